@@ -0,0 +1,123 @@
+"""Pre-aggregated activity series for dashboard charts.
+
+Every registration, candidate, campaign and program increments a counter in
+one hourly and one daily document of ``activity_buckets`` at write time, so
+a chart over any range reads one small document per bucket instead of
+scanning ``created_at`` across whole collections.
+
+Bucket documents look like::
+
+    {"_id": "day:2025-03-14T00:00:00", "granularity": "day", "start": ...,
+     "registrations": 3, "candidates": 1, "campaigns": 2,
+     "campaigns_by_status": {"active": 1, "draft": 1}, "programs": 1}
+
+Campaigns are counted by the status they were created with; statuses other
+than ``STATUSES`` (the field is free text) are counted as ``other``, so
+client input never becomes a field path.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+METRICS = ("registrations", "candidates", "campaigns", "programs", "program_revisions")
+STATUSES = ("draft", "active", "completed")
+# Longest range served per request, in buckets
+MAX_BUCKETS = 24 * 31
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket_id(granularity: str, start: datetime) -> str:
+    return f"{granularity}:{start.isoformat()}"
+
+
+def _status_field(metric: str, status: str) -> str:
+    return f"{metric}_by_status.{status if status in STATUSES else 'other'}"
+
+
+def bucket_updates(metric: str, at: datetime, status: Optional[str] = None) -> List[Tuple[Dict, Dict]]:
+    """``(filter, update)`` pairs incrementing ``metric`` in the buckets containing ``at``"""
+    increments = {metric: 1}
+    if status is not None:
+        increments[_status_field(metric, status)] = 1
+    updates = []
+    for granularity in GRANULARITIES:
+        start = bucket_start(at, granularity)
+        updates.append((
+            {"_id": _bucket_id(granularity, start)},
+            {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+        ))
+    return updates
+
+
+def ensure_indexes(collection):
+    collection.create_index([("granularity", ASCENDING), ("start", ASCENDING)])
+
+
+def rebuild(collection, sources: Dict[str, Tuple[object, Optional[str]]]) -> int:
+    """Compute the buckets from ``created_at`` (``sources``: metric -> (collection, status field)).
+
+    Meant for an empty ``activity_buckets``, when the series are introduced on existing data.
+    """
+    buckets: Dict[Tuple[str, datetime], Counter] = defaultdict(Counter)
+    for metric, (source, status_field) in sources.items():
+        fields = {"_id": 0, "created_at": 1}
+        if status_field:
+            fields[status_field] = 1
+        for doc in source.find({"created_at": {"$exists": True}}, fields):
+            created_at = doc.get("created_at")
+            if not isinstance(created_at, datetime):
+                continue
+            for granularity in GRANULARITIES:
+                counter = buckets[(granularity, bucket_start(created_at, granularity))]
+                counter[metric] += 1
+                if status_field and doc.get(status_field):
+                    counter[_status_field(metric, doc[status_field])] += 1
+
+    operations = []
+    for (granularity, start), counts in buckets.items():
+        fields = {"granularity": granularity, "start": start}
+        for key, count in counts.items():
+            fields[key] = count
+        operations.append(UpdateOne({"_id": _bucket_id(granularity, start)}, {"$set": fields}, upsert=True))
+    for n in range(0, len(operations), 1000):
+        collection.bulk_write(operations[n:n + 1000], ordered=False)
+    return len(operations)
+
+
+def series(collection, granularity: str, start: datetime, end: datetime) -> List[Dict]:
+    """Dense series from ``start`` to ``end``, buckets without activity reported as zeros"""
+    step = GRANULARITIES[granularity]
+    first = bucket_start(start, granularity)
+    stored = {
+        doc["start"]: doc
+        for doc in collection.find(
+            {"granularity": granularity, "start": {"$gte": first, "$lt": end}}, {"_id": 0, "granularity": 0}
+        )
+    }
+    result = []
+    current = first
+    while current < end:
+        doc = stored.get(current, {})
+        entry = {"start": current}
+        for metric in METRICS:
+            entry[metric] = doc.get(metric, 0)
+        entry["campaigns_by_status"] = doc.get("campaigns_by_status", {})
+        result.append(entry)
+        current += step
+    return result
+
+
+def totals(points: Iterable[Dict]) -> Dict:
+    summed = Counter()
+    for point in points:
+        for metric in METRICS:
+            summed[metric] += point[metric]
+    return {metric: summed[metric] for metric in METRICS}
@@ -0,0 +1,116 @@
+"""Campaign analytics computed on columns.
+
+Documents are pulled once per collection, projected to the few fields an
+analysis needs, through a batched cursor (or an aggregation when a value is
+derived server-side, like the length of a program) into one array per
+field. Group-bys and time buckets then run vectorized in pandas/numpy
+instead of looping over dicts in Python.
+
+The report is cached by the endpoint until one of the collections changes
+(see ``ResponseCache`` in compression.py).
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+ANALYTICS_BATCH_SIZE = 5000
+
+BUCKETS = {"day": "D", "week": "W", "month": "M"}
+
+
+def columns(cursor, fields: Iterable[str]) -> pd.DataFrame:
+    """Read a cursor into a DataFrame with one column per field (missing values become None)"""
+    fields = list(fields)
+    data: Dict[str, List] = {field: [] for field in fields}
+    appenders = [(field, data[field].append) for field in fields]
+    for document in cursor:
+        for field, append in appenders:
+            append(document.get(field))
+    return pd.DataFrame(data, columns=fields)
+
+
+def pull(collection, fields: Iterable[str], query: Optional[Dict] = None) -> pd.DataFrame:
+    fields = list(fields)
+    projection = {field: 1 for field in fields}
+    projection["_id"] = 0
+    cursor = collection.find(query or {}, projection).batch_size(ANALYTICS_BATCH_SIZE)
+    return columns(cursor, fields)
+
+
+def time_buckets(dates: pd.Series, bucket: str, by: Optional[pd.Series] = None) -> List[Dict]:
+    """Counts per time bucket (and per ``by`` value), oldest first"""
+    dates = pd.to_datetime(dates, errors="coerce")
+    valid = dates.notna().to_numpy()
+    if not valid.any():
+        return []
+    starts = dates[valid].dt.to_period(BUCKETS[bucket]).dt.start_time
+    if by is None:
+        counts = starts.value_counts().sort_index()
+        return [{"bucket": ts.to_pydatetime(), "count": int(n)} for ts, n in counts.items()]
+    table = pd.crosstab(starts.to_numpy(), by[valid].fillna("sconosciuto").to_numpy()).sort_index()
+    return [
+        {"bucket": pd.Timestamp(ts).to_pydatetime(), "count": int(row.sum()),
+         "by": {str(k): int(v) for k, v in row.items() if v}}
+        for ts, row in table.iterrows()
+    ]
+
+
+def distribution(values: np.ndarray) -> Dict:
+    if values.size == 0:
+        return {"count": 0}
+    p50, p90 = np.percentile(values, [50, 90])
+    return {
+        "count": int(values.size),
+        "total": int(values.sum()),
+        "mean": round(float(values.mean()), 2),
+        "median": float(p50),
+        "p90": float(p90),
+        "max": int(values.max()),
+    }
+
+
+def report(candidates, campaigns, programs, bucket: str = "day", since: Optional[datetime] = None) -> Dict:
+    created = {"created_at": {"$gte": since}} if since else {}
+
+    candidates_df = pull(candidates, ["id", "class_year", "created_at"])
+    campaigns_df = pull(campaigns, ["id", "status", "events_count", "materials_count", "created_at"], created)
+    # Only the length of each program is needed: compute it in the database
+    pipeline = ([{"$match": created}] if created else []) + [
+        {"$project": {"_id": 0, "candidate_id": 1, "created_at": 1,
+                      "length": {"$strLenCP": {"$ifNull": ["$content", ""]}}}},
+    ]
+    programs_df = columns(programs.aggregate(pipeline, batchSize=ANALYTICS_BATCH_SIZE),
+                          ["candidate_id", "created_at", "length"])
+
+    recent_candidates = candidates_df
+    if since is not None:
+        recent_candidates = candidates_df[pd.to_datetime(candidates_df["created_at"], errors="coerce") >= since]
+
+    events = campaigns_df["events_count"].fillna(0).to_numpy(dtype=np.int64)
+    materials = campaigns_df["materials_count"].fillna(0).to_numpy(dtype=np.int64)
+
+    # Program length by the class year of the candidate who wrote it
+    lengths = programs_df.merge(
+        candidates_df[["id", "class_year"]], left_on="candidate_id", right_on="id", how="left"
+    )
+    lengths["class_year"] = lengths["class_year"].fillna("sconosciuto")
+    by_class = lengths.groupby("class_year")["length"].agg(["count", "mean", "median", "max"]).sort_index()
+
+    return {
+        "bucket": bucket,
+        "since": since,
+        "generated_at": datetime.utcnow(),
+        "candidates_created": time_buckets(recent_candidates["created_at"], bucket),
+        "campaigns_created": time_buckets(campaigns_df["created_at"], bucket, by=campaigns_df["status"]),
+        "programs_created": time_buckets(programs_df["created_at"], bucket),
+        "events_per_campaign": distribution(events),
+        "materials_per_campaign": distribution(materials),
+        "campaigns_by_status": {str(k): int(v) for k, v in campaigns_df["status"].value_counts().items()},
+        "program_length_by_class_year": [
+            {"class_year": str(class_year), "programs": int(row["count"]), "mean_chars": round(float(row["mean"]), 1),
+             "median_chars": float(row["median"]), "max_chars": int(row["max"])}
+            for class_year, row in by_class.iterrows()
+        ],
+    }
@@ -0,0 +1,210 @@
+"""Archival of closed elections out of the hot collections.
+
+Archiving an election copies its candidates (those not running in another
+election still to be archived), their campaigns with events and materials,
+their programs with every version, and the ballots into an archive store,
+then deletes them from the live collections. Unindexed scans and counts on
+the live collections then only see the current election.
+
+Two stores, chosen with ``ARCHIVE_BACKEND``:
+
+- ``arrow`` (default when pyarrow is installed): one Arrow IPC file per
+  collection under ``ARCHIVE_DIR/<database>/<election id>/`` (by default
+  ``$XDG_DATA_HOME/lista-elettorale/archive``, outside the code), columnar and
+  compressed with ``ARCHIVE_COMPRESSION`` (``zstd``, ``lz4`` or
+  ``uncompressed``), in record batches of ``ARCHIVE_BATCH_ROWS`` rows.
+  Reads open the file through a memory map and filter one batch at a time,
+  stopping once the requested page is complete, so only the batches
+  scanned are loaded (and decompressed); uncompressed batches are read
+  without any copy.
+- ``collection``: cold ``archive_<collection>`` collections in the same
+  database, indexed by election and candidate.
+
+Archived data is read-only: there is no way to write to it through the API.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+import pandas as pd
+from bson import ObjectId
+from pymongo import ASCENDING
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # optional: without it archives go to cold collections
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BACKEND = os.environ.get('ARCHIVE_BACKEND', 'arrow' if pa is not None else 'collection')
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(
+    os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share'),
+    'lista-elettorale', 'archive',
+))
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'zstd')
+ARCHIVE_BATCH_ROWS = int(os.environ.get('ARCHIVE_BATCH_ROWS', '10000'))
+
+ARCHIVED_COLLECTIONS = (
+    "candidates", "campaigns", "campaign_events", "campaign_materials", "programs", "program_versions", "votes",
+)
+# Fields archived documents can be filtered on
+FILTERS = ("candidate_id", "campaign_id", "program_id")
+
+
+class NotArchivable(Exception):
+    pass
+
+
+def collect(election: Dict, sources: Dict[str, object], candidate_ids: Iterable[str]) -> Dict[str, Dict]:
+    """``{collection: query}`` selecting what belongs to ``election`` in the live collections"""
+    candidate_ids = list(candidate_ids)
+    campaign_ids = sources["campaigns"].distinct("id", {"candidate_id": {"$in": candidate_ids}})
+    program_ids = sources["programs"].distinct("id", {"candidate_id": {"$in": candidate_ids}})
+    return {
+        "candidates": {"id": {"$in": candidate_ids}},
+        "campaigns": {"candidate_id": {"$in": candidate_ids}},
+        "campaign_events": {"campaign_id": {"$in": campaign_ids}},
+        "campaign_materials": {"campaign_id": {"$in": campaign_ids}},
+        "programs": {"candidate_id": {"$in": candidate_ids}},
+        "program_versions": {"program_id": {"$in": program_ids}},
+        "votes": {"election_id": election["id"]},
+    }
+
+
+def _value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def frame(documents: List[Dict]):
+    """``(DataFrame, json_columns)``: nested values and mixed-type columns are stored as JSON text"""
+    rows = [{k: _value(v) for k, v in doc.items() if k != "_id"} for doc in documents]
+    df = pd.DataFrame(rows)
+    json_columns = []
+    for column in df.columns:
+        types = {type(v) for v in df[column] if v is not None and not (isinstance(v, float) and pd.isna(v))}
+        if types - {int, float} and (len(types) > 1 or types & {dict, list}):
+            df[column] = [None if v is None else json.dumps(v, default=str, ensure_ascii=False)
+                          for v in df[column]]
+            json_columns.append(column)
+    return df, json_columns
+
+
+class ArrowArchive:
+    name = "arrow"
+
+    def __init__(self, root: str = ARCHIVE_DIR, compression: str = ARCHIVE_COMPRESSION,
+                 batch_rows: int = ARCHIVE_BATCH_ROWS):
+        if pa is None:
+            raise RuntimeError("ARCHIVE_BACKEND=arrow richiede il pacchetto pyarrow")
+        self.root = root
+        self.compression = None if compression == 'uncompressed' else compression
+        self.batch_rows = batch_rows
+
+    def _path(self, database: str, election_id: str, collection: str) -> str:
+        return os.path.join(self.root, database, election_id, f"{collection}.arrow")
+
+    def write(self, database: str, election_id: str, collection: str, documents: List[Dict]) -> int:
+        path = self._path(database, election_id, collection)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df, json_columns = frame(documents)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({b"json_columns": json.dumps(json_columns).encode()})
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        tmp = path + ".tmp"
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=self.batch_rows)
+        os.replace(tmp, path)
+        return table.num_rows
+
+    def read(self, database: str, election_id: str, collection: str, filters: Dict[str, str],
+             skip: int = 0, limit: int = 100) -> Optional[List[Dict]]:
+        path = self._path(database, election_id, collection)
+        if not os.path.exists(path):
+            return None
+        rows = []
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            if any(field not in reader.schema.names for field in filters):
+                return []
+            metadata = reader.schema.metadata or {}
+            for i in range(reader.num_record_batches):
+                if len(rows) >= limit:
+                    break
+                batch = reader.get_batch(i)
+                for field, value in filters.items():
+                    batch = batch.filter(pc.equal(batch.column(field), value))
+                if skip >= batch.num_rows:
+                    skip -= batch.num_rows
+                    continue
+                rows.extend(batch.slice(skip, limit - len(rows)).to_pylist())
+                skip = 0
+        for column in json.loads(metadata.get(b"json_columns", b"[]")):
+            for row in rows:
+                if row.get(column) is not None:
+                    row[column] = json.loads(row[column])
+        return rows
+
+
+class CollectionArchive:
+    name = "collection"
+
+    def __init__(self, collection: Callable[[str], object]):
+        self.collection = collection
+
+    def _cold(self, name: str):
+        return self.collection(f"archive_{name}")
+
+    def ensure_indexes(self):
+        for name in ARCHIVED_COLLECTIONS:
+            self._cold(name).create_index([("election_id", ASCENDING), ("candidate_id", ASCENDING)])
+
+    def write(self, database: str, election_id: str, collection: str, documents: List[Dict]) -> int:
+        cold = self._cold(collection)
+        cold.delete_many({"election_id": election_id})
+        if documents:
+            cold.insert_many([
+                {**{k: v for k, v in doc.items() if k != "_id"}, "election_id": election_id} for doc in documents
+            ])
+        return len(documents)
+
+    def read(self, database: str, election_id: str, collection: str, filters: Dict[str, str],
+             skip: int = 0, limit: int = 100) -> Optional[List[Dict]]:
+        return list(self._cold(collection).find({"election_id": election_id, **filters}, {"_id": 0})
+                    .skip(skip).limit(limit))
+
+
+def create_store(collection: Callable[[str], object], backend: str = ARCHIVE_BACKEND):
+    if backend == 'arrow':
+        return ArrowArchive()
+    if backend == 'collection':
+        return CollectionArchive(collection)
+    raise RuntimeError(f"ARCHIVE_BACKEND non valido: {backend}")
+
+
+def archive_election(store, database: str, election: Dict, sources: Dict[str, object],
+                     candidate_ids: Iterable[str]) -> Dict:
+    """Copy the election's documents to ``store``, then delete them from ``sources``.
+
+    Returns the archive manifest plus the ids removed per collection.
+    """
+    if election.get("archived_at"):
+        raise NotArchivable("Elezione già archiviata")
+    queries = collect(election, sources, candidate_ids)
+    documents = {name: list(sources[name].find(query)) for name, query in queries.items()}
+    # Copies first: a failure before the deletes leaves the live data untouched
+    counts = {name: store.write(database, election["id"], name, docs) for name, docs in documents.items()}
+    # Delete exactly what was copied: documents matching the queries since then stay live
+    for name, docs in documents.items():
+        if docs:
+            sources[name].delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+    logger.info(f"Elezione {election['id']} archiviata ({store.name}): {counts}")
+    return {
+        "manifest": {"backend": store.name, "archived_at": datetime.utcnow(), "counts": counts},
+        "removed": {name: [d["id"] for d in docs if "id" in d] for name, docs in documents.items()},
+    }
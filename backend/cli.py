@@ -0,0 +1,149 @@
+"""Command line entry point for production deployments.
+
+    python cli.py serve --workers 4
+    python cli.py archive-election <election id>
+    python cli.py precompress-frontend
+    python cli.py migrate-campaign-items
+
+Each worker is a separate process importing ``server:app``; the Mongo
+client is created inside the worker on first use (see database.py), so no
+connection is shared across a fork.
+
+Behind a load balancer or reverse proxy, pass its addresses with
+``--forwarded-allow-ips`` (or ``FORWARDED_ALLOW_IPS``, comma separated, ``*``
+to trust any peer): only then are ``X-Forwarded-For``/``X-Forwarded-Proto``
+used for the client address that rate limits are keyed on. Without it only
+127.0.0.1 is trusted, so a client cannot pick its own address by sending
+the header.
+"""
+import importlib.util
+import os
+from typing import Optional
+
+import typer
+
+cli = typer.Typer(help="Sistema Gestione Lista Elettorale")
+
+
+@cli.callback()
+def main():
+    pass
+
+
+def default_workers() -> int:
+    """Workers sized to the CPUs this process may actually run on"""
+    if os.environ.get('WEB_CONCURRENCY'):
+        return int(os.environ['WEB_CONCURRENCY'])
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus)
+
+
+def _available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+@cli.command()
+def serve(
+    host: str = typer.Option("0.0.0.0", help="Indirizzo di ascolto"),
+    port: int = typer.Option(8001, help="Porta di ascolto"),
+    workers: Optional[int] = typer.Option(None, help="Numero di processi (default: CPU disponibili)"),
+    keep_alive: int = typer.Option(
+        75, help="Secondi di keep-alive; tenere sopra l'idle timeout del load balancer"
+    ),
+    backlog: int = typer.Option(4096, help="Coda di connessioni in attesa di accept()"),
+    graceful_timeout: int = typer.Option(
+        30, help="Secondi concessi alle richieste in corso allo spegnimento"
+    ),
+    limit_concurrency: Optional[int] = typer.Option(
+        None, help="Connessioni concorrenti per worker oltre le quali risponde 503"
+    ),
+    max_requests: Optional[int] = typer.Option(
+        None, help="Riavvia il worker dopo N richieste (limita la crescita di memoria)"
+    ),
+    access_log: bool = typer.Option(False, help="Abilita il log di accesso di uvicorn"),
+    forwarded_allow_ips: Optional[str] = typer.Option(
+        None, envvar="FORWARDED_ALLOW_IPS",
+        help="Indirizzi dei proxy fidati per X-Forwarded-For (default: 127.0.0.1)",
+    ),
+):
+    """Avvia l'API con più worker uvicorn"""
+    import uvicorn
+
+    workers = workers or default_workers()
+    loop = "uvloop" if _available("uvloop") else "asyncio"
+    http = "httptools" if _available("httptools") else "h11"
+    typer.echo(f"Avvio di {workers} worker su {host}:{port} (loop={loop}, http={http})")
+
+    uvicorn.run(
+        "server:app",
+        host=host,
+        port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_keep_alive=keep_alive,
+        backlog=backlog,
+        timeout_graceful_shutdown=graceful_timeout,
+        limit_concurrency=limit_concurrency,
+        limit_max_requests=max_requests,
+        access_log=access_log,
+        proxy_headers=True,
+        forwarded_allow_ips=forwarded_allow_ips,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+@cli.command("archive-election")
+def archive_election(
+    election_id: str = typer.Argument(..., help="Id dell'elezione chiusa da archiviare"),
+    tenant: Optional[str] = typer.Option(None, help="Scuola (tenant) dell'elezione; default: DEFAULT_TENANT"),
+):
+    """Sposta i dati di un'elezione chiusa nell'archivio (ARCHIVE_BACKEND, vedi archive.py)"""
+    import archive
+    import server
+    import tenancy
+
+    with tenancy.use(tenant or tenancy.DEFAULT_TENANT):
+        server.connect_database()
+        try:
+            manifest = server.archive_closed_election(election_id)
+        except (LookupError, archive.NotArchivable) as e:
+            typer.echo(f"Errore: {e}", err=True)
+            raise typer.Exit(code=1)
+    counts = ", ".join(f"{name}={count}" for name, count in manifest["counts"].items())
+    typer.echo(f"Elezione {election_id} archiviata ({manifest['backend']}): {counts}")
+
+
+@cli.command("precompress-frontend")
+def precompress_frontend(
+    build_dir: Optional[str] = typer.Option(None, help="Cartella della build React (default: FRONTEND_BUILD_DIR)"),
+):
+    """Crea le varianti .br/.gz della build React servite dal backend (vedi frontend.py)"""
+    import frontend
+
+    root = build_dir or frontend.FRONTEND_BUILD_DIR
+    if not os.path.isdir(root):
+        typer.echo(f"Errore: cartella {root} non trovata, eseguire prima la build del frontend", err=True)
+        raise typer.Exit(code=1)
+    written = frontend.precompress_tree(root)
+    typer.echo(f"Varianti precompresse create: {written}")
+
+
+@cli.command("migrate-campaign-items")
+def migrate_campaign_items():
+    """Sposta eventi e materiali ancora incorporati nelle campagne nelle loro collezioni, per ogni scuola"""
+    import server
+    import tenancy
+
+    server.connect_database()
+    for tenant in (tenancy.DEFAULT_TENANT, *tenancy.TENANTS):
+        with tenancy.use(tenant):
+            migrated = server.migrate_embedded_campaign_items()
+        typer.echo(f"{tenant}: campagne migrate {migrated}")
+
+
+if __name__ == "__main__":
+    cli()
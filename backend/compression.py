@@ -0,0 +1,336 @@
+"""Response compression with Brotli/gzip negotiation and a compressed-body cache.
+
+``CompressionMiddleware`` replaces Starlette's ``GZipMiddleware``: it picks
+Brotli or gzip from ``Accept-Encoding`` (Brotli only when the ``brotli``
+package is installed), uses a level chosen per path prefix and compresses
+bodies larger than ``COMPRESSION_THREAD_MIN`` in the threadpool, so one big
+response does not stall the event loop for every other request.
+
+Levels are configured with ``COMPRESSION_LEVELS`` as ``prefix=gzip/brotli``
+pairs, the longest matching prefix winning::
+
+    COMPRESSION_LEVELS="default=6/4,/api/programs=9/9,/api/events=4/3"
+
+``ResponseCache`` keeps serialized bodies of cacheable endpoints together
+with their compressed variants, computed once at ``COMPRESSION_CACHE_LEVELS``
+(which can afford to be high). Entries are tied to a validator computed by
+the endpoint from cheap indexed queries; a different validator rebuilds the
+entry. Cached responses already carry ``Content-Encoding`` and go through the
+middleware untouched.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+
+import profiling
+import tenancy
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1000'))
+COMPRESSION_LEVELS = os.environ.get('COMPRESSION_LEVELS', 'default=6/4')
+COMPRESSION_CACHE_LEVELS = os.environ.get('COMPRESSION_CACHE_LEVELS', '9/11')
+COMPRESSION_THREAD_MIN = int(os.environ.get('COMPRESSION_THREAD_MIN', str(64 * 1024)))
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', '256'))
+
+# Already compressed or binary formats that do not shrink
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip',
+                        'application/x-brotli', 'font/woff')
+
+
+def _levels(spec: str) -> Tuple[int, int]:
+    gzip_level, _, brotli_quality = spec.partition('/')
+    return int(gzip_level), int(brotli_quality or 4)
+
+
+def parse_levels(spec: str) -> Dict[str, Tuple[int, int]]:
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        prefix, _, value = item.rpartition('=')
+        levels[prefix.strip()] = _levels(value)
+    levels.setdefault('default', (6, 4))
+    return levels
+
+
+def negotiate(accept_encoding: str) -> str:
+    """Best supported encoding for an Accept-Encoding header: br, gzip or identity"""
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.strip().lower()] = q
+    wildcard = weights.get('*', 0.0)
+    candidates = (('br',) if brotli is not None else ()) + ('gzip',)
+    best, best_q = 'identity', 0.0
+    for encoding in candidates:
+        q = weights.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=level, mode=brotli.MODE_TEXT)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str, level: int):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level, mode=brotli.MODE_TEXT)
+            self._process, self._flush, self._finish = (
+                self._compressor.process, self._compressor.flush, self._compressor.finish)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._process = self._compressor.compress
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+
+    def chunk(self, data: bytes, last: bool) -> bytes:
+        out = self._process(data)
+        return out + (self._finish() if last else self._flush())
+
+
+class CompressionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+
+    def record(self, encoding: str, before: int, after: int, offloaded: bool = False):
+        with self._lock:
+            self.counters[f"{encoding}_responses"] += 1
+            self.counters[f"{encoding}_bytes_in"] += before
+            self.counters[f"{encoding}_bytes_out"] += after
+            if offloaded:
+                self.counters["offloaded"] += 1
+
+    def incr(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+        for encoding in ('br', 'gzip'):
+            bytes_in = counters.get(f"{encoding}_bytes_in")
+            if bytes_in:
+                counters[f"{encoding}_ratio"] = round(counters[f"{encoding}_bytes_out"] / bytes_in, 3)
+        return {"brotli_available": brotli is not None, "counters": counters}
+
+
+stats = CompressionStats()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, levels: Optional[str] = None,
+                 thread_min: int = COMPRESSION_THREAD_MIN):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = parse_levels(levels if levels is not None else COMPRESSION_LEVELS)
+        self.thread_min = thread_min
+
+    def level_for(self, path: str, encoding: str) -> int:
+        prefix = max((p for p in self.levels if p != 'default' and path.startswith(p)), key=len, default='default')
+        gzip_level, brotli_quality = self.levels[prefix]
+        return brotli_quality if encoding == 'br' else gzip_level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding == 'identity':
+            await self.app(scope, receive, send)
+            return
+        responder = _Responder(self, send, encoding, self.level_for(scope["path"], encoding))
+        await self.app(scope, receive, responder.send)
+
+
+class _Responder:
+    def __init__(self, middleware: CompressionMiddleware, send, encoding: str, level: int):
+        self.middleware = middleware
+        self.downstream = send
+        self.encoding = encoding
+        self.level = level
+        self.start_message = None
+        self.passthrough = False
+        self.stream: Optional[_StreamCompressor] = None
+        self.profile = profiling.current_profile.get()
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            headers = Headers(raw=message.get("headers", []))
+            content_type = headers.get("content-type", "")
+            self.passthrough = "content-encoding" in headers or content_type.startswith(INCOMPRESSIBLE_TYPES)
+            return
+        if message["type"] != "http.response.body":
+            if self.start_message is not None:
+                # http.response.pathsend: the file goes out as it is on disk
+                await self.downstream(self.start_message)
+                self.start_message = None
+            await self.downstream(message)
+            return
+
+        if self.passthrough:
+            if self.start_message is not None:
+                await self.downstream(self.start_message)
+                self.start_message = None
+            await self.downstream(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        start = time.perf_counter()
+        if self.start_message is not None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if not more_body and len(body) < self.middleware.minimum_size:
+                await self.downstream(self.start_message)
+                self.start_message = None
+                await self.downstream(message)
+                return
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                offloaded = len(body) >= self.middleware.thread_min
+                if offloaded:
+                    compressed = await run_in_threadpool(compress, body, self.encoding, self.level)
+                else:
+                    compressed = compress(body, self.encoding, self.level)
+                stats.record(self.encoding, len(body), len(compressed), offloaded)
+                headers["Content-Length"] = str(len(compressed))
+                self._timed(start)
+                await self.downstream(self.start_message)
+                self.start_message = None
+                await self.downstream({"type": "http.response.body", "body": compressed})
+                return
+            # Streaming response: compress chunk by chunk
+            del headers["Content-Length"]
+            self.stream = _StreamCompressor(self.encoding, self.level)
+            await self.downstream(self.start_message)
+            self.start_message = None
+
+        compressed = self.stream.chunk(body, last=not more_body)
+        stats.record(self.encoding, len(body), len(compressed))
+        self._timed(start)
+        await self.downstream({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+    def _timed(self, start: float):
+        if self.profile is not None:
+            self.profile.add('compression', time.perf_counter() - start)
+
+
+def json_body(payload) -> bytes:
+    """Serialize like FastAPI's JSONResponse, compactly"""
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class ResponseCache:
+    """Serialized JSON bodies plus their compressed variants, keyed by endpoint and args"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_ENTRIES, levels: str = COMPRESSION_CACHE_LEVELS):
+        self.max_entries = max_entries
+        self.gzip_level, self.brotli_quality = _levels(levels)
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str, validator) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["validator"] != validator:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def entry(self, key: str, validator, build: Callable[[], Union[Dict, bytes]]) -> dict:
+        """Cache entry for ``key``, rebuilt with ``build()`` when ``validator`` changed.
+
+        ``build`` returns the payload, or its JSON serialization as bytes.
+        Keys are local to the current tenant (see tenancy.py).
+        """
+        key = tenancy.scoped(key)
+        entry = self._get(key, validator)
+        if entry is None:
+            stats.incr("cache_misses")
+            body = build()
+            if not isinstance(body, bytes):
+                body = json_body(body)
+            etag = '"' + hashlib.sha1(repr((key, validator)).encode()).hexdigest()[:20] + '"'
+            entry = {"validator": validator, "etag": etag, "bodies": {"identity": body}}
+            self._put(key, entry)
+        else:
+            stats.incr("cache_hits")
+        return entry
+
+    def body(self, key: str, validator, build: Callable[[], Union[Dict, bytes]]) -> bytes:
+        """Serialized JSON body for ``key`` (see ``entry``)"""
+        return self.entry(key, validator, build)["bodies"]["identity"]
+
+    async def respond(self, request, key: str, validator, build: Callable[[], Union[Dict, bytes]]) -> Response:
+        """Response for ``key`` with ETag and the negotiated encoding (see ``entry``)"""
+        entry = self.entry(key, validator, build)
+        headers = {"ETag": entry["etag"], "Vary": "Accept-Encoding"}
+        if entry["etag"] in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=headers)
+
+        identity = entry["bodies"]["identity"]
+        encoding = negotiate(request.headers.get("accept-encoding", ""))
+        if encoding == 'identity' or len(identity) < COMPRESSION_MIN_SIZE:
+            return Response(identity, media_type="application/json", headers=headers)
+
+        body = entry["bodies"].get(encoding)
+        if body is None:
+            level = self.brotli_quality if encoding == 'br' else self.gzip_level
+            body = await run_in_threadpool(compress, identity, encoding, level)
+            # Benign race: two requests may both compress; the result is identical
+            entry["bodies"][encoding] = body
+            stats.record(encoding, len(identity), len(body), offloaded=True)
+        headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            "entries": len(entries),
+            "max_entries": self.max_entries,
+            "bytes": sum(len(b) for e in entries for b in e["bodies"].values()),
+        }
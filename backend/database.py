@@ -0,0 +1,252 @@
+"""MongoDB client configuration.
+
+All settings come from the environment so each deployment can size the
+connection pool and timeouts without code changes:
+
+- ``MONGO_MIN_POOL_SIZE`` / ``MONGO_MAX_POOL_SIZE``: connections kept per server
+- ``MONGO_MAX_IDLE_TIME_MS``: close pooled connections idle for longer
+- ``MONGO_WAIT_QUEUE_TIMEOUT_MS``: max wait for a free pooled connection
+- ``MONGO_SERVER_SELECTION_TIMEOUT_MS``, ``MONGO_CONNECT_TIMEOUT_MS``,
+  ``MONGO_SOCKET_TIMEOUT_MS``: network timeouts
+- ``MONGO_COMPRESSORS``: wire compression, e.g. ``zstd,snappy,zlib``
+- ``MONGO_READ_PREFERENCE`` / ``MONGO_READ_MAX_STALENESS_S``: where list
+  reads are routed (``primary``, ``secondaryPreferred``, ``nearest``, ...)
+"""
+import functools
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from pymongo import MongoClient, monitoring
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+logger = logging.getLogger(__name__)
+
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+DB_NAME = os.environ.get('DB_NAME', 'lista_elettorale')
+
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+
+MONGO_MIN_POOL_SIZE = _env_int('MONGO_MIN_POOL_SIZE', 0)
+MONGO_MAX_POOL_SIZE = _env_int('MONGO_MAX_POOL_SIZE', 100)
+MONGO_MAX_IDLE_TIME_MS = _env_int('MONGO_MAX_IDLE_TIME_MS', 300000)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = _env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+MONGO_CONNECT_TIMEOUT_MS = _env_int('MONGO_CONNECT_TIMEOUT_MS', 5000)
+MONGO_SOCKET_TIMEOUT_MS = _env_int('MONGO_SOCKET_TIMEOUT_MS', 30000)
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', 'zstd,snappy,zlib')
+MONGO_READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+MONGO_READ_MAX_STALENESS_S = _env_int('MONGO_READ_MAX_STALENESS_S', None)
+
+_READ_PREFERENCES = {
+    'primary': Primary,
+    'primarypreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondarypreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+# Python package each wire compressor needs; zlib ships with Python
+_COMPRESSOR_MODULES = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': 'zlib'}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool counters, aggregated per server address"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = defaultdict(lambda: defaultdict(int))
+
+    def _inc(self, address, key: str, amount: int = 1):
+        with self._lock:
+            self._servers[f"{address[0]}:{address[1]}"][key] += amount
+
+    def pool_created(self, event):
+        self._inc(event.address, 'pools_created')
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc(event.address, 'pools_cleared')
+
+    def pool_closed(self, event):
+        self._inc(event.address, 'pools_closed')
+
+    def connection_created(self, event):
+        self._inc(event.address, 'connections_created')
+        self._inc(event.address, 'connections_open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc(event.address, 'connections_closed')
+        self._inc(event.address, 'connections_open', -1)
+
+    def connection_check_out_started(self, event):
+        self._inc(event.address, 'checkouts_started')
+
+    def connection_check_out_failed(self, event):
+        self._inc(event.address, 'checkouts_failed')
+        self._inc(event.address, f'checkouts_failed_{event.reason}')
+
+    def connection_checked_out(self, event):
+        self._inc(event.address, 'checkouts')
+        self._inc(event.address, 'connections_in_use')
+
+    def connection_checked_in(self, event):
+        self._inc(event.address, 'connections_in_use', -1)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(counters) for address, counters in self._servers.items()}
+
+
+pool_metrics = PoolMetrics()
+_event_listeners = [pool_metrics]
+
+
+def add_event_listener(listener):
+    """Register a pymongo event listener for clients created from now on"""
+    _event_listeners.append(listener)
+
+
+@functools.lru_cache(maxsize=None)
+def available_compressors(requested: str = MONGO_COMPRESSORS) -> Tuple[str, ...]:
+    compressors = []
+    for name in [c.strip() for c in requested.split(',') if c.strip()]:
+        module = _COMPRESSOR_MODULES.get(name)
+        if module is None:
+            logger.warning(f"Compressore MongoDB sconosciuto ignorato: {name}")
+            continue
+        try:
+            __import__(module)
+        except ImportError:
+            logger.info(f"Compressore MongoDB {name} non disponibile (manca il pacchetto {module})")
+            continue
+        compressors.append(name)
+    return tuple(compressors)
+
+
+def read_preference(name: str = MONGO_READ_PREFERENCE, max_staleness: Optional[int] = MONGO_READ_MAX_STALENESS_S):
+    cls = _READ_PREFERENCES.get(name.replace('_', '').lower())
+    if cls is None:
+        raise ValueError(f"MONGO_READ_PREFERENCE non valida: {name}")
+    if cls is Primary or max_staleness is None:
+        return cls()
+    return cls(max_staleness=max_staleness)
+
+
+def client_options() -> Dict:
+    options = {
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "event_listeners": list(_event_listeners),
+    }
+    compressors = available_compressors()
+    if compressors:
+        options["compressors"] = list(compressors)
+    return options
+
+
+def create_client(url: str = MONGO_URL) -> MongoClient:
+    return MongoClient(url, **client_options())
+
+
+_client: Optional[MongoClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+_databases: Dict[Tuple[str, bool], Database] = {}
+
+
+def get_client() -> MongoClient:
+    """Return this process' client, creating it on first use.
+
+    MongoClient is not fork-safe, so the client is built lazily in each
+    worker process rather than at import time in the parent.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = create_client()
+                _client_pid = pid
+                _databases.clear()
+    return _client
+
+
+def get_database(read: bool = False, name: str = DB_NAME) -> Database:
+    """Database handle; ``read=True`` applies ``MONGO_READ_PREFERENCE``.
+
+    Every database (one per tenant, see tenancy.py) shares the process' client.
+    """
+    client = get_client()
+    database = _databases.get((name, read))
+    if database is None or database.client is not client:
+        if read:
+            database = client.get_database(name, read_preference=read_preference())
+        else:
+            database = client[name]
+        _databases[(name, read)] = database
+    return database
+
+
+def close_client():
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+        _databases.clear()
+
+
+def _redacted(url: str) -> str:
+    return re.sub(r'//[^@/]*@', '//***@', url)
+
+
+def check_connection():
+    """Ping the server so a misconfigured deployment fails at startup, not on the first request"""
+    try:
+        get_client().admin.command('ping')
+    except PyMongoError as e:
+        raise RuntimeError(
+            f"MongoDB non raggiungibile ({_redacted(MONGO_URL)}) entro {MONGO_SERVER_SELECTION_TIMEOUT_MS} ms: {e}"
+        ) from e
+
+
+def pool_stats() -> Dict:
+    return {
+        "options": {
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "wait_queue_timeout_ms": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            "compressors": list(available_compressors()),
+            "read_preference": MONGO_READ_PREFERENCE,
+        },
+        "servers": pool_metrics.snapshot(),
+    }
@@ -0,0 +1,229 @@
+"""Serving the React build (``frontend/build``) from the API workers.
+
+The build directory is scanned once per worker. For every file the content
+type, size and a strong ETag are computed up front, and the ``.br``/``.gz``
+variants found next to it are recorded. They are created at build time by
+``python cli.py precompress-frontend`` at the highest levels, since they are
+computed once per deployment. ``STATIC_PRECOMPRESS=1`` creates the missing
+ones at startup instead, when the build directory is writable; otherwise the
+variants already there are served.
+
+Responses:
+
+- fingerprinted files (``static/js/main.3f2a9c1e.js``) never change under
+  the same name and are sent with ``Cache-Control: public, max-age=31536000,
+  immutable``;
+- everything else, ``index.html`` first of all, is revalidated on each use
+  (``no-cache``) and answered with 304 when ``If-None-Match`` matches;
+- the best variant accepted by the client is sent as is, so nothing is
+  compressed per request;
+- files up to ``STATIC_CACHE_MAX_FILE`` are kept in memory, least recently
+  used first out beyond ``STATIC_CACHE_BYTES``; larger ones go through
+  ``FileResponse``, which hands the path to the server when it supports the
+  ASGI pathsend extension (sendfile) and streams it in chunks otherwise;
+- unknown paths without an extension get ``index.html``, so client-side
+  routes survive a reload.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from starlette.responses import FileResponse, Response
+
+from compression import brotli, compress, negotiate
+
+logger = logging.getLogger(__name__)
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRONTEND_BUILD_DIR = os.environ.get('FRONTEND_BUILD_DIR', os.path.join(_REPO_DIR, 'frontend', 'build'))
+STATIC_PRECOMPRESS = os.environ.get('STATIC_PRECOMPRESS', '0') not in ('0', 'false', 'no')
+STATIC_CACHE_BYTES = int(os.environ.get('STATIC_CACHE_BYTES', str(32 * 1024 * 1024)))
+STATIC_CACHE_MAX_FILE = int(os.environ.get('STATIC_CACHE_MAX_FILE', str(256 * 1024)))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+INDEX = "index.html"
+
+# Suffix of each precompressed variant and the level used to create it
+VARIANTS = {"br": (".br", 11), "gzip": (".gz", 9)}
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.xml', '.ico', '.webmanifest')
+# Below this size a compressed variant is not worth a second file
+PRECOMPRESS_MIN_SIZE = 512
+
+# CRA names: main.3f2a9c1e.js, 787.1b2c3d4e.chunk.js, logo.6ce24c58023cc2f8fd88fe9d219db6c6.svg
+_FINGERPRINT = re.compile(r'\.[0-9a-f]{8,}\.(?:chunk\.)?[A-Za-z0-9]+$')
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+
+class _Asset:
+    __slots__ = ('path', 'size', 'content_type', 'etag', 'immutable', 'variants')
+
+    def __init__(self, path: str, relative: str, digest: str):
+        self.path = path
+        self.size = os.path.getsize(path)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.etag = f'"{digest}"'
+        self.immutable = relative.startswith('static/') and bool(_FINGERPRINT.search(relative))
+        self.variants: Dict[str, tuple] = {}  # encoding -> (path, size)
+
+
+def precompress(path: str) -> int:
+    """Write missing or stale ``.br``/``.gz`` variants of ``path``; returns how many were written"""
+    if not path.endswith(COMPRESSIBLE) or os.path.getsize(path) < PRECOMPRESS_MIN_SIZE:
+        return 0
+    written = 0
+    body = None
+    for encoding, (suffix, level) in VARIANTS.items():
+        if encoding == 'br' and brotli is None:
+            continue
+        target = path + suffix
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+            continue
+        if body is None:
+            with open(path, 'rb') as f:
+                body = f.read()
+        compressed = compress(body, encoding, level)
+        if len(compressed) >= len(body) * 0.9:
+            continue
+        tmp = f"{target}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp, target)  # workers starting together may race: last complete file wins
+        written += 1
+    return written
+
+
+def precompress_tree(root: str = FRONTEND_BUILD_DIR) -> int:
+    written = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if not name.endswith(tuple(suffix for suffix, _ in VARIANTS.values())):
+                written += precompress(os.path.join(directory, name))
+    return written
+
+
+class StaticFrontend:
+    def __init__(self, root: str = FRONTEND_BUILD_DIR, cache_bytes: int = STATIC_CACHE_BYTES,
+                 cache_max_file: int = STATIC_CACHE_MAX_FILE):
+        self.root = os.path.realpath(root)
+        self.cache_bytes = cache_bytes
+        self.cache_max_file = cache_max_file
+        self._assets: Dict[str, _Asset] = {}
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def available(self) -> bool:
+        return INDEX in self._assets
+
+    def load(self, precompress_missing: bool = STATIC_PRECOMPRESS) -> int:
+        """Scan the build directory; returns the number of files served (0 without a build)"""
+        if not os.path.isfile(os.path.join(self.root, INDEX)):
+            return 0
+        if precompress_missing:
+            try:
+                written = precompress_tree(self.root)
+                if written:
+                    logger.info(f"Frontend: create {written} varianti precompresse")
+            except OSError as e:
+                # Read-only image or volume: serve the variants created at build time
+                logger.warning(f"Frontend: varianti precompresse non create ({e})")
+        assets = {}
+        suffixes = {suffix: encoding for encoding, (suffix, _) in VARIANTS.items()}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.tmp') or os.path.splitext(name)[1] in suffixes:
+                    continue
+                path = os.path.join(directory, name)
+                relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()[:20]
+                asset = _Asset(path, relative, digest)
+                for suffix, encoding in suffixes.items():
+                    if os.path.isfile(path + suffix):
+                        asset.variants[encoding] = (path + suffix, os.path.getsize(path + suffix))
+                assets[relative] = asset
+        with self._lock:
+            self._assets = assets
+            self._cache.clear()
+            self._cached_bytes = 0
+        return len(assets)
+
+    def resolve(self, path: str) -> Optional[_Asset]:
+        path = path.lstrip('/') or INDEX
+        asset = self._assets.get(path)
+        if asset is None and '.' not in path.rsplit('/', 1)[-1]:
+            # Client-side route
+            asset = self._assets.get(INDEX)
+        return asset
+
+    def _body(self, asset: _Asset, encoding: str, path: str, size: int) -> Optional[bytes]:
+        if size > self.cache_max_file:
+            return None
+        key = (asset.path, encoding)
+        with self._lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return body
+        with open(path, 'rb') as f:
+            body = f.read()
+        with self._lock:
+            self.misses += 1
+            if key not in self._cache:
+                self._cache[key] = body
+                self._cached_bytes += len(body)
+            while self._cached_bytes > self.cache_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return body
+
+    def response(self, request, path: str) -> Optional[Response]:
+        asset = self.resolve(path)
+        if asset is None:
+            return None
+        encoding = negotiate(request.headers.get("accept-encoding", ""))
+        if encoding not in asset.variants:
+            encoding = 'identity'
+        etag = asset.etag if encoding == 'identity' else f'{asset.etag[:-1]}-{encoding}"'
+        headers = {
+            "Cache-Control": IMMUTABLE if asset.immutable else REVALIDATE,
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+        }
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=headers)
+        if encoding != 'identity':
+            headers["Content-Encoding"] = encoding
+        file_path, size = asset.variants.get(encoding, (asset.path, asset.size))
+        body = self._body(asset, encoding, file_path, size)
+        if body is None:
+            return FileResponse(file_path, media_type=asset.content_type, headers=headers)
+        return Response(body, headers=headers, media_type=asset.content_type)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "root": self.root,
+                "available": self.available,
+                "files": len(self._assets),
+                "immutable": sum(a.immutable for a in self._assets.values()),
+                "precompressed": {
+                    encoding: sum(encoding in a.variants for a in self._assets.values()) for encoding in VARIANTS
+                },
+                "cache": {"entries": len(self._cache), "bytes": self._cached_bytes,
+                          "hits": self.hits, "misses": self.misses},
+            }
@@ -0,0 +1,274 @@
+"""Idempotency keys for create endpoints.
+
+A client that retries a POST after a network error sends the same
+``Idempotency-Key`` header. The first request runs normally and its response
+is stored; retries with the same key get that response back (marked with
+``Idempotent-Replayed: true``) instead of creating a second record.
+
+Records live in the ``idempotency_keys`` collection, removed by a TTL index
+on ``expires_at``: completed responses are kept for ``IDEMPOTENCY_TTL_S``,
+while a record still in progress expires after ``IDEMPOTENCY_LOCK_S`` so a
+worker that died mid-request does not block the key forever.
+
+Concurrent duplicates are coalesced: within a worker they wait on the first
+request's future, across workers they poll the pending record for up to
+``IDEMPOTENCY_WAIT_MS`` and answer 409 if it is still running. A key reused
+with a different body is rejected with 422. Responses with status 5xx are not
+stored, so the client can retry them.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo.errors import DuplicateKeyError
+
+from ratelimit import client_key
+import tenancy
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL_S = int(os.environ.get('IDEMPOTENCY_TTL_S', str(24 * 3600)))
+IDEMPOTENCY_LOCK_S = int(os.environ.get('IDEMPOTENCY_LOCK_S', '60'))
+IDEMPOTENCY_WAIT_MS = int(os.environ.get('IDEMPOTENCY_WAIT_MS', '10000'))
+IDEMPOTENCY_POLL_MS = 50
+MAX_KEY_LENGTH = 255
+
+# Headers worth replaying; content-length is recomputed from the stored body
+REPLAYED_HEADERS = {b'content-type', b'location'}
+
+
+class _Conflict(Exception):
+    def __init__(self, status: int, detail: str):
+        self.status = status
+        self.detail = detail
+
+
+class IdempotencyStore:
+    def __init__(self, collection, ttl_s: int = IDEMPOTENCY_TTL_S, lock_s: int = IDEMPOTENCY_LOCK_S,
+                 wait_ms: int = IDEMPOTENCY_WAIT_MS):
+        self._collection = collection
+        self.ttl = timedelta(seconds=ttl_s)
+        self.lock = timedelta(seconds=lock_s)
+        self.wait = wait_ms / 1000
+        self._inflight: Dict[str, tuple] = {}
+        self.counters = defaultdict(int)
+
+    def claim(self, key: str, fingerprint: str) -> Optional[Dict]:
+        """Insert a pending record for ``key``; return the existing record if there is one"""
+        now = datetime.utcnow()
+        for _ in range(3):
+            try:
+                self._collection.insert_one({
+                    "_id": key, "fingerprint": fingerprint, "status": "pending",
+                    "created_at": now, "expires_at": now + self.lock,
+                })
+                return None
+            except DuplicateKeyError:
+                existing = self._collection.find_one({"_id": key})
+                if existing is None:
+                    continue
+                if existing["status"] == "pending" and existing["expires_at"] <= now:
+                    # Abandoned by a worker that died; the TTL monitor has not removed it yet
+                    self._collection.delete_one({"_id": key, "expires_at": existing["expires_at"]})
+                    continue
+                return existing
+        raise _Conflict(409, "Richiesta con la stessa Idempotency-Key ancora in corso")
+
+    def complete(self, key: str, response: Dict):
+        now = datetime.utcnow()
+        self._collection.update_one(
+            {"_id": key},
+            {"$set": {"status": "done", "response": response, "expires_at": now + self.ttl}}
+        )
+
+    def release(self, key: str):
+        self._collection.delete_one({"_id": key, "status": "pending"})
+
+    async def wait_for(self, key: str, fingerprint: str) -> Dict:
+        """Wait for a request running in another worker to store its response"""
+        deadline = time.monotonic() + self.wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(IDEMPOTENCY_POLL_MS / 1000)
+            record = await run_in_threadpool(self._collection.find_one, {"_id": key})
+            if record is None:
+                # The first request failed and released the key: run this one instead
+                if await run_in_threadpool(self.claim, key, fingerprint) is None:
+                    return None
+                continue
+            if record["status"] == "done":
+                return record["response"]
+        raise _Conflict(409, "Richiesta con la stessa Idempotency-Key ancora in corso")
+
+    def stats(self) -> Dict:
+        return {
+            "ttl_s": self.ttl.total_seconds(),
+            "in_flight": len(self._inflight),
+            "counters": dict(self.counters),
+        }
+
+
+def _fingerprint(method: str, path: str, body: bytes) -> str:
+    return hashlib.sha256(method.encode() + b' ' + path.encode() + b'\n' + body).hexdigest()
+
+
+def _record_key(scope, idempotency_key: str) -> str:
+    # Keys are scoped per client; hashed so tokens never end up in the collection
+    client = client_key(scope)
+    owner = client if client.startswith("token:") else "anonymous"
+    raw = f"{tenancy.current()}|{owner}|{scope['method']} {scope['path']}|{idempotency_key}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def _send_json(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _replay(send, response: Dict):
+    body = response["body"]
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response["headers"]]
+    headers += [(b"content-length", str(len(body)).encode()), (b"idempotent-replayed", b"true")]
+    await send({"type": "http.response.start", "status": response["status"], "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """Applies ``Idempotency-Key`` semantics to the given ``(method, path)`` routes"""
+
+    def __init__(self, app, store: IdempotencyStore, routes):
+        self.app = app
+        self.store = store
+        self.routes = set(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            await self.app(scope, receive, send)
+            return
+        idempotency_key = None
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                idempotency_key = value.decode("latin-1").strip()
+                break
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            await _send_json(send, 400, f"Idempotency-Key troppo lunga (massimo {MAX_KEY_LENGTH} caratteri)")
+            return
+
+        body = await _read_body(receive)
+        fingerprint = _fingerprint(scope["method"], scope["path"], body)
+        key = _record_key(scope, idempotency_key)
+        try:
+            response = await self._existing_response(key, fingerprint)
+        except _Conflict as e:
+            self.store.counters["conflicts"] += 1
+            await _send_json(send, e.status, e.detail)
+            return
+        if response is not None:
+            self.store.counters["replayed"] += 1
+            await _replay(send, response)
+            return
+        await self._execute(scope, body, send, key)
+
+    async def _existing_response(self, key: str, fingerprint: str) -> Optional[Dict]:
+        """Stored (or concurrently produced) response for ``key``; None once this request owns it"""
+        inflight = self.store._inflight.get(key)
+        if inflight is not None:
+            owner_fingerprint, future = inflight
+            if owner_fingerprint != fingerprint:
+                raise _Conflict(422, "Idempotency-Key già usata per una richiesta diversa")
+            self.store.counters["coalesced"] += 1
+            response = await asyncio.shield(future)
+            if response is not None:
+                return response
+            # The first request was not stored (5xx): run this one instead
+
+        future = asyncio.get_running_loop().create_future()
+        self.store._inflight[key] = (fingerprint, future)
+        try:
+            existing = await run_in_threadpool(self.store.claim, key, fingerprint)
+            if existing is None:
+                return None
+            if existing["fingerprint"] != fingerprint:
+                raise _Conflict(422, "Idempotency-Key già usata per una richiesta diversa")
+            if existing["status"] == "done":
+                response = existing["response"]
+            else:
+                response = await self.store.wait_for(key, fingerprint)
+                if response is None:
+                    return None
+        except BaseException:
+            self._resolve(key, None)
+            raise
+        self._resolve(key, response)
+        return response
+
+    async def _execute(self, scope, body: bytes, send, key: str):
+        sent_body = False
+
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return {"type": "http.disconnect"}
+
+        status = None
+        headers = []
+        chunks = []
+
+        async def capture(message):
+            nonlocal status, headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = [(name.decode("latin-1"), value.decode("latin-1"))
+                           for name, value in message.get("headers", []) if name.lower() in REPLAYED_HEADERS]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        response = None
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            try:
+                if status is not None and status < 500:
+                    response = {"status": status, "headers": headers, "body": b"".join(chunks)}
+                    await run_in_threadpool(self.store.complete, key, response)
+                    self.store.counters["stored"] += 1
+                else:
+                    await run_in_threadpool(self.store.release, key)
+            except Exception as e:
+                response = None
+                logger.error(f"Errore salvataggio risposta idempotente: {e}")
+            self._resolve(key, response)
+
+    def _resolve(self, key: str, response: Optional[Dict]):
+        inflight = self.store._inflight.pop(key, None)
+        if inflight is not None and not inflight[1].done():
+            inflight[1].set_result(response)
@@ -0,0 +1,95 @@
+"""Periodic data hygiene jobs (scheduled by scheduler.py, see server.py).
+
+- ``expire_tokens``: drop session tokens issued more than ``TOKEN_TTL_HOURS``
+  ago, so the ``token`` index only holds live sessions. Expired tokens are
+  already refused by ``verify_token``; this only reclaims the space.
+- ``compact_orphans``: find campaigns (with their events and materials) and
+  programs (with their versions) whose owner no longer exists. The owner in
+  ``candidate_id`` is a candidate id, or the user id for campaigns and
+  programs written by candidate-role users (the frontend sends ``user.id``),
+  so both count as live. Orphans are only reported unless
+  ``ORPHAN_COMPACTION=delete``; deletions record tombstones for delta sync.
+  Documents younger than ``ORPHAN_GRACE_S`` are left alone, so a write
+  still in flight is never mistaken for an orphan.
+- ``reconcile_campaign_counters``: recount the ``events_count`` and
+  ``materials_count`` kept on campaigns and fix those that drifted.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict
+
+TOKEN_TTL_HOURS = float(os.environ.get('TOKEN_TTL_HOURS', '168'))
+ORPHAN_GRACE_S = int(os.environ.get('ORPHAN_GRACE_S', '3600'))
+# "report" (default) only counts orphans, "delete" removes them
+ORPHAN_COMPACTION = os.environ.get('ORPHAN_COMPACTION', 'report')
+
+
+def token_expired(user: Dict, now: datetime = None) -> bool:
+    issued_at = user.get('token_issued_at')
+    if issued_at is None:
+        return False  # issued before expiry existed; backfilled at startup
+    return issued_at < (now or datetime.utcnow()) - timedelta(hours=TOKEN_TTL_HOURS)
+
+
+def backfill_token_issued_at(users) -> int:
+    """Start the TTL now for tokens issued before it existed, instead of logging everyone out"""
+    result = users.update_many(
+        {"token": {"$ne": None}, "token_issued_at": {"$exists": False}},
+        {"$set": {"token_issued_at": datetime.utcnow()}},
+    )
+    return result.modified_count
+
+
+def expire_tokens(users) -> Dict:
+    cutoff = datetime.utcnow() - timedelta(hours=TOKEN_TTL_HOURS)
+    result = users.update_many(
+        {"token_issued_at": {"$lt": cutoff}},
+        {"$unset": {"token": "", "token_issued_at": ""}},
+    )
+    return {"expired": result.modified_count}
+
+
+def compact_orphans(candidates, users, campaigns, events, materials, programs, program_versions,
+                    on_deleted, delete: bool = False) -> Dict:
+    """``on_deleted(collection_name, ids)`` is called for each batch of deleted campaigns or programs"""
+    live = list(set(candidates.distinct("id")) | set(users.distinct("id")))
+    orphan = {"candidate_id": {"$nin": live},
+              "created_at": {"$lt": datetime.utcnow() - timedelta(seconds=ORPHAN_GRACE_S)}}
+
+    campaign_ids = campaigns.distinct("id", orphan)
+    program_ids = programs.distinct("id", orphan)
+    if not delete:
+        return {"deleted": False, "campaigns": len(campaign_ids), "programs": len(program_ids)}
+
+    if campaign_ids:
+        events.delete_many({"campaign_id": {"$in": campaign_ids}})
+        materials.delete_many({"campaign_id": {"$in": campaign_ids}})
+        campaigns.delete_many({"id": {"$in": campaign_ids}})
+        on_deleted("campaigns", campaign_ids)
+
+    if program_ids:
+        program_versions.delete_many({"program_id": {"$in": program_ids}})
+        programs.delete_many({"id": {"$in": program_ids}})
+        on_deleted("programs", program_ids)
+
+    return {"deleted": True, "campaigns": len(campaign_ids), "programs": len(program_ids)}
+
+
+def _counts(collection) -> Dict[str, int]:
+    pipeline = [{"$group": {"_id": "$campaign_id", "count": {"$sum": 1}}}]
+    return {doc["_id"]: doc["count"] for doc in collection.aggregate(pipeline)}
+
+
+def reconcile_campaign_counters(campaigns, events, materials) -> Dict:
+    events_count = _counts(events)
+    materials_count = _counts(materials)
+    fixed = 0
+    for campaign in campaigns.find({}, {"_id": 0, "id": 1, "events_count": 1, "materials_count": 1}):
+        actual = {
+            "events_count": events_count.get(campaign["id"], 0),
+            "materials_count": materials_count.get(campaign["id"], 0),
+        }
+        if any(campaign.get(field) != value for field, value in actual.items()):
+            campaigns.update_one({"id": campaign["id"]}, {"$set": {**actual, "updated_at": datetime.utcnow()}})
+            fixed += 1
+    return {"fixed": fixed}
@@ -0,0 +1,290 @@
+"""Opt-in request profiling.
+
+Enabled with ``PROFILING=1``. A request is traced when it is sampled
+(``PROFILE_SAMPLE_RATE``, a fraction between 0 and 1) or when it turns out
+slower than ``PROFILE_SLOW_MS``. Each trace breaks the request time down into:
+
+- ``mongo_ms``: time spent in database commands (pymongo command monitoring)
+- ``handler_ms``: endpoint code, excluding database time
+- ``serialization_ms``: dependency resolution, validation, JSON encoding and rendering
+- ``compression_ms``: response compression (see compression.py)
+
+With ``PROFILE_STACKS=1`` sampled requests also collect stack samples every
+``PROFILE_STACK_INTERVAL_MS``, in the collapsed format understood by
+flamegraph.pl and speedscope. The slowest ``PROFILE_KEEP`` traces and the
+most recent ones are kept in memory for the admin endpoints.
+"""
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.01'))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '500'))
+PROFILE_STACKS = os.environ.get('PROFILE_STACKS', '0') == '1'
+PROFILE_STACK_INTERVAL_MS = float(os.environ.get('PROFILE_STACK_INTERVAL_MS', '5'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+
+current_profile: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar(
+    "current_profile", default=None
+)
+
+
+class Profile:
+    __slots__ = ('id', 'method', 'path', 'sampled', 'started_at', 'start', 'status',
+                 'timings', 'mongo_ops', 'stacks', 'thread_id')
+
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str, sampled: bool):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.started_at = datetime.utcnow()
+        self.start = time.perf_counter()
+        self.status = None
+        self.timings = Counter()
+        self.mongo_ops = 0
+        self.stacks = Counter() if sampled and PROFILE_STACKS else None
+        self.thread_id = threading.get_ident()
+
+    def add(self, key: str, seconds: float):
+        self.timings[key] += seconds
+
+    def summary(self, total: float) -> Dict:
+        ms = {k: round(v * 1000, 3) for k, v in self.timings.items()}
+        route_ms = ms.get('route', 0.0)
+        endpoint_ms = ms.get('endpoint', 0.0)
+        mongo_ms = ms.get('mongo', 0.0)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "sampled": self.sampled,
+            "total_ms": round(total * 1000, 3),
+            "mongo_ms": mongo_ms,
+            "mongo_ops": self.mongo_ops,
+            "handler_ms": round(max(0.0, endpoint_ms - mongo_ms), 3),
+            "serialization_ms": round(max(0.0, route_ms - endpoint_ms), 3),
+            "compression_ms": ms.get('compression', 0.0),
+            "has_stacks": bool(self.stacks),
+        }
+
+
+class ProfileStore:
+    """Slowest traces (min-heap) plus a ring buffer of the most recent ones"""
+
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self.keep = keep
+        self._slowest: List = []
+        self._recent = deque(maxlen=keep)
+        self._stacks: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+
+    def add(self, summary: Dict, stacks: Optional[Counter]):
+        with self._lock:
+            self._recent.append(summary)
+            entry = (summary['total_ms'], summary['id'], summary)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                evicted = heapq.heapreplace(self._slowest, entry)
+                self._stacks.pop(evicted[1], None)
+            if stacks:
+                self._stacks[summary['id']] = stacks
+            live = {e[1] for e in self._slowest} | {s['id'] for s in self._recent}
+            for trace_id in [t for t in self._stacks if t not in live]:
+                del self._stacks[trace_id]
+
+    def slowest(self) -> List[Dict]:
+        with self._lock:
+            return [e[2] for e in sorted(self._slowest, reverse=True)]
+
+    def recent(self) -> List[Dict]:
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def collapsed_stacks(self, trace_id: int) -> Optional[str]:
+        with self._lock:
+            stacks = self._stacks.get(trace_id)
+        if stacks is None:
+            return None
+        return '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+    def clear(self):
+        with self._lock:
+            self._slowest.clear()
+            self._recent.clear()
+            self._stacks.clear()
+
+
+store = ProfileStore()
+
+
+class MongoTimingListener(monitoring.CommandListener):
+    """Attribute database command time to the profile of the calling request"""
+
+    def __init__(self):
+        self._pending: Dict[int, Profile] = {}
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            self._pending[event.request_id] = profile
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        profile = self._pending.pop(event.request_id, None)
+        if profile is not None:
+            profile.add('mongo', event.duration_micros / 1e6)
+            profile.mongo_ops += 1
+
+
+class StackSampler:
+    """Background thread sampling the stacks of threads running profiled requests"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._active: Dict[int, Profile] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, profile: Profile):
+        with self._lock:
+            self._active[profile.id] = profile
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+
+    def stop(self, profile: Profile):
+        with self._lock:
+            self._active.pop(profile.id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active.values())
+            frames = sys._current_frames()
+            for profile in active:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+sampler = StackSampler(PROFILE_STACK_INTERVAL_MS / 1000)
+
+
+class ProfilingMiddleware:
+    """Outermost middleware: decides whether to trace and stores the result"""
+
+    def __init__(self, app, sample_rate: float = PROFILE_SAMPLE_RATE, slow_ms: float = PROFILE_SLOW_MS):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"], random.random() < self.sample_rate)
+        token = current_profile.set(profile)
+        if profile.stacks is not None:
+            sampler.start(profile)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            total = time.perf_counter() - profile.start
+            current_profile.reset(token)
+            if profile.stacks is not None:
+                sampler.stop(profile)
+            if profile.sampled or (self.slow_ms and total * 1000 >= self.slow_ms):
+                store.add(profile.summary(total), profile.stacks)
+
+
+class ProfiledRoute(APIRoute):
+    """Times the whole route (validation, endpoint, serialization) and the endpoint alone"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            profile = current_profile.get()
+            if profile is None:
+                return await handler(request)
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                profile.add('route', time.perf_counter() - start)
+
+        return profiled_handler
+
+
+def _timed_endpoint(endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profile.add('endpoint', time.perf_counter() - start)
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return endpoint(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                profile.add('endpoint', time.perf_counter() - start)
+    return timed
@@ -0,0 +1,91 @@
+"""Version chain helpers for electoral programs.
+
+Every revision of a program is stored in the ``program_versions`` collection,
+either as a full snapshot of the content or as a compact line diff against
+the previous revision. A full snapshot is written every
+``PROGRAM_SNAPSHOT_INTERVAL`` revisions so rebuilding any version only has to
+replay a bounded number of diffs.
+"""
+import difflib
+import os
+from typing import Dict, List, Optional
+
+PROGRAM_SNAPSHOT_INTERVAL = max(1, int(os.environ.get('PROGRAM_SNAPSHOT_INTERVAL', '10')))
+
+SNAPSHOT = "snapshot"
+DIFF = "diff"
+
+
+def _lines(text: str) -> List[str]:
+    return text.splitlines(keepends=True)
+
+
+def make_diff(old: str, new: str) -> List[list]:
+    """Return the edit operations turning ``old`` into ``new``.
+
+    Each operation is ``[start, end, lines]``: the old lines in
+    ``[start, end)`` are replaced by ``lines``. Unchanged runs are not stored.
+    """
+    old_lines = _lines(old)
+    new_lines = _lines(new)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        ops.append([i1, i2, new_lines[j1:j2]])
+    return ops
+
+
+def apply_diff(old: str, ops: List[list]) -> str:
+    old_lines = _lines(old)
+    result = []
+    cursor = 0
+    for start, end, lines in ops:
+        result.extend(old_lines[cursor:start])
+        result.extend(lines)
+        cursor = end
+    result.extend(old_lines[cursor:])
+    return ''.join(result)
+
+
+def diff_size(ops: List[list]) -> int:
+    return sum(len(line) for _, _, lines in ops for line in lines)
+
+
+def build_version_doc(program_id: str, version: int, content: str,
+                      previous_content: Optional[str], **metadata) -> Dict:
+    """Build the ``program_versions`` document for a new revision.
+
+    A snapshot is stored on the first version, every
+    ``PROGRAM_SNAPSHOT_INTERVAL`` versions, and whenever the diff would not
+    be smaller than the content itself.
+    """
+    doc = {"program_id": program_id, "version": version, "size": len(content), **metadata}
+    if previous_content is not None and (version - 1) % PROGRAM_SNAPSHOT_INTERVAL != 0:
+        ops = make_diff(previous_content, content)
+        if diff_size(ops) < len(content):
+            doc['kind'] = DIFF
+            doc['ops'] = ops
+            return doc
+    doc['kind'] = SNAPSHOT
+    doc['content'] = content
+    return doc
+
+
+def reconstruct(version_docs: List[Dict]) -> str:
+    """Rebuild content from version documents sorted by ascending version.
+
+    The list must start with a snapshot; following diffs are replayed in order.
+    """
+    content = None
+    for doc in version_docs:
+        if doc['kind'] == SNAPSHOT:
+            content = doc['content']
+        elif content is None:
+            raise ValueError(f"Catena versioni senza snapshot iniziale (versione {doc['version']})")
+        else:
+            content = apply_diff(content, doc['ops'])
+    if content is None:
+        raise ValueError("Nessuna versione disponibile")
+    return content
@@ -0,0 +1,226 @@
+"""Mongo command monitoring and slow-query log.
+
+A pymongo ``CommandListener`` records latency and documents returned per
+collection and operation. Commands slower than ``SLOW_QUERY_MS`` are logged
+and, with ``EXPLAIN_SLOW_QUERIES=1``, re-run through ``explain`` in a
+background thread so the log shows documents examined and the winning plan.
+A ``COLLSCAN`` there usually means an index is missing.
+
+Documents examined are only known for explained queries (one per query shape
+and ``EXPLAIN_COOLDOWN_S``), so they are reported in the slow-query entry
+next to the documents returned by the same explain, never summed into the
+per-operation counters, which count documents returned by every command.
+
+Only commands sent to MongoDB are observed; the in-memory storage engine does
+not emit command events.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import monitoring
+
+import database
+
+logger = logging.getLogger(__name__)
+
+QUERY_STATS = os.environ.get('QUERY_STATS', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAIN_SLOW_QUERIES = os.environ.get('EXPLAIN_SLOW_QUERIES', '1') == '1'
+# The same query shape is explained at most once per cooldown
+EXPLAIN_COOLDOWN_S = float(os.environ.get('EXPLAIN_COOLDOWN_S', '300'))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', '100'))
+
+EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+IGNORED = {'explain', 'ping', 'hello', 'isMaster', 'ismaster', 'saslStart', 'saslContinue',
+           'endSessions', 'buildInfo', 'getLastError'}
+# Fields added by the driver that must not be part of an explained command
+DRIVER_FIELDS = {'lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern'}
+
+
+def _collection_of(command_name: str, command: Dict) -> Optional[str]:
+    if command_name == 'getMore':
+        return command.get('collection')
+    value = command.get(command_name)
+    return value if isinstance(value, str) else None
+
+
+def _returned(command_name: str, reply: Dict) -> int:
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if command_name == 'findAndModify':
+        return 1 if reply.get('value') is not None else 0
+    if command_name == 'distinct':
+        return len(reply.get('values', []))
+    return int(reply.get('n', 0))
+
+
+def _shape(command_name: str, command: Dict) -> str:
+    """Query shape: the filter's field names, without values"""
+    spec = command.get('filter') or command.get('query') or {}
+    if command_name == 'aggregate':
+        spec = next((stage['$match'] for stage in command.get('pipeline', []) if '$match' in stage), {})
+    elif command_name in ('update', 'delete'):
+        statements = command.get('updates') or command.get('deletes') or [{}]
+        spec = statements[0].get('q', {})
+    return ','.join(sorted(spec)) if isinstance(spec, dict) else ''
+
+
+def _plan_stages(plan: Dict) -> List[str]:
+    stages = []
+    while isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0] \
+            or plan.get('queryPlan')
+    return stages
+
+
+def summarize_explain(explain: Dict) -> Dict:
+    planner = explain.get('queryPlanner')
+    stats = explain.get('executionStats', {})
+    if planner is None:
+        # Aggregations nest the plan of their $cursor stage
+        for stage in explain.get('stages', []):
+            cursor = stage.get('$cursor')
+            if cursor:
+                planner = cursor.get('queryPlanner')
+                stats = cursor.get('executionStats', stats)
+                break
+    winning = (planner or {}).get('winningPlan', {})
+    stages = _plan_stages(winning)
+    examined, returned = stats.get('totalDocsExamined'), stats.get('nReturned')
+    return {
+        "stages": stages,
+        "collection_scan": 'COLLSCAN' in stages,
+        "docs_examined": examined,
+        "keys_examined": stats.get('totalKeysExamined'),
+        "returned": returned,
+        "examined_per_returned": None if examined is None or returned is None
+        else round(examined / max(1, returned), 2),
+        "execution_ms": stats.get('executionTimeMillis'),
+    }
+
+
+class QueryStatsListener(monitoring.CommandListener):
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, explain: bool = EXPLAIN_SLOW_QUERIES):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self._lock = threading.Lock()
+        self._pending: Dict[int, tuple] = {}
+        self._stats = defaultdict(lambda: {
+            "count": 0, "failures": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "docs_returned": 0, "slow": 0,
+        })
+        self.slow_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._explained_at: Dict[str, float] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def started(self, event):
+        if event.command_name in IGNORED:
+            return
+        collection = _collection_of(event.command_name, event.command)
+        command = None
+        if event.command_name in EXPLAINABLE:
+            command = {k: v for k, v in event.command.items()
+                       if not k.startswith('$') and k not in DRIVER_FIELDS}
+        with self._lock:
+            self._pending[event.request_id] = (collection, event.database_name, command)
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, None)
+
+    def _finish(self, event, reply):
+        with self._lock:
+            pending = self._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        collection, database_name, command = pending
+        elapsed_ms = event.duration_micros / 1000
+        key = f"{collection or '-'}.{event.command_name}"
+        with self._lock:
+            stats = self._stats[key]
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            if reply is None:
+                stats["failures"] += 1
+            else:
+                stats["docs_returned"] += _returned(event.command_name, reply)
+            slow = elapsed_ms >= self.slow_ms
+            if slow:
+                stats["slow"] += 1
+
+        if slow:
+            entry = {
+                "at": datetime.utcnow(),
+                "collection": collection,
+                "operation": event.command_name,
+                "shape": _shape(event.command_name, command or {}),
+                "duration_ms": round(elapsed_ms, 3),
+            }
+            logger.warning(
+                f"Query lenta: {key} filtro [{entry['shape']}] {elapsed_ms:.1f} ms"
+            )
+            with self._lock:
+                self.slow_log.append(entry)
+            if self.explain and command is not None:
+                self._schedule_explain(key, database_name, command, entry)
+
+    def _schedule_explain(self, key: str, database_name: str, command: Dict, entry: Dict):
+        shape_key = f"{key}:{entry['shape']}"
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained_at.get(shape_key, -EXPLAIN_COOLDOWN_S) < EXPLAIN_COOLDOWN_S:
+                return
+            self._explained_at[shape_key] = now
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        self._executor.submit(self._explain, key, database_name, command, entry)
+
+    def _explain(self, key: str, database_name: str, command: Dict, entry: Dict):
+        try:
+            explain = database.get_client()[database_name].command(
+                {"explain": command, "verbosity": "executionStats"}
+            )
+        except Exception as e:
+            logger.info(f"Explain non riuscito per {key}: {e}")
+            return
+        plan = summarize_explain(explain)
+        with self._lock:
+            entry["plan"] = plan
+        hint = " - indice mancante?" if plan["collection_scan"] else ""
+        logger.warning(
+            f"Piano query lenta {key} [{entry['shape']}]: {' <- '.join(plan['stages'])}, "
+            f"esaminati {plan['docs_examined']} documenti per {plan['returned']} restituiti{hint}"
+        )
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            operations = {}
+            for key, stats in self._stats.items():
+                operations[key] = dict(stats, avg_ms=round(stats["total_ms"] / stats["count"], 3)
+                                       if stats["count"] else 0.0)
+            return {
+                "slow_query_ms": self.slow_ms,
+                "operations": operations,
+                "slow_queries": list(reversed(self.slow_log)),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_log.clear()
+            self._explained_at.clear()
+
+
+query_stats = QueryStatsListener()
@@ -0,0 +1,312 @@
+"""Per-client rate limiting and global admission control.
+
+Each client gets a token bucket per route budget. A client is its bearer
+token once the token has been verified, its IP address otherwise; the login
+and registration budgets (``IP_KEYED_ROUTES``) are always per IP address, so
+a made-up token never buys a fresh bucket. A token not verified yet is
+charged to the IP address bucket, and only requests within that budget pay
+for the lookup; rejected tokens are remembered for ``VERIFIED_TOKEN_TTL_S``
+like accepted ones, so repeating one costs no lookup at all. Behind a proxy
+the IP address is the one uvicorn takes from ``X-Forwarded-For``, trusted
+only from ``--forwarded-allow-ips`` (see cli.py).
+
+Budgets are ``capacity/seconds`` pairs: a client may burst up to
+``capacity`` requests, refilled evenly over ``seconds``. They are
+configured with ``RATE_LIMITS``, e.g.::
+
+    RATE_LIMITS="POST /api/auth/login=10/60,POST /api/auth/register=5/60,default=120/10"
+
+An empty ``RATE_LIMITS`` disables per-client limits.
+
+On top of that, at most ``MAX_IN_FLIGHT`` requests per worker are handled at
+once. A request waiting longer than ``ADMISSION_TIMEOUT_MS`` for a slot is
+shed with 503 instead of letting latency grow without bound.
+
+Buckets live in process memory by default. ``RATE_LIMIT_BACKEND=shared``
+keeps them in the ``rate_limits`` collection so all workers share budgets.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMITS = (
+    "POST /api/auth/login=10/60,"
+    "POST /api/auth/register=5/60,"
+    "POST /api/generate-program=3/60,"
+    "default=120/10"
+)
+RATE_LIMITS = os.environ.get('RATE_LIMITS', DEFAULT_RATE_LIMITS)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', '256'))
+ADMISSION_TIMEOUT_MS = int(os.environ.get('ADMISSION_TIMEOUT_MS', '200'))
+
+# Never limited: probes must keep working while the worker sheds load
+EXEMPT_PATHS = ('/api/health/',)
+# Budgets kept per IP address whatever the Authorization header says
+IP_KEYED_ROUTES = ('POST /api/auth/login', 'POST /api/auth/register')
+# How long a verified (or rejected) token is trusted without a new lookup
+VERIFIED_TOKEN_TTL_S = 30
+
+
+def parse_budgets(spec: str) -> Dict[str, Tuple[float, float]]:
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        route, _, budget = item.rpartition('=')
+        capacity, _, seconds = budget.partition('/')
+        budgets[route.strip()] = (float(capacity), float(capacity) / float(seconds or 1))
+    return budgets
+
+
+class MemoryBucketBackend:
+    """Token buckets held in this worker's memory, evicting the least recently used"""
+
+    def __init__(self, max_keys: int = 100000):
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Consume a token; return 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedBucketBackend:
+    """Token buckets stored in a collection so every worker enforces the same budget"""
+
+    def __init__(self, collection, retries: int = 5):
+        self._collection = collection
+        self._retries = retries
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        for _ in range(self._retries):
+            now = time.time()
+            bucket = self._collection.find_one({"_id": key})
+            if bucket is None:
+                try:
+                    self._collection.insert_one({
+                        "_id": key, "tokens": capacity - 1, "updated": now,
+                        "expires_at": _expiry(capacity, rate),
+                    })
+                    return 0.0
+                except DuplicateKeyError:
+                    continue
+            tokens = min(capacity, bucket["tokens"] + (now - bucket["updated"]) * rate)
+            allowed = tokens >= 1
+            # Compare-and-set on the previous timestamp so concurrent workers never double-spend
+            result = self._collection.update_one(
+                {"_id": key, "updated": bucket["updated"]},
+                {"$set": {"tokens": tokens - 1 if allowed else tokens, "updated": now,
+                          "expires_at": _expiry(capacity, rate)}}
+            )
+            if result.matched_count:
+                return 0.0 if allowed else (1 - tokens) / rate
+        # Heavy contention on a single key: treat it as exhausted
+        return 1.0 / rate
+
+
+def _expiry(capacity: float, rate: float) -> datetime:
+    # Once a bucket has refilled completely its document carries no information
+    return datetime.utcnow() + timedelta(seconds=capacity / rate + 60)
+
+
+class RateLimiter:
+    def __init__(self, budgets: Dict[str, Tuple[float, float]], backend,
+                 max_in_flight: int = MAX_IN_FLIGHT, admission_timeout_ms: int = ADMISSION_TIMEOUT_MS,
+                 verify_token: Optional[Callable[[str], bool]] = None, max_verified: int = 10000):
+        self.budgets = budgets
+        self.backend = backend
+        self.verify_token = verify_token
+        # token -> (accepted, until monotonic time)
+        self._verified: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._max_verified = max_verified
+        self.max_in_flight = max_in_flight
+        self.admission_timeout = admission_timeout_ms / 1000
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    def budget_for(self, method: str, path: str) -> Tuple[str, Tuple[float, float]]:
+        route = f"{method} {path}"
+        if route in self.budgets:
+            return route, self.budgets[route]
+        return "default", self.budgets.get("default", (float('inf'), float('inf')))
+
+    def _known(self, token: str) -> Optional[bool]:
+        """Cached verification result, None when the token must be looked up"""
+        accepted, until = self._verified.get(token, (False, 0.0))
+        return accepted if until > time.monotonic() else None
+
+    async def _verify(self, token: str):
+        accepted = bool(await run_in_threadpool(self.verify_token, token))
+        self._verified[token] = (accepted, time.monotonic() + VERIFIED_TOKEN_TTL_S)
+        self._verified.move_to_end(token)
+        while len(self._verified) > self._max_verified:
+            self._verified.popitem(last=False)
+
+    def _token(self, scope) -> Optional[str]:
+        if self.verify_token is None or f"{scope['method']} {scope['path']}" in IP_KEYED_ROUTES:
+            return None
+        return bearer_token(scope)
+
+    def client_key(self, scope) -> str:
+        """Bucket owner: the bearer token once verified, else the IP address"""
+        token = self._token(scope)
+        if token and self._known(token):
+            return "token:" + token
+        return ip_key(scope)
+
+    async def charge(self, scope) -> float:
+        """Take a token from the client's bucket; returns the seconds to wait, 0 when allowed"""
+        key = self.client_key(scope)
+        wait = await self.check(scope["method"], scope["path"], key)
+        _, (capacity, _) = self.budget_for(scope["method"], scope["path"])
+        if not wait and key.startswith("ip:") and not math.isinf(capacity):
+            token = self._token(scope)
+            # Verified only once the IP budget allowed the request, so made-up tokens cannot force lookups
+            if token and self._known(token) is None:
+                await self._verify(token)
+        return wait
+
+    async def check(self, method: str, path: str, client_key: str) -> float:
+        route, (capacity, rate) = self.budget_for(method, path)
+        if math.isinf(capacity):
+            return 0.0
+        key = f"{route}|{client_key}"
+        if isinstance(self.backend, MemoryBucketBackend):
+            wait = self.backend.take(key, capacity, rate)
+        else:
+            wait = await run_in_threadpool(self.backend.take, key, capacity, rate)
+        self.counters[route]["limited" if wait else "allowed"] += 1
+        return wait
+
+    async def admit(self) -> bool:
+        if self.max_in_flight <= 0:
+            return True
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.admission_timeout)
+        except asyncio.TimeoutError:
+            self.counters["admission"]["shed"] += 1
+            return False
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self):
+        if self.max_in_flight > 0:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def reset(self):
+        """Forget buckets and counters (tests, or after changing budgets)"""
+        if isinstance(self.backend, MemoryBucketBackend):
+            self.backend.clear()
+        self._verified.clear()
+        self.counters.clear()
+        self.peak_in_flight = self.in_flight
+        if self.in_flight == 0:
+            self._semaphore = None
+
+    def stats(self) -> Dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "budgets": {route: {"capacity": c, "per_second": r} for route, (c, r) in self.budgets.items()},
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "max_in_flight": self.max_in_flight,
+            "counters": {route: dict(c) for route, c in self.counters.items()},
+        }
+
+
+def bearer_token(scope) -> Optional[str]:
+    for name, value in scope.get("headers", []):
+        if name == b"authorization" and value.startswith(b"Bearer "):
+            return value[7:].decode("latin-1")
+    return None
+
+
+def ip_key(scope) -> str:
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+def client_key(scope) -> str:
+    """Unverified client identity (writer of buffered writes, idempotency scope); not for rate limits"""
+    token = bearer_token(scope)
+    return "token:" + token if token else ip_key(scope)
+
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PATHS) or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        wait = await self.limiter.charge(scope)
+        if wait:
+            await _reject(send, 429, "Troppe richieste, riprova più tardi", wait)
+            return
+
+        if not await self.limiter.admit():
+            await _reject(send, 503, "Server sovraccarico, riprova tra poco", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+
+def create_limiter(collection=None, verify_token: Optional[Callable[[str], bool]] = None) -> RateLimiter:
+    if RATE_LIMIT_BACKEND == 'shared':
+        backend = SharedBucketBackend(collection)
+    else:
+        backend = MemoryBucketBackend()
+    return RateLimiter(parse_budgets(RATE_LIMITS), backend, verify_token=verify_token)
@@ -0,0 +1,130 @@
+"""Compact record types for the hot list endpoints.
+
+Listing candidates, campaigns or programs used to materialize one pymongo
+dict per document, copy it again through ``jsonable_encoder`` and only then
+serialize. For long lists those intermediate dicts dominate memory.
+
+Here documents are fetched as ``RawBSONDocument`` (the cursor batch stays as
+undecoded bytes), restricted by projection to the fields the API returns,
+and each one is turned into a slotted record holding just those values. The
+list response is serialized straight from the records into JSON bytes.
+
+The in-memory storage engine ignores codec options and yields plain dicts,
+which records accept as well.
+"""
+import json
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+_MISSING = object()
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, RawBSONDocument):
+        # Embedded documents of a raw document stay raw until serialized
+        return dict(value)
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default)
+
+
+class Record:
+    """Base for slotted records; subclasses list their fields in ``FIELDS``"""
+
+    __slots__ = ()
+    FIELDS: tuple = ()
+    DEFAULTS: Dict = {}
+
+    @classmethod
+    def projection(cls) -> Dict:
+        projection = {field: 1 for field in cls.FIELDS}
+        projection.setdefault("_id", 0)
+        return projection
+
+    @classmethod
+    def from_document(cls, document) -> "Record":
+        record = cls.__new__(cls)
+        for field in cls.FIELDS:
+            value = document.get(field, _MISSING)
+            if value is _MISSING:
+                value = cls.DEFAULTS.get(field, _MISSING)
+            setattr(record, field, value)
+        return record
+
+    def get(self, field: str, default=None):
+        value = getattr(self, field, _MISSING)
+        return default if value is _MISSING else value
+
+    def to_dict(self) -> Dict:
+        # Fields missing from the document are omitted, as they were with plain dicts
+        return {field: value for field in self.FIELDS
+                if (value := getattr(self, field)) is not _MISSING}
+
+    def to_json(self) -> str:
+        return _encoder.encode(self.to_dict())
+
+
+class CandidateRecord(Record):
+    FIELDS = ('_id', 'id', 'user_id', 'name', 'class_year', 'description', 'photo', 'manifesto',
+              'created_at', 'updated_at')
+    __slots__ = FIELDS
+
+
+class CampaignRecord(Record):
+    FIELDS = ('id', 'candidate_id', 'title', 'description', 'status', 'created_at', 'updated_at',
+              'events_count', 'materials_count', 'next_event')
+    DEFAULTS = {'events_count': 0, 'materials_count': 0, 'next_event': None}
+    __slots__ = FIELDS
+
+    @classmethod
+    def projection(cls) -> Dict:
+        # next_event is computed per request, not stored
+        projection = super().projection()
+        projection.pop('next_event')
+        return projection
+
+
+class ProgramRecord(Record):
+    FIELDS = ('_id', 'id', 'candidate_id', 'title', 'content', 'generated_by_ai', 'created_at',
+              'updated_at', 'version')
+    DEFAULTS = {'version': 1}
+    __slots__ = FIELDS
+
+
+def raw_find(collection, query: Dict, record_type, sort=None):
+    """Cursor over ``record_type``'s projection with documents left as raw BSON"""
+    cursor = collection.with_options(codec_options=RAW_BSON).find(query, record_type.projection())
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor
+
+
+def records(cursor, record_type) -> Iterator[Record]:
+    for document in cursor:
+        yield record_type.from_document(document)
+
+
+def list_body(key: str, items: Iterable[Record], extra: Optional[Dict] = None) -> bytes:
+    """``{"success": true, <key>: [...], **extra}`` serialized record by record"""
+    body = bytearray(b'{"success":true,')
+    body += _encoder.encode(key).encode('utf-8') + b':['
+    for n, item in enumerate(items):
+        if n:
+            body += b','
+        body += item.to_json().encode('utf-8')
+    body += b']'
+    for name, value in (extra or {}).items():
+        body += (',' + _encoder.encode(name) + ':' + _encoder.encode(value)).encode('utf-8')
+    body += b'}'
+    return bytes(body)
@@ -0,0 +1,171 @@
+"""In-process scheduler for periodic maintenance jobs.
+
+Every worker runs the same scheduler, started from the app lifespan. Before
+each run a worker takes the job's lease in ``scheduler_locks`` (a document
+per job, ``{owner, expires_at}``): the lease is granted when it is free,
+expired or already held by the same worker, so exactly one worker runs
+each job per interval and keeps the job until it stops renewing it. Runs
+are spread by a random ``SCHEDULER_JITTER`` fraction of the interval so
+workers started together do not contend at the same instant.
+
+Intervals are configured with ``SCHEDULER_JOBS``, in seconds per job::
+
+    SCHEDULER_JOBS="expire_tokens=3600,compact_orphans=21600,refresh_aggregates=900"
+
+Jobs run once per tenant (see tenancy.py) in a worker thread.
+``SCHEDULER_ENABLED=0`` turns the scheduler off in a worker, e.g. for
+one-off CLI processes.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import tenancy
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') not in ('0', 'false', 'no')
+SCHEDULER_JOBS = os.environ.get('SCHEDULER_JOBS', '')
+SCHEDULER_JITTER = float(os.environ.get('SCHEDULER_JITTER', '0.1'))
+
+
+def parse_intervals(spec: str) -> Dict[str, float]:
+    intervals = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, seconds = item.partition('=')
+        intervals[name.strip()] = float(seconds)
+    return intervals
+
+
+class Job:
+    __slots__ = ('name', 'interval', 'func', 'runs', 'failures', 'skipped', 'total_ms', 'max_ms',
+                 'last_ms', 'last_run_at', 'last_result', 'last_error')
+
+    def __init__(self, name: str, interval: float, func: Callable[[], Optional[Dict]]):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms: Optional[float] = None
+        self.last_run_at: Optional[datetime] = None
+        self.last_result: Optional[Dict] = None
+        self.last_error: Optional[str] = None
+
+    def record(self, elapsed_ms: float, result: Optional[Dict], error: Optional[str]):
+        self.runs += 1
+        self.failures += error is not None
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.last_ms = elapsed_ms
+        self.last_run_at = datetime.utcnow()
+        self.last_result = result
+        self.last_error = error
+
+    def to_dict(self) -> Dict:
+        return {
+            "interval_s": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped_not_leader": self.skipped,
+            "avg_ms": round(self.total_ms / self.runs, 2) if self.runs else None,
+            "max_ms": round(self.max_ms, 2),
+            "last_ms": None if self.last_ms is None else round(self.last_ms, 2),
+            "last_run_at": self.last_run_at,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
+
+
+class Scheduler:
+    def __init__(self, locks, jitter: float = SCHEDULER_JITTER,
+                 tenants: Callable[[], Iterable[str]] = lambda: (tenancy.DEFAULT_TENANT, *tenancy.TENANTS)):
+        self.locks = locks
+        self.jitter = jitter
+        self.tenants = tenants
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.jobs: Dict[str, Job] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, interval: float, func: Callable[[], Optional[Dict]]):
+        self.jobs[name] = Job(name, interval, func)
+
+    def acquire(self, job: Job) -> bool:
+        """Take or renew the job's lease for one interval; False while another worker holds it"""
+        now = datetime.utcnow()
+        with tenancy.use(tenancy.DEFAULT_TENANT):
+            try:
+                self.locks.find_one_and_update(
+                    {"_id": job.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": self.owner, "acquired_at": now,
+                              "expires_at": now + timedelta(seconds=job.interval)}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                return True
+            except DuplicateKeyError:
+                return False
+
+    def run(self, name: str, force: bool = False) -> Optional[Dict]:
+        """Run a job now for every tenant (blocking); None when another worker is the leader"""
+        job = self.jobs[name]
+        if not force and not self.acquire(job):
+            job.skipped += 1
+            return None
+        start = time.perf_counter()
+        results, error = {}, None
+        for tenant in self.tenants():
+            with tenancy.use(tenant):
+                try:
+                    results[tenant] = job.func()
+                except Exception as e:
+                    error = f"{tenant}: {e}"
+                    logger.error(f"Job {name} fallito per il tenant {tenant}: {e}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            job.record(elapsed_ms, results, error)
+        logger.info(f"Job {name} completato in {elapsed_ms:.0f} ms")
+        return results
+
+    async def _loop(self, job: Job):
+        while True:
+            await asyncio.sleep(job.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+            try:
+                await run_in_threadpool(self.run, job.name)
+            except Exception as e:
+                logger.error(f"Scheduler: errore nel job {job.name}: {e}")
+
+    def start(self):
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._loop(job)) for job in self.jobs.values() if job.interval > 0]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "running": bool(self._tasks),
+                "owner": self.owner,
+                "jobs": {name: job.to_dict() for name, job in self.jobs.items()},
+            }
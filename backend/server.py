@@ -1,22 +1,95 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from pymongo import MongoClient
+from fastapi.responses import PlainTextResponse, Response
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from pymongo.errors import DuplicateKeyError
 import os
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
 from typing import Dict, List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+from fastapi.concurrency import run_in_threadpool
 import asyncio
-#from emergent.llm.chat import LlmChat, UserMessage
+import functools
+from program_versions import build_version_doc, reconstruct, SNAPSHOT
+from database import DB_NAME
+from storage import LazyCollection, get_storage
+from ratelimit import RATE_LIMIT_BACKEND, RateLimitMiddleware, create_limiter
+import database
+import profiling
+from query_stats import QUERY_STATS, query_stats
+from ratelimit import client_key
+from write_buffer import WriteBuffer
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+import sync
+import analytics
+import activity
+import similarity
+import archive
+import maintenance
+import scheduler
+import frontend
+import tenancy
+import compression
+from compression import CompressionMiddleware, ResponseCache, json_body
+from voting import ELECTION_CLOSED, ELECTION_OPEN, VOTER_ROLES, AlreadyVoted, ElectionClosed, VotingService
+from records import CampaignRecord, CandidateRecord, ProgramRecord, list_body, raw_find, records
 
 # Enhanced logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Sistema Gestione Lista Elettorale")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    await run_in_threadpool(connect_database)
+    await run_in_threadpool(ensure_indexes)
+    served = await run_in_threadpool(frontend_files.load)
+    if served:
+        logger.info(f"Frontend servito da {frontend_files.root}: {served} file")
+    tenant_registry.mark_ready(tenancy.DEFAULT_TENANT)
+    if scheduler.SCHEDULER_ENABLED:
+        maintenance_scheduler.start()
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    await maintenance_scheduler.stop()
+    await write_buffer.close()
+    await run_in_threadpool(get_storage().close)
+
+app = FastAPI(title="Sistema Gestione Lista Elettorale", lifespan=lifespan)
+if QUERY_STATS:
+    database.add_event_listener(query_stats)
+if profiling.PROFILING:
+    # Must be set before any route is declared
+    app.router.route_class = profiling.ProfiledRoute
+    database.add_event_listener(profiling.MongoTimingListener())
+
+# Idempotency-Key support on create endpoints (see idempotency.py). Innermost,
+# so rate limiting and admission control still apply to retries.
+idempotency_store = IdempotencyStore(LazyCollection("idempotency_keys"))
+app.add_middleware(
+    IdempotencyMiddleware,
+    store=idempotency_store,
+    routes=[("POST", "/api/candidates"), ("POST", "/api/campaigns"), ("POST", "/api/programs")],
+)
+
+# Per-school cap on concurrent requests (see tenancy.py), inside the
+# worker-wide admission below so only admitted requests hold a school slot.
+tenant_registry = tenancy.TenantRegistry(setup=lambda: ensure_indexes())
+app.add_middleware(tenancy.TenantAdmissionMiddleware, registry=tenant_registry)
+
+# Per-client token buckets and in-flight admission control (see ratelimit.py).
+# Added before CORS so 429/503 responses still get CORS headers.
+rate_limiter = create_limiter(LazyCollection("rate_limits"), verify_token=lambda token: verify_token(token) is not None)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
+# School (tenant) of each request, selecting its database (see tenancy.py).
+# Outside rate limiting and idempotency, whose state lives in the tenant's database.
+app.add_middleware(tenancy.TenantMiddleware, registry=tenant_registry)
+tenant_quotas = tenancy.Quotas()
 
 # Enhanced CORS settings
 app.add_middleware(
@@ -26,23 +99,80 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Brotli/gzip negotiation with per-route levels (COMPRESSION_LEVELS, see compression.py)
+app.add_middleware(CompressionMiddleware)
+if profiling.PROFILING:
+    # Outermost, so traces include every other middleware
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+# Serialized and pre-compressed bodies of cacheable list endpoints
+response_cache = ResponseCache()
+
+# React build served by the same workers when present (FRONTEND_BUILD_DIR, see frontend.py)
+frontend_files = frontend.StaticFrontend()
 
-# MongoDB setup
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-DB_NAME = os.environ.get('DB_NAME', 'lista_elettorale')
+# Storage setup: STORAGE_BACKEND selects Mongo (configured in database.py) or the
+# in-memory engine. The Mongo client is created lazily in each worker, after fork.
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+# Optional batching of campaign writes (WRITE_DURABILITY, see write_buffer.py)
+write_buffer = WriteBuffer()
+
+# Most read operations accepted by one POST /api/batch
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', '20'))
 
 # Gemini AI setup
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 
 # Collections
-users_collection = db.users
-candidates_collection = db.candidates
-campaigns_collection = db.campaigns
-programs_collection = db.programs
+users_collection = LazyCollection("users")
+candidates_collection = LazyCollection("candidates")
+campaigns_collection = LazyCollection("campaigns")
+programs_collection = LazyCollection("programs")
+program_versions_collection = LazyCollection("program_versions")
+events_collection = LazyCollection("campaign_events")
+materials_collection = LazyCollection("campaign_materials")
+tombstones_collection = LazyCollection("tombstones")
+elections_collection = LazyCollection("elections")
+activity_collection = LazyCollection("activity_buckets")
+
+# List reads may be served by secondaries according to MONGO_READ_PREFERENCE
+candidates_read_collection = LazyCollection("candidates", read=True)
+campaigns_read_collection = LazyCollection("campaigns", read=True)
+programs_read_collection = LazyCollection("programs", read=True)
+events_read_collection = LazyCollection("campaign_events", read=True)
+materials_read_collection = LazyCollection("campaign_materials", read=True)
+activity_read_collection = LazyCollection("activity_buckets", read=True)
+
+# MinHash signatures of programs for near-duplicate detection (see similarity.py)
+program_similarity = similarity.ProgramSimilarity(LazyCollection("program_signatures"), LazyCollection("program_bands"))
+
+# Elections and votes (see voting.py)
+voting_service = VotingService(elections_collection, LazyCollection("votes"), LazyCollection("vote_counters"))
+
+# Documents of archived elections (ARCHIVE_BACKEND, see archive.py)
+archive_store = archive.create_store(LazyCollection)
+
+# Periodic maintenance, one leader worker per job (SCHEDULER_JOBS, see scheduler.py)
+def _on_orphans_deleted(collection_name: str, ids: List[str]):
+    sync.record_deletions(tombstones_collection, collection_name, ids)
+    if collection_name == "programs":
+        program_similarity.remove(ids)
+
+MAINTENANCE_JOBS = {
+    "expire_tokens": (3600, lambda: maintenance.expire_tokens(users_collection)),
+    "compact_orphans": (6 * 3600, lambda: maintenance.compact_orphans(
+        candidates_collection, users_collection, campaigns_collection, events_collection, materials_collection,
+        programs_collection, program_versions_collection, _on_orphans_deleted,
+        delete=maintenance.ORPHAN_COMPACTION == 'delete',
+    )),
+    "refresh_aggregates": (900, lambda: maintenance.reconcile_campaign_counters(
+        campaigns_collection, events_collection, materials_collection,
+    )),
+}
+maintenance_scheduler = scheduler.Scheduler(LazyCollection("scheduler_locks"))
+_job_intervals = scheduler.parse_intervals(scheduler.SCHEDULER_JOBS)
+for _name, (_interval, _func) in MAINTENANCE_JOBS.items():
+    maintenance_scheduler.add(_name, _job_intervals.get(_name, _interval), _func)
 
 # Models
 class User(BaseModel):
@@ -73,10 +203,28 @@ class Campaign(BaseModel):
     title: str
     description: str
     status: str  # draft, active, completed
+    # Accepted on creation only: items are stored in their own collections
     events: Optional[List[Dict]] = []
     materials: Optional[List[Dict]] = []
     created_at: Optional[datetime] = None
 
+class CampaignEvent(BaseModel):
+    id: Optional[str] = None
+    name: str
+    date: datetime
+    location: Optional[str] = None
+    description: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+class CampaignMaterial(BaseModel):
+    id: Optional[str] = None
+    type: str
+    title: str
+    description: Optional[str] = None
+    content: Optional[str] = None
+    date: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+
 class ProgramGenerationRequest(BaseModel):
     candidate_name: str
     class_year: str
@@ -91,17 +239,206 @@ class ElectoralProgram(BaseModel):
     content: str
     generated_by_ai: bool = False
     created_at: Optional[datetime] = None
+    version: Optional[int] = None  # base version being edited, for conflict detection
+
+class Election(BaseModel):
+    title: str
+    # Defaults to every candidate registered when the election is created
+    candidate_ids: Optional[List[str]] = None
+
+class VoteRequest(BaseModel):
+    candidate_id: str
+
+class BatchOperation(BaseModel):
+    id: Optional[str] = None  # key of the result, defaults to the position in the list
+    op: str = Field(pattern="^(stats|candidates|campaigns|programs)$")
+    candidate_id: Optional[str] = None
+    skip: int = Field(0, ge=0)
+    limit: Optional[int] = Field(None, ge=1, le=500)
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
 
 # Auth helpers
 def verify_token(token: str):
     # Simple token verification - in production use JWT
     user = users_collection.find_one({"token": token})
+    if user and maintenance.token_expired(user):
+        return None
+    return user
+
+def require_user(request: Request):
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else None
+    user = verify_token(token) if token else None
+    if not user:
+        raise HTTPException(status_code=401, detail="Token non valido")
+    return user
+
+def require_admin(request: Request):
+    user = require_user(request)
+    if user.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Accesso riservato agli amministratori")
     return user
 
+def check_quota(collection):
+    try:
+        tenant_quotas.check(collection)
+    except tenancy.QuotaExceeded as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+def connect_database():
+    # Fail fast with a clear error instead of hanging on the first request
+    storage = get_storage()
+    storage.ping()
+    logger.info(f"Storage {storage.name} pronto, database {DB_NAME}")
+
+def ensure_indexes():
+    try:
+        users_collection.create_index("token")
+        users_collection.create_index("token_issued_at")
+        candidates_collection.create_index("id", unique=True)
+        programs_collection.create_index("id", unique=True)
+        programs_collection.create_index("candidate_id")
+        program_versions_collection.create_index(
+            [("program_id", ASCENDING), ("version", ASCENDING)], unique=True
+        )
+        events_collection.create_index("id", unique=True)
+        events_collection.create_index([("campaign_id", ASCENDING), ("date", ASCENDING)])
+        events_collection.create_index([("date", ASCENDING), ("candidate_id", ASCENDING)])
+        materials_collection.create_index("id", unique=True)
+        materials_collection.create_index([("campaign_id", ASCENDING), ("date", DESCENDING)])
+        campaigns_collection.create_index("id", unique=True)
+        campaigns_collection.create_index("candidate_id")
+        sync.ensure_sync_indexes(
+            {"candidates": candidates_collection, "campaigns": campaigns_collection,
+             "programs": programs_collection},
+            tombstones_collection,
+        )
+        voting_service.ensure_indexes()
+        activity.ensure_indexes(activity_collection)
+        program_similarity.ensure_indexes()
+        if archive_store.name == 'collection':
+            archive_store.ensure_indexes()
+        LazyCollection("idempotency_keys").create_index("expires_at", expireAfterSeconds=0)
+        if RATE_LIMIT_BACKEND == 'shared':
+            LazyCollection("rate_limits").create_index("expires_at", expireAfterSeconds=0)
+    except Exception as e:
+        logger.error(f"Errore creazione indici: {e}")
+
+    try:
+        migrate_embedded_campaign_items()
+    except Exception as e:
+        logger.error(f"Errore migrazione eventi/materiali: {e}")
+
+    try:
+        updated = maintenance.backfill_token_issued_at(users_collection)
+        if updated:
+            logger.info(f"Scadenza avviata per {updated} token esistenti")
+    except Exception as e:
+        logger.error(f"Errore inizializzazione scadenza token: {e}")
+
+    try:
+        for collection in (candidates_collection, campaigns_collection, programs_collection):
+            updated = sync.backfill_updated_at(collection)
+            if updated:
+                logger.info(f"{collection.name}: aggiunto updated_at a {updated} documenti")
+    except Exception as e:
+        logger.error(f"Errore inizializzazione updated_at: {e}")
+
+    try:
+        if activity_collection.find_one({}, {"_id": 1}) is None:
+            buckets = activity.rebuild(activity_collection, {
+                "registrations": (users_collection, None),
+                "candidates": (candidates_collection, None),
+                "campaigns": (campaigns_collection, "status"),
+                "programs": (programs_collection, None),
+            })
+            if buckets:
+                logger.info(f"Serie attività ricostruite: {buckets} intervalli")
+    except Exception as e:
+        logger.error(f"Errore ricostruzione serie attività: {e}")
+
+    try:
+        if program_similarity.signatures.find_one({}, {"_id": 1}) is None:
+            indexed = program_similarity.rebuild(programs_collection)
+            if indexed:
+                logger.info(f"Firme di similarità calcolate per {indexed} programmi")
+    except Exception as e:
+        logger.error(f"Errore indicizzazione similarità programmi: {e}")
+
+async def record_activity(metric: str, at: datetime, status: Optional[str] = None):
+    """Count a write in the hourly/daily activity buckets; never fails the request"""
+    try:
+        await asyncio.gather(*(
+            write_buffer.update(activity_collection, filter, update, upsert=True)
+            for filter, update in activity.bucket_updates(metric, at, status)
+        ))
+    except Exception as e:
+        logger.error(f"Errore aggiornamento attività {metric}: {e}")
+
+def migrate_embedded_campaign_items() -> int:
+    """Move events/materials still embedded in old campaign documents to their collections.
+
+    Every worker runs it at startup (and ``python cli.py migrate-campaign-items``
+    as a deploy step), so it must be safe to run concurrently and to re-run after
+    a crash: items get ids derived from their campaign and position, are upserted,
+    and the counters are recounted rather than incremented.
+    """
+    legacy = campaigns_collection.find(
+        {"$or": [{"events": {"$exists": True}}, {"materials": {"$exists": True}}]}
+    )
+    migrated = 0
+    for campaign in legacy:
+        moved = {}
+        for field, collection in (("events", events_collection), ("materials", materials_collection)):
+            items = [
+                _campaign_item(campaign, {**item, "id": item.get("id") or str(
+                    uuid.uuid5(uuid.NAMESPACE_URL, f"campaign/{campaign['id']}/{field}/{index}")
+                )})
+                for index, item in enumerate(campaign.get(field) or [])
+            ]
+            if items:
+                collection.bulk_write(
+                    [UpdateOne({"id": item["id"]}, {"$setOnInsert": item}, upsert=True) for item in items]
+                )
+            moved[field] = len(items)
+        campaigns_collection.update_one(
+            {"_id": campaign["_id"]},
+            {
+                "$unset": {"events": "", "materials": ""},
+                "$set": {
+                    "events_count": events_collection.count_documents({"campaign_id": campaign["id"]}),
+                    "materials_count": materials_collection.count_documents({"campaign_id": campaign["id"]}),
+                },
+            }
+        )
+        migrated += 1
+        logger.info(f"Campagna {campaign.get('id')}: migrati {moved['events']} eventi e {moved['materials']} materiali")
+    return migrated
+
 @app.get("/")
-async def root():
+async def root(request: Request):
+    if frontend_files.available:
+        return frontend_files.response(request, frontend.INDEX)
     return {"message": "Sistema Gestione Lista Elettorale API", "status": "running"}
 
+# Health checks
+@app.get("/api/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+def readiness(request: Request):
+    if not getattr(request.app.state, 'ready', False):
+        raise HTTPException(status_code=503, detail="Avvio in corso")
+    try:
+        get_storage().ping()
+    except RuntimeError as e:
+        logger.error(f"Readiness fallita: {e}")
+        raise HTTPException(status_code=503, detail="Database non raggiungibile")
+    return {"status": "ready"}
+
 # Auth endpoints
 @app.post("/api/auth/register")
 async def register(user: User):
@@ -110,8 +447,10 @@ async def register(user: User):
         user_dict['id'] = str(uuid.uuid4())
         user_dict['created_at'] = datetime.utcnow()
         user_dict['token'] = str(uuid.uuid4())
+        user_dict['token_issued_at'] = user_dict['created_at']
         
         users_collection.insert_one(user_dict)
+        await record_activity("registrations", user_dict['created_at'])
         
         return {
             "success": True,
@@ -138,7 +477,9 @@ async def login(request: LoginRequest):
         
         # Update token
         new_token = str(uuid.uuid4())
-        users_collection.update_one({"_id": user["_id"]}, {"$set": {"token": new_token}})
+        users_collection.update_one(
+            {"_id": user["_id"]}, {"$set": {"token": new_token, "token_issued_at": datetime.utcnow()}}
+        )
         
         return {
             "success": True,
@@ -156,14 +497,24 @@ async def login(request: LoginRequest):
         logger.error(f"Errore login: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
+def _collection_version(collection, query: Optional[Dict] = None):
+    """Cheap validator for cached responses: document count and latest updated_at"""
+    latest = collection.find_one(query or {}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", DESCENDING)])
+    count = collection.count_documents(query) if query else collection.estimated_document_count()
+    return count, latest.get('updated_at') if latest else None
+
 # Candidates endpoints
+def _candidate_list() -> bytes:
+    cursor = raw_find(candidates_read_collection, {}, CandidateRecord)
+    return list_body("candidates", records(cursor, CandidateRecord))
+
+def _cached_candidate_list():
+    return "candidates", _collection_version(candidates_read_collection), _candidate_list
+
 @app.get("/api/candidates")
-async def get_candidates():
+async def get_candidates(request: Request):
     try:
-        candidates = list(candidates_collection.find({}))
-        for candidate in candidates:
-            candidate['_id'] = str(candidate['_id'])
-        return {"success": True, "candidates": candidates}
+        return await response_cache.respond(request, *_cached_candidate_list())
     except Exception as e:
         logger.error(f"Errore recupero candidati: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
@@ -171,16 +522,21 @@ async def get_candidates():
 @app.post("/api/candidates")
 async def create_candidate(candidate: Candidate):
     try:
+        check_quota(candidates_collection)
         candidate_dict = candidate.dict()
         candidate_dict['id'] = str(uuid.uuid4())
         candidate_dict['created_at'] = datetime.utcnow()
+        candidate_dict['updated_at'] = candidate_dict['created_at']
         
         result = candidates_collection.insert_one(candidate_dict)
+        await record_activity("candidates", candidate_dict['created_at'])
         
         # Remove MongoDB _id from response
         candidate_dict.pop('_id', None)
         
         return {"success": True, "candidate": candidate_dict}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Errore creazione candidato: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
@@ -188,7 +544,7 @@ async def create_candidate(candidate: Candidate):
 @app.get("/api/candidates/{candidate_id}")
 async def get_candidate(candidate_id: str):
     try:
-        candidate = candidates_collection.find_one({"id": candidate_id})
+        candidate = candidates_read_collection.find_one({"id": candidate_id})
         if not candidate:
             raise HTTPException(status_code=404, detail="Candidato non trovato")
         
@@ -201,138 +557,940 @@ async def get_candidate(candidate_id: str):
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 # Campaigns endpoints
+def _to_utc_naive(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _campaign_item(campaign: Dict, item: Dict, strict: bool = False) -> Dict:
+    """Build an event/material document owned by ``campaign``.
+
+    With ``strict`` an unparseable date raises ValueError (client input);
+    otherwise it is kept as text (legacy documents).
+    """
+    item = dict(item)
+    now = datetime.utcnow()
+    item['id'] = item.get('id') or str(uuid.uuid4())
+    item['campaign_id'] = campaign['id']
+    item['candidate_id'] = campaign['candidate_id']
+    item['created_at'] = item.get('created_at') or now
+    try:
+        date = item.get('date')
+        if date not in (None, '') and not isinstance(date, (str, datetime)):
+            raise ValueError(f"data non valida: {date!r}")
+        item['date'] = _to_utc_naive(date or None) or item['created_at']
+    except ValueError:
+        if strict:
+            raise
+        # Free-form legacy dates are kept as-is alongside an indexable one
+        item['date_text'] = item['date']
+        item['date'] = item['created_at']
+    return item
+
+def _next_events(campaign_ids: List[str]) -> Dict[str, Dict]:
+    """Return the first upcoming event of each campaign, keyed by campaign id"""
+    if not campaign_ids:
+        return {}
+    pipeline = [
+        {"$match": {"campaign_id": {"$in": campaign_ids}, "date": {"$gte": datetime.utcnow()}}},
+        {"$sort": {"date": ASCENDING}},
+        {"$group": {
+            "_id": "$campaign_id",
+            "id": {"$first": "$id"},
+            "name": {"$first": "$name"},
+            "date": {"$first": "$date"},
+            "location": {"$first": "$location"},
+        }},
+    ]
+    return {doc.pop('_id'): doc for doc in events_read_collection.aggregate(pipeline)}
+
+def _page(cursor, skip: int, limit: int):
+    items = list(cursor.skip(skip).limit(limit + 1))
+    has_more = len(items) > limit
+    return items[:limit], has_more
+
+def _date_range(start: Optional[datetime], end: Optional[datetime], days: Optional[int]) -> Dict:
+    start = _to_utc_naive(start)
+    end = _to_utc_naive(end)
+    if days is not None:
+        start = start or datetime.utcnow()
+        end = end or start + timedelta(days=days)
+    date_filter = {}
+    if start:
+        date_filter["$gte"] = start
+    if end:
+        date_filter["$lt"] = end
+    return date_filter
+
+def _candidate_campaigns(candidate_id: str) -> bytes:
+    campaigns = list(records(
+        raw_find(campaigns_read_collection, {"candidate_id": candidate_id}, CampaignRecord),
+        CampaignRecord
+    ))
+    next_events = _next_events([c.id for c in campaigns])
+    for campaign in campaigns:
+        campaign.next_event = next_events.get(campaign.id)
+    return list_body("campaigns", campaigns)
+
 @app.get("/api/campaigns/{candidate_id}")
-async def get_candidate_campaigns(candidate_id: str):
+async def get_candidate_campaigns(candidate_id: str, request: Request):
     try:
-        campaigns = list(campaigns_collection.find({"candidate_id": candidate_id}))
-        for campaign in campaigns:
-            campaign['_id'] = str(campaign['_id'])
-        return {"success": True, "campaigns": campaigns}
+        await write_buffer.sync_writer(client_key(request.scope), "campaigns", "campaign_events")
+        return Response(_candidate_campaigns(candidate_id), media_type="application/json")
     except Exception as e:
         logger.error(f"Errore recupero campagne: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @app.post("/api/campaigns")
-async def create_campaign(campaign: Campaign):
+async def create_campaign(campaign: Campaign, request: Request):
     try:
+        check_quota(campaigns_collection)
         campaign_dict = campaign.dict()
         campaign_dict['id'] = str(uuid.uuid4())
         campaign_dict['created_at'] = datetime.utcnow()
-        
-        result = campaigns_collection.insert_one(campaign_dict)
+        campaign_dict['updated_at'] = campaign_dict['created_at']
+
+        # Validated before any write, so bad input never leaves a partial campaign behind
+        try:
+            events = [_campaign_item(campaign_dict, e, strict=True) for e in campaign_dict.pop('events') or []]
+            materials = [_campaign_item(campaign_dict, m, strict=True) for m in campaign_dict.pop('materials') or []]
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Data non valida in un evento o materiale della campagna")
+        campaign_dict['events_count'] = len(events)
+        campaign_dict['materials_count'] = len(materials)
+
+        writer = client_key(request.scope)
+        await asyncio.gather(
+            write_buffer.insert(campaigns_collection, campaign_dict, writer=writer),
+            write_buffer.insert_many(events_collection, events, writer=writer),
+            write_buffer.insert_many(materials_collection, materials, writer=writer),
+            record_activity("campaigns", campaign_dict['created_at'], campaign_dict['status']),
+        )
         
         # Remove MongoDB _id from response
         campaign_dict.pop('_id', None)
+        upcoming = sorted((e for e in events if e['date'] >= datetime.utcnow()), key=lambda e: e['date'])
+        campaign_dict['next_event'] = {
+            k: upcoming[0].get(k) for k in ("id", "name", "date", "location")
+        } if upcoming else None
         
         return {"success": True, "campaign": campaign_dict}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Errore creazione campagna: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
+async def _get_campaign_or_404(campaign_id: str, writer: str) -> Dict:
+    projection = {"_id": 0, "id": 1, "candidate_id": 1}
+    campaign = campaigns_collection.find_one({"id": campaign_id}, projection)
+    if not campaign:
+        # The campaign may still be queued by this writer (buffered mode)
+        await write_buffer.sync_writer(writer, "campaigns")
+        campaign = campaigns_collection.find_one({"id": campaign_id}, projection)
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campagna non trovata")
+    return campaign
+
+@app.post("/api/campaigns/{campaign_id}/events")
+async def add_campaign_event(campaign_id: str, event: CampaignEvent, request: Request):
+    try:
+        writer = client_key(request.scope)
+        campaign = await _get_campaign_or_404(campaign_id, writer)
+        event_dict = _campaign_item(campaign, event.dict(exclude_none=True))
+
+        await asyncio.gather(
+            write_buffer.insert(events_collection, event_dict, writer=writer),
+            write_buffer.update(campaigns_collection, {"id": campaign_id},
+                                {"$inc": {"events_count": 1}, "$set": {"updated_at": datetime.utcnow()}},
+                                writer=writer),
+        )
+
+        event_dict.pop('_id', None)
+        return {"success": True, "event": event_dict}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore creazione evento: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/campaigns/{campaign_id}/events")
+async def get_campaign_events(campaign_id: str, request: Request, start: Optional[datetime] = None,
+                              end: Optional[datetime] = None, skip: int = Query(0, ge=0),
+                              limit: int = Query(50, ge=1, le=500)):
+    try:
+        await write_buffer.sync_writer(client_key(request.scope), "campaign_events")
+        query = {"campaign_id": campaign_id}
+        date_filter = _date_range(start, end, None)
+        if date_filter:
+            query["date"] = date_filter
+
+        events, has_more = _page(events_read_collection.find(query, {"_id": 0}).sort("date", ASCENDING), skip, limit)
+        return {"success": True, "events": events, "has_more": has_more}
+    except Exception as e:
+        logger.error(f"Errore recupero eventi: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.post("/api/campaigns/{campaign_id}/materials")
+async def add_campaign_material(campaign_id: str, material: CampaignMaterial, request: Request):
+    try:
+        writer = client_key(request.scope)
+        campaign = await _get_campaign_or_404(campaign_id, writer)
+        material_dict = _campaign_item(campaign, material.dict(exclude_none=True))
+
+        await asyncio.gather(
+            write_buffer.insert(materials_collection, material_dict, writer=writer),
+            write_buffer.update(campaigns_collection, {"id": campaign_id},
+                                {"$inc": {"materials_count": 1}, "$set": {"updated_at": datetime.utcnow()}},
+                                writer=writer),
+        )
+
+        material_dict.pop('_id', None)
+        return {"success": True, "material": material_dict}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore creazione materiale: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/campaigns/{campaign_id}/materials")
+async def get_campaign_materials(campaign_id: str, request: Request, skip: int = Query(0, ge=0),
+                                 limit: int = Query(50, ge=1, le=500)):
+    try:
+        await write_buffer.sync_writer(client_key(request.scope), "campaign_materials")
+        cursor = materials_read_collection.find({"campaign_id": campaign_id}, {"_id": 0}).sort("date", DESCENDING)
+        materials, has_more = _page(cursor, skip, limit)
+        return {"success": True, "materials": materials, "has_more": has_more}
+    except Exception as e:
+        logger.error(f"Errore recupero materiali: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/events")
+async def get_events(request: Request, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     days: Optional[int] = Query(None, ge=1, le=366),
+                     candidate_id: Optional[str] = None,
+                     skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500)):
+    """Events across all campaigns, e.g. ``?days=7`` for the coming week"""
+    try:
+        await write_buffer.sync_writer(client_key(request.scope), "campaign_events")
+        query = {}
+        date_filter = _date_range(start, end, days)
+        if date_filter:
+            query["date"] = date_filter
+        if candidate_id:
+            query["candidate_id"] = candidate_id
+
+        events, has_more = _page(events_read_collection.find(query, {"_id": 0}).sort("date", ASCENDING), skip, limit)
+        return {"success": True, "events": events, "has_more": has_more}
+    except Exception as e:
+        logger.error(f"Errore recupero eventi: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
 # AI Program Generation - THE KILLER FEATURE!
 
-# @app.post("/api/generate-program")
-# async def generate_electoral_program(request: ProgramGenerationRequest):
-#     try:
-#         if not GEMINI_API_KEY:
-#             raise HTTPException(status_code=500, detail="API Key Gemini non configurata")
+@functools.lru_cache(maxsize=1)
+def load_llm_provider():
+    """Import the LLM SDK on first use so startup and other routes never pay for it"""
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    return LlmChat, UserMessage
+
+@app.post("/api/generate-program")
+async def generate_electoral_program(request: ProgramGenerationRequest):
+    try:
+        if not GEMINI_API_KEY:
+            raise HTTPException(status_code=500, detail="API Key Gemini non configurata")
+
+        try:
+            LlmChat, UserMessage = await run_in_threadpool(load_llm_provider)
+        except ImportError as e:
+            logger.error(f"SDK LLM non disponibile: {e}")
+            raise HTTPException(status_code=503, detail="Servizio di generazione AI non disponibile")
         
-#         Create AI chat instance
-#         chat = LlmChat(
-#             api_key=GEMINI_API_KEY,
-#             session_id=f"program-gen-{uuid.uuid4()}",
-#             system_message="""Sei un esperto consulente politico per elezioni studentesche italiane. 
-#             Crei programmi elettorali coinvolgenti, realistici e specifici per studenti delle scuole superiori.
-#             Il programma deve essere professionale ma accessibile agli studenti, con proposte concrete e realizzabili."""
-#         ).with_model("gemini", "gemini-2.5-pro-preview-05-06").with_max_tokens(4000)
+        # Create AI chat instance
+        chat = LlmChat(
+            api_key=GEMINI_API_KEY,
+            session_id=f"program-gen-{uuid.uuid4()}",
+            system_message="""Sei un esperto consulente politico per elezioni studentesche italiane. 
+            Crei programmi elettorali coinvolgenti, realistici e specifici per studenti delle scuole superiori.
+            Il programma deve essere professionale ma accessibile agli studenti, con proposte concrete e realizzabili."""
+        ).with_model("gemini", "gemini-2.5-pro-preview-05-06").with_max_tokens(4000)
         
-#         Generate program content
-#         prompt = f"""
-#         Crea un programma elettorale completo per le elezioni studentesche per:
-#         - Candidato: {request.candidate_name}
-#         - Anno scolastico: {request.class_year}
-#         - Principali questioni: {', '.join(request.main_issues)}
-#         - Valori personali: {', '.join(request.personal_values)}
-#         - Contesto scolastico: {request.school_context}
+        # Generate program content
+        prompt = f"""
+        Crea un programma elettorale completo per le elezioni studentesche per:
+        - Candidato: {request.candidate_name}
+        - Anno scolastico: {request.class_year}
+        - Principali questioni: {', '.join(request.main_issues)}
+        - Valori personali: {', '.join(request.personal_values)}
+        - Contesto scolastico: {request.school_context}
         
-#         Il programma deve includere:
-#         1. Titolo accattivante
-#         2. Presentazione del candidato
-#         3. Visione per la scuola
-#         4. 5-7 proposte concrete e specifiche
-#         5. Conclusione motivante
+        Il programma deve includere:
+        1. Titolo accattivante
+        2. Presentazione del candidato
+        3. Visione per la scuola
+        4. 5-7 proposte concrete e specifiche
+        5. Conclusione motivante
         
-#         Scrivi in italiano, stile professionale ma giovanile. Massimo 1500 parole.
-#         """
+        Scrivi in italiano, stile professionale ma giovanile. Massimo 1500 parole.
+        """
         
-#         user_message = UserMessage(text=prompt)
-#         response = await chat.send_message(user_message)
+        user_message = UserMessage(text=prompt)
+        response = await chat.send_message(user_message)
         
-#         return {
-#             "success": True,
-#             "program": {
-#                 "content": response,
-#                 "generated_at": datetime.utcnow().isoformat(),
-#                 "model_used": "gemini-2.5-pro-preview-05-06"
-#             }
-#         }
+        return {
+            "success": True,
+            "program": {
+                "content": response,
+                "generated_at": datetime.utcnow().isoformat(),
+                "model_used": "gemini-2.5-pro-preview-05-06"
+            }
+        }
         
-#     except HTTPException:
-#         raise
-#     except Exception as e:
-#         logger.error(f"Errore generazione programma AI: {e}")
-#         raise HTTPException(status_code=500, detail=f"Errore generazione programma: {str(e)}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore generazione programma AI: {e}")
+        raise HTTPException(status_code=500, detail=f"Errore generazione programma: {str(e)}")
+
+def _program_version_metadata(program_dict: Dict) -> Dict:
+    return {
+        "title": program_dict['title'],
+        "generated_by_ai": program_dict.get('generated_by_ai', False),
+        "created_at": program_dict['updated_at'],
+    }
+
+def _create_program(program: ElectoralProgram) -> Dict:
+    program_dict = program.dict()
+    now = datetime.utcnow()
+    program_dict['id'] = str(uuid.uuid4())
+    program_dict['created_at'] = now
+    program_dict['updated_at'] = now
+    program_dict['version'] = 1
+
+    program_versions_collection.insert_one(build_version_doc(
+        program_dict['id'], 1, program_dict['content'], None,
+        **_program_version_metadata(program_dict)
+    ))
+    programs_collection.insert_one(program_dict)
+    return program_dict
+
+def _revise_program(current: Dict, program: ElectoralProgram) -> Dict:
+    current_version = current.get('version')
+    if current_version is None:
+        # Programs saved before versioning: record the existing content as version 1.
+        # Concurrent first edits both get here, so only the first one writes it.
+        current_version = 1
+        try:
+            program_versions_collection.update_one(
+                {"program_id": current['id'], "version": 1},
+                {"$setOnInsert": build_version_doc(
+                    current['id'], 1, current['content'], None,
+                    title=current['title'],
+                    generated_by_ai=current.get('generated_by_ai', False),
+                    created_at=current.get('created_at'),
+                )},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Lost the upsert race: version 1 is already recorded
+            pass
+    if program.version is not None and program.version != current_version:
+        raise HTTPException(status_code=409, detail="Il programma è stato modificato nel frattempo")
+
+    new_version = current_version + 1
+    updates = {
+        "title": program.title,
+        "content": program.content,
+        "generated_by_ai": program.generated_by_ai,
+        "updated_at": datetime.utcnow(),
+        "version": new_version,
+    }
+    try:
+        program_versions_collection.insert_one(build_version_doc(
+            current['id'], new_version, program.content, current['content'],
+            **_program_version_metadata(updates)
+        ))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Il programma è stato modificato nel frattempo")
+
+    programs_collection.update_one(
+        {"id": current['id'], "version": current.get('version')},
+        {"$set": updates}
+    )
+    current.update(updates)
+    current.pop('_id', None)
+    return current
 
 @app.post("/api/programs")
 async def save_program(program: ElectoralProgram):
     try:
-        program_dict = program.dict()
-        program_dict['id'] = str(uuid.uuid4())
-        program_dict['created_at'] = datetime.utcnow()
-        
-        result = programs_collection.insert_one(program_dict)
-        
+        current = None
+        if program.id:
+            current = programs_collection.find_one({"id": program.id, "candidate_id": program.candidate_id})
+
+        if current:
+            program_dict = _revise_program(current, program)
+            await record_activity("program_revisions", program_dict['updated_at'])
+        else:
+            check_quota(programs_collection)
+            program_dict = _create_program(program)
+            await record_activity("programs", program_dict['created_at'])
+        await run_in_threadpool(index_program_similarity, program_dict)
+
         # Remove MongoDB _id from response
         program_dict.pop('_id', None)
-        
+
         return {"success": True, "program": program_dict}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Errore salvataggio programma: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
+def index_program_similarity(program_dict: Dict):
+    """Update the near-duplicate index of a saved program; never fails the request"""
+    try:
+        program_similarity.index(program_dict['id'], program_dict['candidate_id'], program_dict['content'])
+    except Exception as e:
+        logger.error(f"Errore indicizzazione similarità programma {program_dict['id']}: {e}")
+
+def _candidate_programs(candidate_id: str) -> bytes:
+    cursor = raw_find(programs_read_collection, {"candidate_id": candidate_id}, ProgramRecord)
+    return list_body("programs", records(cursor, ProgramRecord))
+
+def _cached_candidate_programs(candidate_id: str):
+    return (
+        f"programs:{candidate_id}",
+        _collection_version(programs_read_collection, {"candidate_id": candidate_id}),
+        functools.partial(_candidate_programs, candidate_id),
+    )
+
 @app.get("/api/programs/{candidate_id}")
-async def get_candidate_programs(candidate_id: str):
+async def get_candidate_programs(candidate_id: str, request: Request):
     try:
-        programs = list(programs_collection.find({"candidate_id": candidate_id}))
-        for program in programs:
-            program['_id'] = str(program['_id'])
-        return {"success": True, "programs": programs}
+        return await response_cache.respond(request, *_cached_candidate_programs(candidate_id))
     except Exception as e:
         logger.error(f"Errore recupero programmi: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
-# Dashboard stats
-@app.get("/api/dashboard/stats")
-async def get_dashboard_stats():
+@app.get("/api/programs/{program_id}/versions")
+async def get_program_versions(program_id: str):
     try:
-        total_candidates = candidates_collection.count_documents({})
-        total_campaigns = campaigns_collection.count_documents({})
-        active_campaigns = campaigns_collection.count_documents({"status": "active"})
-        total_programs = programs_collection.count_documents({})
-        
+        program = programs_collection.find_one({"id": program_id}, {"_id": 0, "content": 0})
+        if not program:
+            raise HTTPException(status_code=404, detail="Programma non trovato")
+
+        versions = list(program_versions_collection.find(
+            {"program_id": program_id},
+            {"_id": 0, "content": 0, "ops": 0}
+        ).sort("version", ASCENDING))
+        return {"success": True, "program": program, "versions": versions}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore recupero versioni programma: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/programs/{program_id}/versions/{version}")
+async def get_program_version(program_id: str, version: int):
+    try:
+        snapshot = program_versions_collection.find_one(
+            {"program_id": program_id, "version": {"$lte": version}, "kind": SNAPSHOT},
+            {"version": 1},
+            sort=[("version", DESCENDING)]
+        )
+        if not snapshot:
+            raise HTTPException(status_code=404, detail="Versione non trovata")
+
+        chain = list(program_versions_collection.find(
+            {"program_id": program_id, "version": {"$gte": snapshot['version'], "$lte": version}},
+            {"_id": 0}
+        ).sort("version", ASCENDING))
+        if chain[-1]['version'] != version:
+            raise HTTPException(status_code=404, detail="Versione non trovata")
+
+        target = chain[-1]
         return {
             "success": True,
-            "stats": {
-                "total_candidates": total_candidates,
-                "total_campaigns": total_campaigns,
-                "active_campaigns": active_campaigns,
-                "total_programs": total_programs
+            "program": {
+                "id": program_id,
+                "version": version,
+                "title": target.get('title'),
+                "content": reconstruct(chain),
+                "generated_by_ai": target.get('generated_by_ai', False),
+                "created_at": target.get('created_at'),
             }
         }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore ricostruzione versione programma: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/programs/{program_id}/similar")
+async def get_similar_programs(program_id: str, threshold: float = Query(similarity.SIMILARITY_THRESHOLD, ge=0.1, le=1),
+                               limit: int = Query(10, ge=1, le=100)):
+    try:
+        if programs_read_collection.find_one({"id": program_id}, {"_id": 1}) is None:
+            raise HTTPException(status_code=404, detail="Programma non trovato")
+        similar = await run_in_threadpool(program_similarity.similar, program_id, threshold, limit)
+        titles = {
+            p['id']: p.get('title')
+            for p in programs_read_collection.find({"id": {"$in": [s['program_id'] for s in similar]}},
+                                                   {"_id": 0, "id": 1, "title": 1})
+        }
+        for entry in similar:
+            entry['title'] = titles.get(entry['program_id'])
+        return {"success": True, "program_id": program_id, "similar": similar}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore ricerca programmi simili: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+# Elections
+def _get_election_or_404(election_id: str, fresh: bool = False) -> Dict:
+    election = voting_service.election(election_id, fresh=fresh)
+    if not election:
+        raise HTTPException(status_code=404, detail="Elezione non trovata")
+    return election
+
+@app.post("/api/elections")
+async def create_election(election: Election, admin: Dict = Depends(require_admin)):
+    try:
+        election_dict = election.dict()
+        if election_dict['candidate_ids'] is None:
+            election_dict['candidate_ids'] = candidates_collection.distinct("id")
+        now = datetime.utcnow()
+        election_dict.update({
+            "id": str(uuid.uuid4()),
+            "status": ELECTION_OPEN,
+            "created_at": now,
+            "updated_at": now,
+        })
+        elections_collection.insert_one(election_dict)
+        election_dict.pop('_id', None)
+        return {"success": True, "election": election_dict}
+    except Exception as e:
+        logger.error(f"Errore creazione elezione: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/elections")
+async def get_elections():
+    try:
+        elections = list(elections_collection.find({}, {"_id": 0, "results": 0}).sort("created_at", DESCENDING))
+        return {"success": True, "elections": elections}
+    except Exception as e:
+        logger.error(f"Errore recupero elezioni: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.post("/api/elections/{election_id}/votes")
+async def cast_vote(election_id: str, vote: VoteRequest, user: Dict = Depends(require_user)):
+    try:
+        if user.get('role') not in VOTER_ROLES:
+            raise HTTPException(status_code=403, detail="Il tuo ruolo non può votare")
+        election = _get_election_or_404(election_id)
+        if election['status'] != ELECTION_OPEN:
+            raise HTTPException(status_code=409, detail="Le votazioni sono chiuse")
+        if vote.candidate_id not in election['candidate_ids']:
+            raise HTTPException(status_code=400, detail="Candidato non presente in questa elezione")
+
+        cast = await run_in_threadpool(voting_service.cast, election, user['id'], vote.candidate_id)
+        return {"success": True, "vote": cast}
+    except AlreadyVoted:
+        raise HTTPException(status_code=409, detail="Hai già votato in questa elezione")
+    except ElectionClosed:
+        raise HTTPException(status_code=409, detail="Le votazioni sono chiuse")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore registrazione voto: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/elections/{election_id}/results")
+async def get_election_results(election_id: str):
+    """Live tally while the election is open (refreshed every VOTE_TALLY_REFRESH_S), final once closed"""
+    try:
+        election = _get_election_or_404(election_id)
+        results = await run_in_threadpool(voting_service.results, election)
+        return {"success": True, "election_id": election_id, "status": election['status'], **results}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore risultati elezione: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.post("/api/elections/{election_id}/close")
+async def close_election(election_id: str, admin: Dict = Depends(require_admin)):
+    try:
+        election = _get_election_or_404(election_id, fresh=True)
+        if election['status'] == ELECTION_CLOSED:
+            raise HTTPException(status_code=409, detail="Elezione già chiusa")
+        results = await run_in_threadpool(voting_service.close, election)
+        return {"success": True, "election_id": election_id, "status": ELECTION_CLOSED,
+                **results, "final": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore chiusura elezione: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+def archive_closed_election(election_id: str) -> Dict:
+    """Move a closed election's documents to the archive store (see archive.py)"""
+    election = voting_service.election(election_id, fresh=True)
+    if not election:
+        raise LookupError("Elezione non trovata")
+    if election['status'] != ELECTION_CLOSED:
+        raise archive.NotArchivable("Solo le elezioni chiuse possono essere archiviate")
+    # Candidates still running in elections not yet archived stay live
+    running = set(elections_collection.distinct(
+        "candidate_ids", {"id": {"$ne": election_id}, "archived_at": {"$exists": False}}
+    ))
+    candidate_ids = [c for c in election.get('candidate_ids') or [] if c not in running]
+    sources = {name: LazyCollection(name) for name in archive.ARCHIVED_COLLECTIONS}
+    result = archive.archive_election(archive_store, tenancy.database_name(), election, sources, candidate_ids)
+
+    removed = result['removed']
+    for name in ("candidates", "campaigns", "programs"):
+        sync.record_deletions(tombstones_collection, name, removed[name])
+    program_similarity.remove(removed['programs'])
+    LazyCollection("vote_counters").delete_many({"election_id": election_id})
+    manifest = dict(result['manifest'], candidate_ids=candidate_ids)
+    elections_collection.update_one(
+        {"id": election_id},
+        {"$set": {"archived_at": manifest['archived_at'], "archive": manifest, "updated_at": datetime.utcnow()}}
+    )
+    voting_service.forget(election_id)
+    return manifest
+
+@app.post("/api/admin/elections/{election_id}/archive")
+async def archive_election(election_id: str, admin: Dict = Depends(require_admin)):
+    try:
+        manifest = await run_in_threadpool(archive_closed_election, election_id)
+        return {"success": True, "election_id": election_id, "archive": manifest}
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except archive.NotArchivable as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Errore archiviazione elezione: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/admin/archive/{election_id}/{collection}")
+async def get_archived_documents(election_id: str, collection: str, request: Request,
+                                 skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000),
+                                 admin: Dict = Depends(require_admin)):
+    """Read-only access to an archived election; filter with candidate_id, campaign_id or program_id"""
+    try:
+        if collection not in archive.ARCHIVED_COLLECTIONS:
+            raise HTTPException(status_code=404, detail="Collezione non archiviata")
+        election = _get_election_or_404(election_id)
+        if not election.get('archived_at'):
+            raise HTTPException(status_code=404, detail="Elezione non archiviata")
+        filters = {f: request.query_params[f] for f in archive.FILTERS if f in request.query_params}
+        documents = await run_in_threadpool(
+            archive_store.read, tenancy.database_name(), election_id, collection, filters, skip, limit
+        )
+        if documents is None:
+            raise HTTPException(status_code=404, detail="Archivio non trovato")
+        return {"success": True, "election_id": election_id, "collection": collection, collection: documents}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore lettura archivio: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+# Batched reads
+def _candidate_page(skip: int, limit: int) -> bytes:
+    cursor = raw_find(candidates_read_collection, {}, CandidateRecord, sort=[("_id", ASCENDING)])
+    page = list(records(cursor.skip(skip).limit(limit + 1), CandidateRecord))
+    return list_body("candidates", page[:limit], {"has_more": len(page) > limit})
+
+def _batch_operation(operation: BatchOperation) -> bytes:
+    if operation.op == "stats":
+        return response_cache.body(*_cached_dashboard_stats())
+    if operation.op == "candidates":
+        if operation.skip or operation.limit:
+            return _candidate_page(operation.skip, operation.limit or 50)
+        return response_cache.body(*_cached_candidate_list())
+    if not operation.candidate_id:
+        raise HTTPException(status_code=400, detail=f"candidate_id obbligatorio per {operation.op}")
+    if operation.op == "campaigns":
+        return _candidate_campaigns(operation.candidate_id)
+    return response_cache.body(*_cached_candidate_programs(operation.candidate_id))
+
+async def _run_batch_operation(operation: BatchOperation) -> bytes:
+    try:
+        body = await run_in_threadpool(_batch_operation, operation)
+        return b'{"status":200,"body":' + body + b'}'
+    except HTTPException as e:
+        return json_body({"status": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.error(f"Errore operazione batch {operation.op}: {e}")
+        return json_body({"status": 500, "detail": "Errore interno del server"})
+
+@app.post("/api/batch")
+async def batch_read(batch: BatchRequest, request: Request):
+    """Run several read operations concurrently and return their results in one response.
+
+    Each result is ``{"status": 200, "body": <same body as the single endpoint>}``
+    or ``{"status": <code>, "detail": <error>}``, keyed by the operation ``id``.
+    """
+    try:
+        if not batch.operations or len(batch.operations) > BATCH_MAX_OPERATIONS:
+            raise HTTPException(status_code=400,
+                                detail=f"Da 1 a {BATCH_MAX_OPERATIONS} operazioni per richiesta")
+        keys = [op.id or str(n) for n, op in enumerate(batch.operations)]
+        if len(set(keys)) != len(keys):
+            raise HTTPException(status_code=400, detail="Identificativi delle operazioni duplicati")
+        if any(op.op == "campaigns" for op in batch.operations):
+            await write_buffer.sync_writer(client_key(request.scope), "campaigns", "campaign_events")
+
+        results = await asyncio.gather(*(_run_batch_operation(op) for op in batch.operations))
+        body = b'{"success":true,"results":{' + b','.join(
+            json_body(key) + b':' + result for key, result in zip(keys, results)
+        ) + b'}}'
+        return Response(body, media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore richiesta batch: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+# Delta sync
+@app.get("/api/sync")
+async def delta_sync(request: Request, since: Optional[datetime] = None,
+                     candidate_id: Optional[str] = None):
+    """Candidates, campaigns and programs changed since ``since`` (see sync.py).
+
+    Without ``since``, or with one older than the tombstone retention, every
+    record is returned with ``full: true`` and the client should replace its
+    local copy. ``candidate_id`` restricts campaigns and programs to one candidate.
+    """
+    try:
+        now = datetime.utcnow()
+        since = _to_utc_naive(since)
+        full = sync.needs_full_sync(since)
+        if full:
+            since = None
+        await write_buffer.sync_writer(client_key(request.scope), "campaigns", "campaign_events")
+
+        scoped = {"candidate_id": candidate_id} if candidate_id else {}
+        sources = {
+            "candidates": (candidates_read_collection, {}),
+            "campaigns": (campaigns_read_collection, scoped),
+            "programs": (programs_read_collection, scoped),
+        }
+        result = {}
+        truncated_at = []
+        for name, (collection, query) in sources.items():
+            docs = sync.changed(collection, since, query)
+            if len(docs) > sync.SYNC_MAX_ITEMS:
+                docs = docs[:sync.SYNC_MAX_ITEMS]
+                truncated_at.append(docs[-1]['updated_at'])
+            result[name] = docs
+
+        next_events = _next_events([c['id'] for c in result["campaigns"]])
+        for campaign in result["campaigns"]:
+            campaign.setdefault('events_count', 0)
+            campaign.setdefault('materials_count', 0)
+            campaign['next_event'] = next_events.get(campaign['id'])
+        for program in result["programs"]:
+            program.setdefault('version', 1)
+
+        return {
+            "success": True,
+            "full": full,
+            "since": since,
+            "next_since": sync.next_since(now, truncated_at),
+            "has_more": bool(truncated_at),
+            **result,
+            "deleted": sync.deleted(tombstones_collection, since) if since else {},
+        }
+    except Exception as e:
+        logger.error(f"Errore sincronizzazione: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+# Admin endpoints
+@app.get("/api/admin/analytics")
+async def get_analytics(request: Request, bucket: str = Query("day", pattern="^(day|week|month)$"),
+                        since: Optional[datetime] = None, admin: Dict = Depends(require_admin)):
+    """Creation trends, events per campaign and program lengths by class year (see analytics.py)"""
+    try:
+        since = _to_utc_naive(since)
+        validator = tuple(_collection_version(c) for c in (
+            candidates_read_collection, campaigns_read_collection, programs_read_collection
+        ))
+        return await response_cache.respond(
+            request, f"analytics:{bucket}:{since}", validator,
+            functools.partial(analytics.report, candidates_read_collection, campaigns_read_collection,
+                              programs_read_collection, bucket=bucket, since=since),
+        )
+    except Exception as e:
+        logger.error(f"Errore analisi campagne: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/admin/programs/duplicates")
+async def get_duplicate_programs(threshold: float = Query(0.8, ge=0.1, le=1), limit: int = Query(100, ge=1, le=1000),
+                                 admin: Dict = Depends(require_admin)):
+    """Pairs of near-identical programs across the whole collection (see similarity.py)"""
+    try:
+        report = await run_in_threadpool(program_similarity.all_pairs, threshold, limit)
+        return {"success": True, **report}
+    except Exception as e:
+        logger.error(f"Errore report programmi duplicati: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/admin/tenant")
+async def get_tenant_stats(admin: Dict = Depends(require_admin)):
+    """Quotas, usage and request metrics of the admin's school in this worker"""
+    try:
+        usage = await run_in_threadpool(
+            tenant_quotas.usage,
+            [users_collection, candidates_collection, campaigns_collection, programs_collection],
+        )
+        return {
+            "success": True,
+            "tenant": tenancy.current(),
+            "database": tenancy.database_name(),
+            "collections": usage,
+            "metrics": tenant_registry.metrics(),
+        }
+    except Exception as e:
+        logger.error(f"Errore statistiche tenant: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/admin/scheduler")
+async def get_scheduler_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, **maintenance_scheduler.stats()}
+
+@app.post("/api/admin/scheduler/{job}/run")
+async def run_maintenance_job(job: str, admin: Dict = Depends(require_admin)):
+    """Run a maintenance job now, in this worker, regardless of its schedule and lease"""
+    try:
+        if job not in maintenance_scheduler.jobs:
+            raise HTTPException(status_code=404, detail="Job sconosciuto")
+        result = await run_in_threadpool(maintenance_scheduler.run, job, True)
+        return {"success": True, "job": job, "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore esecuzione job {job}: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@app.get("/api/admin/frontend")
+async def get_frontend_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, **frontend_files.stats()}
+
+@app.get("/api/admin/db/pool")
+async def get_db_pool_stats(admin: Dict = Depends(require_admin)):
+    storage = get_storage()
+    return {"success": True, "backend": storage.name, "pool": storage.stats()}
+
+@app.get("/api/admin/db/queries")
+async def get_query_stats(admin: Dict = Depends(require_admin)):
+    """Per-collection/operation latency and the slow-query log with explain plans"""
+    if not QUERY_STATS:
+        raise HTTPException(status_code=404, detail="Monitoraggio query non abilitato (QUERY_STATS=1)")
+    return {"success": True, "queries": query_stats.snapshot()}
+
+@app.get("/api/admin/write-buffer")
+async def get_write_buffer_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, "write_buffer": write_buffer.stats()}
+
+@app.get("/api/admin/idempotency")
+async def get_idempotency_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, "idempotency": idempotency_store.stats()}
+
+@app.get("/api/admin/compression")
+async def get_compression_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, "compression": compression.stats.snapshot(), "cache": response_cache.stats()}
+
+@app.get("/api/admin/rate-limits")
+async def get_rate_limit_stats(admin: Dict = Depends(require_admin)):
+    return {"success": True, "rate_limits": rate_limiter.stats()}
+
+@app.get("/api/admin/profiles")
+async def get_profiles(order: str = Query("slowest", pattern="^(slowest|recent)$"),
+                       admin: Dict = Depends(require_admin)):
+    if not profiling.PROFILING:
+        raise HTTPException(status_code=404, detail="Profilazione non abilitata (PROFILING=1)")
+    traces = profiling.store.slowest() if order == "slowest" else profiling.store.recent()
+    return {"success": True, "profiles": traces}
+
+@app.get("/api/admin/profiles/{trace_id}/stacks", response_class=PlainTextResponse)
+async def get_profile_stacks(trace_id: int, admin: Dict = Depends(require_admin)):
+    """Stack samples in collapsed format, ready for flamegraph.pl or speedscope"""
+    stacks = profiling.store.collapsed_stacks(trace_id)
+    if stacks is None:
+        raise HTTPException(status_code=404, detail="Campioni non disponibili per questa traccia")
+    return stacks
+
+# Dashboard stats
+def _dashboard_stats() -> Dict:
+    total_candidates = candidates_read_collection.count_documents({})
+    total_campaigns = campaigns_read_collection.count_documents({})
+    active_campaigns = campaigns_read_collection.count_documents({"status": "active"})
+    total_programs = programs_read_collection.count_documents({})
+
+    return {
+        "success": True,
+        "stats": {
+            "total_candidates": total_candidates,
+            "total_campaigns": total_campaigns,
+            "active_campaigns": active_campaigns,
+            "total_programs": total_programs
+        }
+    }
+
+@app.get("/api/dashboard/activity")
+async def get_dashboard_activity(granularity: str = Query("day", pattern="^(hour|day)$"),
+                                 start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Activity per hour or day between ``start`` and ``end`` (default: the last 30 days or 48 hours)"""
+    try:
+        end = _to_utc_naive(end) or datetime.utcnow()
+        default_span = timedelta(days=30) if granularity == "day" else timedelta(hours=48)
+        start = _to_utc_naive(start) or end - default_span
+        if end <= start:
+            raise HTTPException(status_code=400, detail="L'intervallo richiesto non è valido")
+        if (end - start) / activity.GRANULARITIES[granularity] > activity.MAX_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Intervallo troppo ampio (massimo {activity.MAX_BUCKETS} punti)")
+
+        points = activity.series(activity_read_collection, granularity, start, end)
+        return {"success": True, "granularity": granularity, "start": start, "end": end,
+                "totals": activity.totals(points), "series": points}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore serie attività: {e}")
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+def _cached_dashboard_stats():
+    validator = tuple(_collection_version(c) for c in (
+        candidates_read_collection, campaigns_read_collection, programs_read_collection
+    ))
+    return "dashboard_stats", validator, _dashboard_stats
+
+@app.get("/api/dashboard/stats")
+async def get_dashboard_stats(request: Request):
+    try:
+        return await response_cache.respond(request, *_cached_dashboard_stats())
     except Exception as e:
         logger.error(f"Errore statistiche dashboard: {e}")
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
+# Frontend files and client-side routes; declared last so every API route matches first
+@app.api_route("/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_frontend(path: str, request: Request):
+    response = None
+    if frontend_files.available and not path.startswith("api/"):
+        response = frontend_files.response(request, path)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return response
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,200 @@
+"""Near-duplicate detection for electoral programs.
+
+Each program is reduced to a MinHash signature of its word shingles
+(``SIMILARITY_SHINGLE`` consecutive words): ``SIMILARITY_PERMUTATIONS``
+minimum hash values, whose fraction of equal positions between two programs
+estimates the Jaccard similarity of their shingle sets. Signatures are
+computed with numpy when a program is saved and stored in
+``program_signatures``.
+
+For lookups the signature is cut into ``SIMILARITY_BANDS`` bands (locality
+sensitive hashing): programs sharing at least one band hash are candidates,
+and only those are compared. Band hashes live in ``program_bands``, one
+indexed document per band, so finding the programs similar to one is a
+single ``$in`` query. The all-pairs report buckets every signature by band
+in memory with numpy instead of comparing each pair.
+
+With 128 permutations in 32 bands of 4 rows, pairs above ~0.6 similarity
+are found with high probability, pairs below ~0.2 rarely become candidates.
+"""
+import hashlib
+import os
+import re
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from pymongo import InsertOne
+
+SIMILARITY_SHINGLE = int(os.environ.get('SIMILARITY_SHINGLE', '3'))
+SIMILARITY_PERMUTATIONS = int(os.environ.get('SIMILARITY_PERMUTATIONS', '128'))
+SIMILARITY_BANDS = int(os.environ.get('SIMILARITY_BANDS', '32'))
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', '0.5'))
+
+_PRIME = np.uint64((1 << 31) - 1)
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text: str, size: int = SIMILARITY_SHINGLE) -> set:
+    words = _WORD.findall((text or "").lower())
+    if not words:
+        return set()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[n:n + size]) for n in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, permutations: int = SIMILARITY_PERMUTATIONS, bands: int = SIMILARITY_BANDS,
+                 seed: int = 1):
+        if permutations % bands:
+            raise ValueError("SIMILARITY_PERMUTATIONS deve essere un multiplo di SIMILARITY_BANDS")
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = permutations // bands
+        # Fixed seed: signatures stored by any worker must be comparable
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, int(_PRIME), size=(permutations, 1)).astype(np.uint64)
+        self._b = rng.randint(0, int(_PRIME), size=(permutations, 1)).astype(np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature (uint32) of ``text``, None when it has no words"""
+        shingle_set = shingles(text)
+        if not shingle_set:
+            return None
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingle_set),
+                             dtype=np.uint64, count=len(shingle_set)) % _PRIME
+        # (permutations x shingles) universal hashes, minimum per permutation
+        permuted = (self._a * hashes + self._b) % _PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray) -> List[str]:
+        bands = signature.reshape(self.bands, self.rows)
+        return [f"{n}:{hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest()}"
+                for n, band in enumerate(bands)]
+
+    def from_bytes(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(data, dtype=np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.count_nonzero(a == b)) / a.size
+
+
+class ProgramSimilarity:
+    def __init__(self, signatures, bands, hasher: Optional[MinHasher] = None):
+        self.signatures = signatures
+        self.bands = bands
+        self.hasher = hasher or MinHasher()
+
+    def ensure_indexes(self):
+        self.bands.create_index("band")
+        self.bands.create_index("program_id")
+
+    def index(self, program_id: str, candidate_id: str, content: str):
+        """Store (or replace) the signature and band hashes of a program"""
+        signature = self.hasher.signature(content)
+        self.bands.delete_many({"program_id": program_id})
+        if signature is None:
+            self.signatures.delete_one({"_id": program_id})
+            return
+        self.signatures.replace_one(
+            {"_id": program_id},
+            {"_id": program_id, "candidate_id": candidate_id, "signature": signature.tobytes(),
+             "permutations": self.hasher.permutations, "updated_at": datetime.utcnow()},
+            upsert=True,
+        )
+        self.bands.bulk_write([
+            InsertOne({"band": key, "program_id": program_id, "candidate_id": candidate_id})
+            for key in self.hasher.band_keys(signature)
+        ], ordered=False)
+
+    def remove(self, program_ids: Iterable[str]):
+        program_ids = list(program_ids)
+        if program_ids:
+            self.bands.delete_many({"program_id": {"$in": program_ids}})
+            self.signatures.delete_many({"_id": {"$in": program_ids}})
+
+    def rebuild(self, programs) -> int:
+        """Index every program; meant for empty collections, when the feature is introduced"""
+        indexed = 0
+        for program in programs.find({}, {"_id": 0, "id": 1, "candidate_id": 1, "content": 1}):
+            self.index(program["id"], program.get("candidate_id"), program.get("content"))
+            indexed += 1
+        return indexed
+
+    def similar(self, program_id: str, threshold: float = SIMILARITY_THRESHOLD, limit: int = 10) -> List[Dict]:
+        """Programs whose estimated similarity with ``program_id`` is at least ``threshold``"""
+        own = self.signatures.find_one({"_id": program_id})
+        if own is None:
+            return []
+        signature = self.hasher.from_bytes(own["signature"])
+        keys = self.hasher.band_keys(signature)
+        candidates = {doc["program_id"] for doc in self.bands.find({"band": {"$in": keys}},
+                                                                    {"_id": 0, "program_id": 1})}
+        candidates.discard(program_id)
+        if not candidates:
+            return []
+        found = []
+        for doc in self.signatures.find({"_id": {"$in": list(candidates)}}):
+            score = similarity(signature, self.hasher.from_bytes(doc["signature"]))
+            if score >= threshold:
+                found.append({"program_id": doc["_id"], "candidate_id": doc.get("candidate_id"),
+                              "similarity": round(score, 3)})
+        found.sort(key=lambda entry: entry["similarity"], reverse=True)
+        return found[:limit]
+
+    def load(self):
+        """``(ids, candidate_ids, matrix)`` with one signature per row"""
+        ids, candidate_ids, rows = [], [], []
+        for doc in self.signatures.find({"permutations": self.hasher.permutations}):
+            ids.append(doc["_id"])
+            candidate_ids.append(doc.get("candidate_id"))
+            rows.append(doc["signature"])
+        matrix = np.frombuffer(b"".join(rows), dtype=np.uint32).reshape(len(rows), self.hasher.permutations)
+        return ids, candidate_ids, matrix
+
+    def all_pairs(self, threshold: float = SIMILARITY_THRESHOLD, limit: int = 100) -> Dict:
+        """Every pair of programs at or above ``threshold``, most similar first"""
+        ids, candidate_ids, matrix = self.load()
+        count = len(ids)
+        left, right = candidate_pairs(matrix, self.hasher.bands)
+        if left.size:
+            scores = np.count_nonzero(matrix[left] == matrix[right], axis=1) / self.hasher.permutations
+            keep = scores >= threshold
+            left, right, scores = left[keep], right[keep], scores[keep]
+            order = np.argsort(-scores, kind="stable")
+            left, right, scores = left[order], right[order], scores[order]
+        else:
+            scores = np.empty(0)
+        pairs = [
+            {"program_ids": [ids[i], ids[j]], "candidate_ids": [candidate_ids[i], candidate_ids[j]],
+             "same_candidate": candidate_ids[i] == candidate_ids[j], "similarity": round(float(s), 3)}
+            for i, j, s in zip(left[:limit].tolist(), right[:limit].tolist(), scores[:limit].tolist())
+        ]
+        return {"programs": count, "threshold": threshold, "total_pairs": int(scores.size), "pairs": pairs}
+
+
+def candidate_pairs(matrix: np.ndarray, bands: int):
+    """Row index pairs ``(i < j)`` sharing at least one band of their signatures"""
+    count, permutations = matrix.shape
+    if count < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows = permutations // bands
+    found = []
+    for band in range(bands):
+        block = np.ascontiguousarray(matrix[:, band * rows:(band + 1) * rows])
+        # One opaque value per row so np.unique groups identical bands
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, inverse, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        ends = np.cumsum(sizes)
+        for group in np.flatnonzero(sizes > 1):
+            members = order[ends[group] - sizes[group]:ends[group]]
+            i, j = np.triu_indices(members.size, k=1)
+            found.append(members[i] * count + members[j])
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    codes = np.unique(np.concatenate(found))
+    return codes // count, codes % count
@@ -0,0 +1,938 @@
+"""Storage backends behind all endpoints.
+
+Endpoints talk to collections through ``LazyCollection`` proxies that are
+resolved against the active storage backend on every use:
+
+- ``mongo`` (default): pymongo collections configured in database.py
+- ``memory``: an in-process engine implementing the subset of the pymongo
+  collection API used by the application, including unique/compound/TTL
+  indexes. It needs no outside services, so the whole API can be exercised
+  and benchmarked in-process (tests, benchmarks, local demos).
+
+The backend is chosen with ``STORAGE_BACKEND=mongo|memory``. Both resolve
+collections in the database of the current tenant (see tenancy.py).
+"""
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+import database
+import tenancy
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+
+
+class Storage:
+    """Interface implemented by every storage backend"""
+
+    name = "base"
+
+    def collection(self, name: str, read: bool = False):
+        raise NotImplementedError
+
+    def ping(self):
+        """Raise ``RuntimeError`` with a clear message when the backend is unusable"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class MongoStorage(Storage):
+    name = "mongo"
+
+    def collection(self, name: str, read: bool = False):
+        return database.get_database(read, tenancy.database_name())[name]
+
+    def ping(self):
+        database.check_connection()
+
+    def close(self):
+        database.close_client()
+
+    def stats(self) -> Dict:
+        return database.pool_stats()
+
+
+# ---------------------------------------------------------------------------
+# In-memory engine
+# ---------------------------------------------------------------------------
+
+_MISSING = object()
+
+
+def _clone(value):
+    # Documents only hold JSON/BSON-like values, so this is much cheaper than deepcopy
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _get_path(doc, path: str):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set_path(doc: Dict, path: str, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc: Dict, path: str):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+# Cross-type ordering as in MongoDB: null < numbers < strings < objects < arrays < ObjectId < bool < dates
+def _type_rank(value) -> int:
+    if value is None or value is _MISSING:
+        return 0
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 6
+    if isinstance(value, datetime):
+        return 8
+    return 9
+
+
+def _sort_key(value):
+    rank = _type_rank(value)
+    if rank == 0:
+        return (0, 0)
+    if rank in (3, 4, 9):
+        return (rank, repr(value))
+    return (rank, value)
+
+
+def _compare(a, b) -> Optional[int]:
+    if a is _MISSING or b is _MISSING:
+        return None
+    if _type_rank(a) != _type_rank(b):
+        return None
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return None
+
+
+def _values_equal(value, expected) -> bool:
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(_values_equal(v, expected) for v in value)
+    if value is _MISSING:
+        return expected is None
+    return value == expected
+
+
+def _match_operator(value, op: str, arg) -> bool:
+    if op == '$eq':
+        return _values_equal(value, arg)
+    if op == '$ne':
+        return not _values_equal(value, arg)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        candidates = value if isinstance(value, list) else [value]
+        for candidate in candidates:
+            cmp = _compare(candidate, arg)
+            if cmp is None:
+                continue
+            if (op == '$gt' and cmp > 0) or (op == '$gte' and cmp >= 0) \
+                    or (op == '$lt' and cmp < 0) or (op == '$lte' and cmp <= 0):
+                return True
+        return False
+    if op == '$in':
+        return any(_values_equal(value, a) for a in arg)
+    if op == '$nin':
+        return not any(_values_equal(value, a) for a in arg)
+    if op == '$exists':
+        return (value is not _MISSING) == bool(arg)
+    if op == '$not':
+        return not _match_condition(value, arg)
+    if op == '$regex':
+        return isinstance(value, str) and re.search(arg, value) is not None
+    if op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    raise OperationFailure(f"Operatore non supportato dal motore in memoria: {op}")
+
+
+def _match_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        if '$regex' in condition and '$options' in condition:
+            flags = re.IGNORECASE if 'i' in condition['$options'] else 0
+            return isinstance(value, str) and re.search(condition['$regex'], value, flags) is not None
+        return all(_match_operator(value, op, arg) for op, arg in condition.items() if op != '$options')
+    if isinstance(condition, re.Pattern):
+        return isinstance(value, str) and condition.search(value) is not None
+    return _values_equal(value, condition)
+
+
+def matches(doc: Dict, query: Optional[Dict]) -> bool:
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, q) for q in condition):
+                return False
+        elif not _match_condition(_get_path(doc, key), condition):
+            return False
+    return True
+
+
+def _project(doc: Dict, projection) -> Dict:
+    if not projection:
+        return _clone(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    if fields and all(fields.values()):
+        result = {}
+        for field in fields:
+            value = _get_path(doc, field)
+            if value is not _MISSING:
+                _set_path(result, field, _clone(value))
+        if include_id and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    result = _clone(doc)
+    for field in fields:
+        _unset_path(result, field)
+    if not include_id:
+        result.pop('_id', None)
+    return result
+
+
+def _normalize_sort(key_or_list, direction=None) -> List[Tuple[str, int]]:
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(k, d) for k, d in key_or_list]
+
+
+def _sorted(docs: List[Dict], spec: List[Tuple[str, int]]) -> List[Dict]:
+    for field, direction in reversed(spec):
+        docs = sorted(docs, key=lambda d: _sort_key(_get_path(d, field)), reverse=direction < 0)
+    return docs
+
+
+def _apply_update(doc: Dict, update: Dict, inserting: bool = False):
+    if not any(k.startswith('$') for k in update):
+        # Replacement document
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(_clone(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if op == '$set':
+                _set_path(doc, path, _clone(arg))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set_path(doc, path, _clone(arg))
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                current = _get_path(doc, path)
+                _set_path(doc, path, (0 if current is _MISSING else current) + arg)
+            elif op in ('$max', '$min'):
+                current = _get_path(doc, path)
+                cmp = _compare(arg, current)
+                if current is _MISSING or (cmp is not None and (cmp > 0 if op == '$max' else cmp < 0)):
+                    _set_path(doc, path, _clone(arg))
+            elif op in ('$push', '$addToSet'):
+                current = _get_path(doc, path)
+                if current is _MISSING:
+                    current = []
+                    _set_path(doc, path, current)
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                for item in items:
+                    if op == '$push' or item not in current:
+                        current.append(_clone(item))
+                if isinstance(arg, dict) and '$slice' in arg:
+                    limit = arg['$slice']
+                    current[:] = current[limit:] if limit < 0 else current[:limit]
+            elif op == '$pull':
+                current = _get_path(doc, path)
+                if isinstance(current, list):
+                    current[:] = [v for v in current if not _match_condition(v, arg)]
+            else:
+                raise OperationFailure(f"Operatore di aggiornamento non supportato: {op}")
+
+
+def _upsert_seed(query: Dict) -> Dict:
+    """Equality fields of a query become fields of the upserted document"""
+    seed = {}
+    for key, condition in (query or {}).items():
+        if key.startswith('$'):
+            continue
+        if isinstance(condition, dict) and any(k.startswith('$') for k in condition):
+            if '$eq' in condition:
+                _set_path(seed, key, _clone(condition['$eq']))
+            continue
+        _set_path(seed, key, _clone(condition))
+    return seed
+
+
+class _Index:
+    def __init__(self, name: str, keys: List[Tuple[str, int]], unique: bool,
+                 expire_after: Optional[int], partial: Optional[Dict]):
+        self.name = name
+        self.keys = keys
+        self.fields = [k for k, _ in keys]
+        self.unique = unique
+        self.expire_after = expire_after
+        self.partial = partial
+        # First field value -> _ids, used for equality lookups
+        self.buckets: Dict[Any, set] = {}
+        self.unique_keys: Dict[tuple, Any] = {}
+
+    def covers(self, doc: Dict) -> bool:
+        return self.partial is None or matches(doc, self.partial)
+
+    @staticmethod
+    def _hashable(value):
+        if isinstance(value, list):
+            return tuple(_Index._hashable(v) for v in value)
+        if isinstance(value, dict):
+            return tuple(sorted((k, _Index._hashable(v)) for k, v in value.items()))
+        return value
+
+    def key_of(self, doc: Dict) -> tuple:
+        return tuple(self._hashable(None if (v := _get_path(doc, f)) is _MISSING else v) for f in self.fields)
+
+    def bucket_key(self, doc: Dict):
+        value = _get_path(doc, self.fields[0])
+        return self._hashable(None if value is _MISSING else value)
+
+    def add(self, doc: Dict):
+        if not self.covers(doc):
+            return
+        self.buckets.setdefault(self.bucket_key(doc), set()).add(doc['_id'])
+        if self.unique:
+            self.unique_keys[self.key_of(doc)] = doc['_id']
+
+    def remove(self, doc: Dict):
+        if not self.covers(doc):
+            return
+        bucket = self.buckets.get(self.bucket_key(doc))
+        if bucket is not None:
+            bucket.discard(doc['_id'])
+            if not bucket:
+                del self.buckets[self.bucket_key(doc)]
+        if self.unique and self.unique_keys.get(self.key_of(doc)) == doc['_id']:
+            del self.unique_keys[self.key_of(doc)]
+
+    def check_unique(self, doc: Dict, collection_name: str):
+        if not self.unique or not self.covers(doc):
+            return
+        owner = self.unique_keys.get(self.key_of(doc))
+        if owner is not None and owner != doc['_id']:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {collection_name} index: {self.name}",
+                11000
+            )
+
+
+class MemoryCursor:
+    def __init__(self, collection: "MemoryCollection", query, projection, sort=None, skip=0, limit=0):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = _normalize_sort(sort)
+        self._skip = skip
+        self._limit = limit
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def _execute(self):
+        if self._results is None:
+            self._results = iter(self._collection._run_query(
+                self._query, self._projection, self._sort, self._skip, self._limit
+            ))
+        return self._results
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._execute())
+
+    next = __next__
+
+    def close(self):
+        pass
+
+
+class MemoryCollection:
+    def __init__(self, storage: "MemoryStorage", name: str, database_name: str = "memory"):
+        self._storage = storage
+        self.name = name
+        self.full_name = f"{database_name}.{name}"
+        self._docs: Dict[Any, Dict] = {}
+        self._seq: Dict[Any, int] = {}
+        self._next_seq = 0
+        self._indexes: Dict[str, _Index] = {}
+        self._lock = threading.RLock()
+        self._last_expire = 0.0
+
+    # Compatibility helpers
+    def with_options(self, **kwargs):
+        return self
+
+    @property
+    def database(self):
+        return self._storage
+
+    # Indexes
+    def create_index(self, keys, unique: bool = False, name: Optional[str] = None,
+                     expireAfterSeconds: Optional[int] = None,
+                     partialFilterExpression: Optional[Dict] = None, **kwargs) -> str:
+        keys = _normalize_sort(keys, 1)
+        name = name or '_'.join(f"{field}_{direction}" for field, direction in keys)
+        with self._lock:
+            if name in self._indexes:
+                return name
+            index = _Index(name, keys, unique, expireAfterSeconds, partialFilterExpression)
+            for doc in self._docs.values():
+                index.check_unique(doc, self.full_name)
+                index.add(doc)
+            self._indexes[name] = index
+        return name
+
+    def create_indexes(self, models) -> List[str]:
+        return [self.create_index(m.document['key'], **{k: v for k, v in m.document.items()
+                                                          if k not in ('key',)}) for m in models]
+
+    def index_information(self) -> Dict:
+        with self._lock:
+            info = {'_id_': {'key': [('_id', 1)]}}
+            for name, index in self._indexes.items():
+                info[name] = {'key': index.keys, 'unique': index.unique}
+                if index.expire_after is not None:
+                    info[name]['expireAfterSeconds'] = index.expire_after
+            return info
+
+    def drop_index(self, name: str):
+        with self._lock:
+            self._indexes.pop(name, None)
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._seq.clear()
+            for index in self._indexes.values():
+                index.buckets.clear()
+                index.unique_keys.clear()
+
+    # Internals
+    def _expire(self):
+        # TTL indexes are enforced lazily, at most once per second like Mongo's TTL monitor (every 60s)
+        now = time.monotonic()
+        if now - self._last_expire < 1:
+            return
+        self._last_expire = now
+        for index in self._indexes.values():
+            if index.expire_after is None:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=index.expire_after)
+            expired = [d for d in self._docs.values()
+                       if isinstance(v := _get_path(d, index.fields[0]), datetime) and v < cutoff]
+            for doc in expired:
+                self._remove(doc)
+
+    def _candidates(self, query: Optional[Dict]) -> Iterable[Dict]:
+        """Narrow the scan using an index whose first field is matched by equality.
+
+        Documents are returned in insertion (natural) order.
+        """
+        if query:
+            for index in self._indexes.values():
+                if index.partial is not None:
+                    continue
+                condition = query.get(index.fields[0], _MISSING)
+                if condition is _MISSING:
+                    continue
+                if isinstance(condition, dict) and any(k.startswith('$') for k in condition):
+                    if set(condition) != {'$in'}:
+                        continue
+                    ids = set()
+                    for value in condition['$in']:
+                        ids |= index.buckets.get(_Index._hashable(value), set())
+                elif isinstance(condition, (list, re.Pattern)):
+                    continue
+                else:
+                    ids = index.buckets.get(_Index._hashable(condition), ())
+                return [self._docs[i] for i in sorted(ids, key=self._seq.__getitem__)]
+        return list(self._docs.values())
+
+    def _run_query(self, query, projection, sort, skip, limit) -> List[Dict]:
+        with self._lock:
+            self._expire()
+            docs = [d for d in self._candidates(query) if matches(d, query)]
+            if sort:
+                docs = _sorted(docs, sort)
+            if skip:
+                docs = docs[skip:]
+            if limit:
+                docs = docs[:limit]
+            return [_project(d, projection) for d in docs]
+
+    def _insert(self, doc: Dict):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        stored = _clone(doc)
+        if stored['_id'] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: _id_", 11000)
+        for index in self._indexes.values():
+            index.check_unique(stored, self.full_name)
+        for index in self._indexes.values():
+            index.add(stored)
+        self._docs[stored['_id']] = stored
+        self._seq[stored['_id']] = self._next_seq
+        self._next_seq += 1
+        return stored['_id']
+
+    def _remove(self, doc: Dict):
+        for index in self._indexes.values():
+            index.remove(doc)
+        self._docs.pop(doc['_id'], None)
+        self._seq.pop(doc['_id'], None)
+
+    def _replace(self, old: Dict, new: Dict):
+        for index in self._indexes.values():
+            index.remove(old)
+        try:
+            for index in self._indexes.values():
+                index.check_unique(new, self.full_name)
+        except DuplicateKeyError:
+            for index in self._indexes.values():
+                index.add(old)
+            raise
+        for index in self._indexes.values():
+            index.add(new)
+        self._docs[new['_id']] = new
+
+    def _first(self, query, sort=None) -> Optional[Dict]:
+        docs = [d for d in self._candidates(query) if matches(d, query)]
+        if not docs:
+            return None
+        if sort:
+            docs = _sorted(docs, _normalize_sort(sort))
+        return docs[0]
+
+    def _update(self, query, update, upsert, many) -> UpdateResult:
+        with self._lock:
+            self._expire()
+            targets = [d for d in self._candidates(query) if matches(d, query)]
+            if not many:
+                targets = targets[:1]
+            modified = 0
+            for doc in targets:
+                new = _clone(doc)
+                _apply_update(new, update)
+                if new != doc:
+                    self._replace(doc, new)
+                    modified += 1
+            upserted_id = None
+            if not targets and upsert:
+                new = _upsert_seed(query)
+                _apply_update(new, update, inserting=True)
+                upserted_id = self._insert(new)
+            return UpdateResult(
+                {'n': len(targets) or (1 if upserted_id is not None else 0),
+                 'nModified': modified, 'upserted': upserted_id},
+                True
+            )
+
+    # Reads
+    def find(self, filter: Optional[Dict] = None, projection=None, sort=None,
+             skip: int = 0, limit: int = 0, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, filter or {}, projection, sort, skip, limit)
+
+    def find_one(self, filter: Optional[Dict] = None, projection=None, sort=None, **kwargs) -> Optional[Dict]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        results = self._run_query(filter or {}, projection, _normalize_sort(sort), 0, 1)
+        return results[0] if results else None
+
+    def count_documents(self, filter: Optional[Dict] = None, **kwargs) -> int:
+        with self._lock:
+            self._expire()
+            if not filter:
+                return len(self._docs)
+            return sum(1 for d in self._candidates(filter) if matches(d, filter))
+
+    def estimated_document_count(self, **kwargs) -> int:
+        with self._lock:
+            return len(self._docs)
+
+    def distinct(self, key: str, filter: Optional[Dict] = None) -> List:
+        values = []
+        for doc in self._run_query(filter or {}, None, [], 0, 0):
+            value = _get_path(doc, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING and v not in values:
+                    values.append(v)
+        return values
+
+    def aggregate(self, pipeline: List[Dict], **kwargs) -> List[Dict]:
+        docs = None
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = self._run_query(arg, None, [], 0, 0) if docs is None \
+                    else [d for d in docs if matches(d, arg)]
+                continue
+            if docs is None:
+                docs = self._run_query({}, None, [], 0, 0)
+            docs = _aggregate_stage(docs, op, arg)
+        return docs if docs is not None else self._run_query({}, None, [], 0, 0)
+
+    # Writes
+    def insert_one(self, document: Dict, **kwargs) -> InsertOneResult:
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents: List[Dict], ordered: bool = True, **kwargs) -> InsertManyResult:
+        ids = []
+        with self._lock:
+            for document in documents:
+                ids.append(self._insert(document))
+        return InsertManyResult(ids, True)
+
+    def update_one(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        return self._update(filter, update, upsert, many=True)
+
+    def replace_one(self, filter: Dict, replacement: Dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        return self._update(filter, replacement, upsert, many=False)
+
+    def find_one_and_update(self, filter: Dict, update: Dict, projection=None, sort=None,
+                            upsert: bool = False, return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            self._expire()
+            doc = self._first(filter, sort)
+            if doc is None:
+                if not upsert:
+                    return None
+                new = _upsert_seed(filter)
+                _apply_update(new, update, inserting=True)
+                self._insert(new)
+                return _project(self._docs[new['_id']], projection) if return_document else None
+            new = _clone(doc)
+            _apply_update(new, update)
+            self._replace(doc, new)
+            return _project(new if return_document else doc, projection)
+
+    def find_one_and_delete(self, filter: Dict, projection=None, sort=None, **kwargs):
+        with self._lock:
+            doc = self._first(filter, sort)
+            if doc is None:
+                return None
+            self._remove(doc)
+            return _project(doc, projection)
+
+    def delete_one(self, filter: Dict, **kwargs) -> DeleteResult:
+        with self._lock:
+            doc = self._first(filter)
+            if doc is not None:
+                self._remove(doc)
+            return DeleteResult({'n': 1 if doc is not None else 0}, True)
+
+    def delete_many(self, filter: Dict, **kwargs) -> DeleteResult:
+        with self._lock:
+            targets = [d for d in self._candidates(filter) if matches(d, filter)]
+            for doc in targets:
+                self._remove(doc)
+            return DeleteResult({'n': len(targets)}, True)
+
+    def bulk_write(self, requests: List, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        counts = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0,
+                  'nUpserted': 0, 'upserted': [], 'writeErrors': []}
+        with self._lock:
+            for position, request in enumerate(requests):
+                try:
+                    self._bulk_operation(position, request, counts)
+                except DuplicateKeyError as e:
+                    # Reported like the server does: ordered writes stop at the first error
+                    counts['writeErrors'].append({'index': position, 'code': e.code, 'errmsg': str(e),
+                                                  'op': getattr(request, '_doc', None)})
+                    if ordered:
+                        break
+        if counts['writeErrors']:
+            raise BulkWriteError(counts)
+        return BulkWriteResult(counts, True)
+
+    def _bulk_operation(self, position: int, request, counts: Dict):
+        if isinstance(request, InsertOne):
+            self._insert(request._doc)
+            counts['nInserted'] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+            result = self._update(request._filter, request._doc, bool(request._upsert),
+                                  many=isinstance(request, UpdateMany))
+            if result.upserted_id is not None:
+                counts['nUpserted'] += 1
+                counts['upserted'].append({'index': position, '_id': result.upserted_id})
+            else:
+                counts['nMatched'] += result.matched_count
+            counts['nModified'] += result.modified_count
+        elif isinstance(request, DeleteOne):
+            counts['nRemoved'] += self.delete_one(request._filter).deleted_count
+        elif isinstance(request, DeleteMany):
+            counts['nRemoved'] += self.delete_many(request._filter).deleted_count
+        else:
+            raise OperationFailure(f"Operazione bulk non supportata: {type(request).__name__}")
+
+
+def _group_key(doc: Dict, spec):
+    if isinstance(spec, str) and spec.startswith('$'):
+        value = _get_path(doc, spec[1:])
+        return None if value is _MISSING else value
+    if isinstance(spec, dict):
+        return tuple((k, _group_key(doc, v)) for k, v in spec.items())
+    return spec
+
+
+def _expression(doc: Dict, expr):
+    if isinstance(expr, str) and expr.startswith('$'):
+        value = _get_path(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, dict) and len(expr) == 1:
+        (op, arg), = expr.items()
+        if op == '$size':
+            value = _expression(doc, arg)
+            return len(value) if isinstance(value, list) else 0
+        if op == '$strLenCP':
+            value = _expression(doc, arg)
+            return len(value) if isinstance(value, str) else 0
+        if op == '$ifNull':
+            value = _expression(doc, arg[0])
+            return _expression(doc, arg[1]) if value is None else value
+    return expr
+
+
+def _aggregate_stage(docs: List[Dict], op: str, arg) -> List[Dict]:
+    if op == '$sort':
+        return _sorted(docs, _normalize_sort(arg))
+    if op == '$limit':
+        return docs[:arg]
+    if op == '$skip':
+        return docs[arg:]
+    if op == '$project':
+        computed = {k: v for k, v in arg.items() if not isinstance(v, (int, bool))}
+        flags = {k: v for k, v in arg.items() if isinstance(v, (int, bool))}
+        inclusion = bool(computed) or any(v for k, v in flags.items() if k != '_id')
+        projected = []
+        for doc in docs:
+            if inclusion:
+                result = _project(doc, {k: 1 for k, v in flags.items() if v and k != '_id'} or {'_id': 1})
+                if flags.get('_id', 1) and '_id' in doc:
+                    result['_id'] = doc['_id']
+                else:
+                    result.pop('_id', None)
+                result.update({k: _expression(doc, v) for k, v in computed.items()})
+            else:
+                result = _project(doc, flags)
+            projected.append(result)
+        return projected
+    if op == '$count':
+        return [{arg: len(docs)}] if docs else []
+    if op == '$group':
+        groups: Dict[Any, Dict] = {}
+        for doc in docs:
+            key = _group_key(doc, arg['_id'])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {'_id': dict(key) if isinstance(arg['_id'], dict) else key}
+                for field, accumulator in arg.items():
+                    if field != '_id':
+                        (acc, _), = accumulator.items()
+                        group[field] = [] if acc in ('$push', '$addToSet', '$avg') else _MISSING
+            for field, accumulator in arg.items():
+                if field == '_id':
+                    continue
+                (acc, expr), = accumulator.items()
+                value = _expression(doc, expr)
+                current = group[field]
+                if acc == '$sum':
+                    group[field] = (0 if current is _MISSING else current) + (value if isinstance(value, (int, float)) else 0)
+                elif acc == '$first':
+                    if current is _MISSING:
+                        group[field] = value
+                elif acc == '$last':
+                    group[field] = value
+                elif acc in ('$min', '$max'):
+                    cmp = _compare(value, current)
+                    if current is _MISSING or (cmp is not None and (cmp < 0 if acc == '$min' else cmp > 0)):
+                        group[field] = value
+                elif acc in ('$push', '$avg'):
+                    current.append(value)
+                elif acc == '$addToSet':
+                    if value not in current:
+                        current.append(value)
+                else:
+                    raise OperationFailure(f"Accumulatore non supportato: {acc}")
+        results = []
+        for group in groups.values():
+            for field, accumulator in arg.items():
+                if field == '_id':
+                    continue
+                (acc, _), = accumulator.items()
+                if acc == '$avg':
+                    values = [v for v in group[field] if isinstance(v, (int, float))]
+                    group[field] = sum(values) / len(values) if values else None
+                elif group[field] is _MISSING:
+                    group[field] = None
+            results.append(group)
+        return results
+    raise OperationFailure(f"Stage di aggregazione non supportato dal motore in memoria: {op}")
+
+
+class MemoryStorage(Storage):
+    """Process-local storage; each worker process has its own independent data"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._collections: Dict[Tuple[str, str], MemoryCollection] = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str, read: bool = False) -> MemoryCollection:
+        key = (tenancy.database_name(), name)
+        collection = self._collections.get(key)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.setdefault(key, MemoryCollection(self, name, key[0]))
+        return collection
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self.collection(name)
+
+    def list_collection_names(self) -> List[str]:
+        database_name = tenancy.database_name()
+        return [name for db, name in self._collections if db == database_name]
+
+    def ping(self):
+        pass
+
+    def stats(self) -> Dict:
+        database_name = tenancy.database_name()
+        return {
+            "collections": {name: c.estimated_document_count()
+                            for (db, name), c in self._collections.items() if db == database_name}
+        }
+
+
+_BACKENDS = {"mongo": MongoStorage, "memory": MemoryStorage}
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                backend = _BACKENDS.get(STORAGE_BACKEND)
+                if backend is None:
+                    raise RuntimeError(f"STORAGE_BACKEND non valido: {STORAGE_BACKEND}")
+                _storage = backend()
+                logger.info(f"Storage backend: {_storage.name}")
+    return _storage
+
+
+def set_storage(storage: Optional[Storage]):
+    """Replace the active backend (tests and benchmarks use a fresh ``MemoryStorage``)"""
+    global _storage
+    with _storage_lock:
+        _storage = storage
+
+
+class LazyCollection:
+    """Collection proxy resolved against the active storage backend on every use"""
+
+    def __init__(self, name: str, read: bool = False):
+        self.name = name
+        self.read = read
+
+    def resolve(self):
+        """The collection of the current tenant (see tenancy.py)"""
+        return get_storage().collection(self.name, self.read)
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r}, read={self.read})"
@@ -0,0 +1,85 @@
+"""Delta sync support.
+
+Candidates, campaigns and programs carry an indexed ``updated_at`` that every
+write path bumps. ``GET /api/sync?since=`` returns the records whose
+``updated_at`` is not older than ``since`` and the ids deleted since then, so a
+client can keep a local copy and refresh it with small payloads.
+
+Deletions are recorded as tombstones in the ``tombstones`` collection, kept
+for ``SYNC_TOMBSTONE_DAYS``. A client whose ``since`` is older than that
+cannot know what was deleted in between and gets a full resync (``full``).
+
+The returned ``next_since`` lags the server clock by ``SYNC_OVERLAP_S``, so
+writes stamped just before a sync but committed just after it (clock skew
+between workers, batched writes) are picked up by the next one. Clients must
+therefore upsert by ``id``: a record can be returned more than once.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, InsertOne, UpdateOne
+
+SYNC_OVERLAP_S = float(os.environ.get('SYNC_OVERLAP_S', '5'))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', '30'))
+SYNC_MAX_ITEMS = int(os.environ.get('SYNC_MAX_ITEMS', '1000'))
+
+SYNCED_COLLECTIONS = ("candidates", "campaigns", "programs")
+
+
+def ensure_sync_indexes(collections: Dict, tombstones):
+    for collection in collections.values():
+        collection.create_index("updated_at")
+    tombstones.create_index([("collection", ASCENDING), ("deleted_at", ASCENDING)])
+    tombstones.create_index("deleted_at", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
+
+
+def backfill_updated_at(collection, batch_size: int = 500) -> int:
+    """Stamp documents written before delta sync with their creation time"""
+    operations = []
+    updated = 0
+    for doc in collection.find({"updated_at": {"$exists": False}}, {"_id": 1, "created_at": 1}):
+        operations.append(UpdateOne(
+            {"_id": doc["_id"]}, {"$set": {"updated_at": doc.get("created_at") or datetime.utcnow()}}
+        ))
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+def record_deletions(tombstones, collection_name: str, ids: Iterable[str]):
+    """Call whenever candidates, campaigns or programs are removed"""
+    now = datetime.utcnow()
+    operations = [InsertOne({"collection": collection_name, "id": id, "deleted_at": now}) for id in ids]
+    if operations:
+        tombstones.bulk_write(operations, ordered=False)
+
+
+def needs_full_sync(since: Optional[datetime]) -> bool:
+    return since is None or since < datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)
+
+
+def changed(collection, since: Optional[datetime], query: Dict, limit: int = SYNC_MAX_ITEMS) -> List[Dict]:
+    """Documents changed since ``since`` (all of them when None), oldest change first"""
+    query = dict(query)
+    if since is not None:
+        query["updated_at"] = {"$gte": since}
+    cursor = collection.find(query, {"_id": 0, "events": 0, "materials": 0}) \
+        .sort([("updated_at", ASCENDING), ("id", ASCENDING)])
+    return list(cursor.limit(limit + 1))
+
+
+def deleted(tombstones, since: datetime) -> Dict[str, List[str]]:
+    result = {name: [] for name in SYNCED_COLLECTIONS}
+    for tombstone in tombstones.find({"deleted_at": {"$gte": since}}, {"_id": 0, "collection": 1, "id": 1}):
+        result.setdefault(tombstone["collection"], []).append(tombstone["id"])
+    return result
+
+
+def next_since(now: datetime, truncated_at: List[datetime]) -> datetime:
+    """Where the next sync should resume: before the first truncated page ended, with overlap"""
+    resume = now - timedelta(seconds=SYNC_OVERLAP_S)
+    return min([resume] + truncated_at)
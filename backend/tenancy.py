@@ -0,0 +1,308 @@
+"""Multi-school tenancy.
+
+Every school (tenant) gets its own database on the same cluster: the default
+tenant keeps ``DB_NAME``, any other uses ``{DB_NAME}_{tenant}``. Collections,
+indexes, TTLs and migrations are therefore separate per school while all
+tenants share the one Mongo client (and its connection pool) of the worker.
+
+The tenant of a request comes from the ``TENANT_HEADER`` header (``X-Tenant``
+by default); requests without it belong to ``DEFAULT_TENANT``. Only tenants
+listed in ``TENANTS`` are accepted, an empty list means single-school mode;
+names that map to the same database (``liceo-fermi`` and ``liceo_fermi``)
+are refused at startup. ``TenantMiddleware`` stores the tenant in a context variable that storage
+resolution (``LazyCollection``) and in-memory caches read, so endpoint code
+is unchanged.
+
+Per tenant, the middleware also:
+
+- prepares its database (indexes, migrations) on the first request seen by
+  the worker;
+- counts requests, errors and latency, exposed by ``metrics()``.
+
+In multi-school mode ``TenantAdmissionMiddleware`` also caps the concurrent
+requests of a school at ``TENANT_MAX_IN_FLIGHT`` (by default three quarters
+of ``MAX_IN_FLIGHT``), so one school cannot take every slot of a shared
+worker. It runs inside the worker-wide admission of ratelimit.py, so only
+requests already holding a worker slot take a school slot, and like it a
+request waits up to ``TENANT_ADMISSION_TIMEOUT_MS`` before being shed with
+503. Health probes are never capped.
+
+``TENANT_QUOTAS`` limits documents per collection, e.g.::
+
+    TENANT_QUOTAS="candidates=200,programs=2000,campaigns=1000;liceo-fermi:candidates=400"
+
+Unprefixed entries apply to every tenant, ``<tenant>:`` entries override them.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from database import DB_NAME
+from ratelimit import ADMISSION_TIMEOUT_MS, EXEMPT_PATHS, MAX_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+TENANTS = tuple(t.strip() for t in os.environ.get('TENANTS', '').split(',') if t.strip())
+TENANT_HEADER = os.environ.get('TENANT_HEADER', 'X-Tenant').lower().encode('latin-1')
+TENANT_MAX_IN_FLIGHT = int(os.environ.get('TENANT_MAX_IN_FLIGHT', str(MAX_IN_FLIGHT * 3 // 4)))
+TENANT_ADMISSION_TIMEOUT_MS = int(os.environ.get('TENANT_ADMISSION_TIMEOUT_MS', str(ADMISSION_TIMEOUT_MS)))
+TENANT_QUOTAS = os.environ.get('TENANT_QUOTAS', '')
+
+# Tenant names end up in database names (at most 64 characters)
+_VALID_TENANT = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+
+_current = contextvars.ContextVar('tenant', default=DEFAULT_TENANT)
+
+
+def current() -> str:
+    return _current.get()
+
+
+def database_name(tenant: Optional[str] = None) -> str:
+    tenant = tenant or current()
+    if tenant == DEFAULT_TENANT:
+        return DB_NAME
+    return f"{DB_NAME}_{tenant.replace('-', '_')}"
+
+
+def is_known(tenant: str) -> bool:
+    return tenant == DEFAULT_TENANT or (tenant in TENANTS and bool(_VALID_TENANT.match(tenant)))
+
+
+def check_tenants(tenants=TENANTS):
+    """Refuse invalid tenant names and names that would share a database"""
+    databases = {database_name(DEFAULT_TENANT): DEFAULT_TENANT}
+    for tenant in tenants:
+        if tenant != DEFAULT_TENANT and not _VALID_TENANT.match(tenant):
+            raise RuntimeError(f"Nome di tenant non valido in TENANTS: {tenant}")
+        other = databases.setdefault(database_name(tenant), tenant)
+        if other != tenant:
+            raise RuntimeError(f"I tenant {other} e {tenant} userebbero lo stesso database")
+
+
+check_tenants()
+
+
+@contextlib.contextmanager
+def use(tenant: str):
+    """Run a block (startup tasks, CLI commands) on behalf of ``tenant``"""
+    token = _current.set(tenant)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def scoped(key: str) -> str:
+    """Cache key local to the current tenant"""
+    return f"{current()}/{key}"
+
+
+def parse_quotas(spec: str) -> Dict[str, Dict[str, int]]:
+    """``{tenant or "*": {collection: max documents}}``"""
+    quotas: Dict[str, Dict[str, int]] = defaultdict(dict)
+    for group in filter(None, (part.strip() for part in spec.split(';'))):
+        tenant, _, limits = group.rpartition(':')
+        for item in filter(None, (part.strip() for part in limits.split(','))):
+            name, _, value = item.partition('=')
+            quotas[tenant.strip() or '*'][name.strip()] = int(value)
+    return dict(quotas)
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, collection: str, limit: int):
+        super().__init__(f"Quota di {limit} documenti raggiunta per {collection}")
+        self.collection = collection
+        self.limit = limit
+
+
+class Quotas:
+    def __init__(self, spec: str = TENANT_QUOTAS):
+        self.limits = parse_quotas(spec)
+
+    def limit(self, collection: str, tenant: Optional[str] = None) -> Optional[int]:
+        tenant = tenant or current()
+        return self.limits.get(tenant, {}).get(collection, self.limits.get('*', {}).get(collection))
+
+    def check(self, collection):
+        """Raise ``QuotaExceeded`` when the current tenant cannot add a document to ``collection``"""
+        limit = self.limit(collection.name)
+        if limit is not None and collection.count_documents({}) >= limit:
+            raise QuotaExceeded(collection.name, limit)
+
+    def usage(self, collections) -> Dict[str, Dict]:
+        return {
+            c.name: {"documents": c.estimated_document_count(), "limit": self.limit(c.name)}
+            for c in collections
+        }
+
+
+class _TenantMetrics:
+    __slots__ = ('requests', 'errors', 'rejected', 'in_flight', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "avg_ms": round(self.total_ms / self.requests, 2) if self.requests else 0.0,
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+class TenantRegistry:
+    """Per-worker state of the tenants served: prepared databases and metrics"""
+
+    def __init__(self, setup: Optional[Callable[[], None]] = None, max_in_flight: int = TENANT_MAX_IN_FLIGHT,
+                 admission_timeout_ms: int = TENANT_ADMISSION_TIMEOUT_MS):
+        self.setup = setup
+        self.max_in_flight = max_in_flight
+        self.admission_timeout = admission_timeout_ms / 1000
+        self._metrics: Dict[str, _TenantMetrics] = defaultdict(_TenantMetrics)
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._ready = set()
+        self._setup_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._lock = threading.Lock()
+
+    def mark_ready(self, tenant: str):
+        self._ready.add(tenant)
+
+    async def prepare(self, tenant: str):
+        """Run ``setup`` (indexes, migrations) for ``tenant`` once per worker"""
+        if tenant in self._ready or self.setup is None:
+            return
+        async with self._setup_locks[tenant]:
+            if tenant not in self._ready:
+                await run_in_threadpool(self.setup)
+                self._ready.add(tenant)
+                logger.info(f"Database del tenant {tenant} pronto ({database_name(tenant)})")
+
+    async def admit(self, tenant: str) -> bool:
+        """Take one of the tenant's slots, waiting up to ``admission_timeout`` (multi-school mode only)"""
+        if self.max_in_flight and TENANTS:
+            slots = self._slots.get(tenant)
+            if slots is None:
+                slots = self._slots.setdefault(tenant, asyncio.Semaphore(self.max_in_flight))
+            try:
+                await asyncio.wait_for(slots.acquire(), self.admission_timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._metrics[tenant].rejected += 1
+                return False
+        with self._lock:
+            self._metrics[tenant].in_flight += 1
+        return True
+
+    def release(self, tenant: str):
+        with self._lock:
+            self._metrics[tenant].in_flight -= 1
+        slots = self._slots.get(tenant)
+        if slots is not None:
+            slots.release()
+
+    def done(self, tenant: str, elapsed_ms: float, status: int):
+        with self._lock:
+            metrics = self._metrics[tenant]
+            metrics.requests += 1
+            metrics.errors += status >= 500
+            metrics.total_ms += elapsed_ms
+            metrics.max_ms = max(metrics.max_ms, elapsed_ms)
+
+    def metrics(self, tenant: Optional[str] = None) -> Dict:
+        with self._lock:
+            return self._metrics[tenant or current()].to_dict()
+
+    def reset(self):
+        """Forget metrics and prepared databases (tests swap the storage under the registry)"""
+        with self._lock:
+            self._metrics.clear()
+            self._slots.clear()
+            self._ready.clear()
+
+
+class TenantMiddleware:
+    def __init__(self, app, registry: TenantRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        tenant = DEFAULT_TENANT
+        for name, value in scope.get("headers", []):
+            if name == TENANT_HEADER:
+                tenant = value.decode("latin-1").strip().lower() or DEFAULT_TENANT
+                break
+        if not is_known(tenant):
+            await _reject(send, 404, "Scuola non trovata")
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _current.set(tenant)
+        try:
+            await self.registry.prepare(tenant)
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self.registry.done(tenant, (time.perf_counter() - started) * 1000, status)
+
+
+class TenantAdmissionMiddleware:
+    """Per-school cap on concurrent requests; goes inside ``RateLimitMiddleware``"""
+
+    def __init__(self, app, registry: TenantRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        tenant = current()
+        if not await self.registry.admit(tenant):
+            await _reject(send, 503, "Troppe richieste in corso per questa scuola, riprova tra poco")
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.registry.release(tenant)
+
+
+async def _reject(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
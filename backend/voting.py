@@ -0,0 +1,205 @@
+"""Elections, one vote per user, and a live tally.
+
+Votes are stored in ``votes`` with a unique ``(election_id, user_id)``
+index, so a second vote from the same user fails at the database whatever
+worker handles it. Per-candidate totals are kept in ``vote_counters`` split
+over ``VOTE_COUNTER_SHARDS`` documents per candidate: each vote increments a
+random shard, so thousands of votes per minute for the same candidate do not
+all contend for one document.
+
+Each worker serves results from an in-memory tally: the shard sums read at
+most every ``VOTE_TALLY_REFRESH_S`` plus the votes it accepted since. Votes
+taken by other workers therefore show up within one refresh interval. When
+an election is closed the final result is recounted from ``votes`` cast
+before ``closed_at`` and stored on the election, so closed results are exact.
+
+Workers check the election status against a copy cached for
+``ELECTION_CACHE_S``, so a vote may still be written after the close. Right
+after its insert each vote re-reads the status: a vote cast after
+``closed_at`` is deleted and refused, one cast before it but written after
+the final recount recounts the results again, so it is never stored
+without being counted.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+import tenancy
+
+logger = logging.getLogger(__name__)
+
+VOTE_COUNTER_SHARDS = int(os.environ.get('VOTE_COUNTER_SHARDS', '16'))
+VOTE_TALLY_REFRESH_S = float(os.environ.get('VOTE_TALLY_REFRESH_S', '1'))
+VOTER_ROLES = tuple(r.strip() for r in os.environ.get('VOTER_ROLES', 'visitor,candidate,grafico').split(',')
+                    if r.strip())
+# Election documents (status, candidates) are re-read at most this often per worker
+ELECTION_CACHE_S = float(os.environ.get('ELECTION_CACHE_S', '2'))
+
+ELECTION_OPEN = 'open'
+ELECTION_CLOSED = 'closed'
+
+
+class AlreadyVoted(Exception):
+    pass
+
+
+class ElectionClosed(Exception):
+    pass
+
+
+class _LiveTally:
+    __slots__ = ('base', 'local', 'refreshed_at', 'lock')
+
+    def __init__(self):
+        self.base = Counter()
+        self.local = Counter()
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+
+class VotingService:
+    def __init__(self, elections, votes, counters, shards: int = VOTE_COUNTER_SHARDS,
+                 refresh_s: float = VOTE_TALLY_REFRESH_S):
+        self.elections = elections
+        self.votes = votes
+        self.counters = counters
+        self.shards = shards
+        self.refresh_s = refresh_s
+        # Keyed by (tenant, election id)
+        self._tallies: Dict[tuple, _LiveTally] = {}
+        self._election_cache: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.elections.create_index("id", unique=True)
+        self.votes.create_index([("election_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+        self.votes.create_index([("election_id", ASCENDING), ("candidate_id", ASCENDING)])
+        self.counters.create_index("election_id")
+
+    def election(self, election_id: str, fresh: bool = False) -> Optional[Dict]:
+        now = time.monotonic()
+        key = (tenancy.current(), election_id)
+        cached = self._election_cache.get(key)
+        if not fresh and cached and now - cached[0] < ELECTION_CACHE_S:
+            return cached[1]
+        election = self.elections.find_one({"id": election_id}, {"_id": 0})
+        self._election_cache[key] = (now, election)
+        return election
+
+    def forget(self, election_id: str):
+        key = (tenancy.current(), election_id)
+        self._election_cache.pop(key, None)
+        with self._lock:
+            self._tallies.pop(key, None)
+
+    def cast(self, election: Dict, user_id: str, candidate_id: str) -> Dict:
+        vote = {
+            "election_id": election['id'],
+            "user_id": user_id,
+            "candidate_id": candidate_id,
+            "cast_at": datetime.utcnow(),
+        }
+        try:
+            self.votes.insert_one(vote)
+        except DuplicateKeyError:
+            raise AlreadyVoted()
+        current = self.elections.find_one({"id": election['id']}, {"_id": 0, "status": 1, "closed_at": 1})
+        if current and current.get('status') == ELECTION_CLOSED:
+            # Accepted against a stale cached copy of the election
+            if vote['cast_at'] >= current['closed_at']:
+                self.votes.delete_one({"_id": vote['_id']})
+                raise ElectionClosed()
+            self._finalize(election, current['closed_at'])
+        shard = random.randrange(self.shards)
+        self.counters.update_one(
+            {"_id": f"{election['id']}:{candidate_id}:{shard}"},
+            {"$inc": {"count": 1},
+             "$setOnInsert": {"election_id": election['id'], "candidate_id": candidate_id, "shard": shard}},
+            upsert=True,
+        )
+        tally = self._tally(election['id'])
+        with tally.lock:
+            tally.local[candidate_id] += 1
+        vote.pop('_id', None)
+        return vote
+
+    def _tally(self, election_id: str) -> _LiveTally:
+        key = (tenancy.current(), election_id)
+        with self._lock:
+            tally = self._tallies.get(key)
+            if tally is None:
+                tally = self._tallies[key] = _LiveTally()
+            return tally
+
+    def _shard_sums(self, election_id: str) -> Counter:
+        pipeline = [
+            {"$match": {"election_id": election_id}},
+            {"$group": {"_id": "$candidate_id", "count": {"$sum": "$count"}}},
+        ]
+        return Counter({doc['_id']: doc['count'] for doc in self.counters.aggregate(pipeline)})
+
+    def live_counts(self, election_id: str) -> Counter:
+        tally = self._tally(election_id)
+        if time.monotonic() - tally.refreshed_at >= self.refresh_s:
+            with tally.lock:
+                # Votes accepted from here on are not guaranteed to be in the sums read below
+                tally.local = Counter()
+                tally.refreshed_at = time.monotonic()
+            base = self._shard_sums(election_id)
+            with tally.lock:
+                tally.base = base
+        with tally.lock:
+            return tally.base + tally.local
+
+    def recount(self, election_id: str, before: Optional[datetime] = None) -> Counter:
+        match = {"election_id": election_id}
+        if before is not None:
+            match["cast_at"] = {"$lt": before}
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": "$candidate_id", "count": {"$sum": 1}}},
+        ]
+        return Counter({doc['_id']: doc['count'] for doc in self.votes.aggregate(pipeline)})
+
+    def close(self, election: Dict) -> Dict:
+        closed_at = datetime.utcnow()
+        self.elections.update_one(
+            {"id": election['id']},
+            {"$set": {"status": ELECTION_CLOSED, "closed_at": closed_at, "updated_at": closed_at}}
+        )
+        results = self._finalize(election, closed_at)
+        if results['total_votes'] != sum(self._shard_sums(election['id']).values()):
+            logger.warning(f"Elezione {election['id']}: contatori non allineati ai voti, usato il riconteggio")
+        self.forget(election['id'])
+        return results
+
+    def _finalize(self, election: Dict, closed_at: datetime) -> Dict:
+        """Recount the votes cast before ``closed_at`` and store the result unless a larger one is there"""
+        results = self._results(election, self.recount(election['id'], before=closed_at))
+        # Later recounts only ever see more votes: never overwrite one with a smaller total
+        self.elections.update_one(
+            {"id": election['id'], "$or": [{"results": {"$exists": False}},
+                                           {"results.total_votes": {"$lt": results['total_votes']}}]},
+            {"$set": {"results": results}},
+        )
+        return results
+
+    def results(self, election: Dict) -> Dict:
+        if election.get('status') == ELECTION_CLOSED and election.get('results'):
+            return dict(election['results'], final=True)
+        return dict(self._results(election, self.live_counts(election['id'])), final=False)
+
+    @staticmethod
+    def _results(election: Dict, counts: Counter) -> Dict:
+        candidate_ids: List[str] = election.get('candidate_ids') or sorted(counts)
+        tally = [{"candidate_id": c, "votes": counts.get(c, 0)} for c in candidate_ids]
+        tally.sort(key=lambda entry: entry['votes'], reverse=True)
+        return {"total_votes": sum(counts.values()), "tally": tally}
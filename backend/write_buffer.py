@@ -0,0 +1,227 @@
+"""Write batching for high-frequency campaign writes.
+
+Inserts and updates submitted through the buffer are coalesced into one
+``bulk_write`` per collection, flushed when ``WRITE_BATCH_SIZE`` operations
+are pending or ``WRITE_BATCH_DELAY_MS`` after the first one, whichever comes
+first. ``WRITE_DURABILITY`` selects the acknowledgement semantics:
+
+- ``immediate`` (default): no buffering, one acknowledged write per call
+- ``group``: group commit; the caller waits until its batch is acknowledged
+  by the database, so a successful response is as durable as before
+- ``buffered``: write-behind; the caller returns once the write is queued.
+  Up to one batch window of writes can be lost if the worker crashes, and a
+  write the database rejects is only logged and counted (``lost`` and
+  ``last_error`` in ``stats()``).
+
+Each batch is an ordered ``bulk_write``, so writes to a collection are
+applied in submission order (an insert before the update of the same
+document). A rejected write does not stop the rest of its batch: the writes
+after it are sent again.
+
+Read-your-writes: in ``buffered`` mode a writer's pending operations are
+flushed before that writer reads the same collections
+(``await write_buffer.sync_writer(...)``). Other workers only see the writes
+once flushed; deployments that need cross-worker read-your-writes should use
+``group``.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import tenancy
+from storage import LazyCollection
+
+logger = logging.getLogger(__name__)
+
+WRITE_DURABILITY = os.environ.get('WRITE_DURABILITY', 'immediate')
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '100'))
+WRITE_BATCH_DELAY_MS = float(os.environ.get('WRITE_BATCH_DELAY_MS', '10'))
+
+MODES = ('immediate', 'group', 'buffered')
+
+
+class _PendingWrite:
+    __slots__ = ('collection', 'operation', 'writer', 'future')
+
+    def __init__(self, collection, operation, writer: Optional[str], future: Optional[asyncio.Future]):
+        self.collection = collection
+        self.operation = operation
+        self.writer = writer
+        self.future = future
+
+
+class WriteBuffer:
+    def __init__(self, mode: str = WRITE_DURABILITY, max_batch: int = WRITE_BATCH_SIZE,
+                 max_delay_ms: float = WRITE_BATCH_DELAY_MS):
+        if mode not in MODES:
+            raise ValueError(f"WRITE_DURABILITY non valida: {mode} (valori ammessi: {', '.join(MODES)})")
+        self.mode = mode
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._pending: List[_PendingWrite] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.metrics = defaultdict(float)
+        self.last_error: Optional[str] = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Primitives belong to the loop that created them (tests run one loop per client)
+            self._loop = loop
+            self._flush_lock = asyncio.Lock()
+            self._timer = None
+
+    async def insert(self, collection, document: Dict, writer: Optional[str] = None):
+        if self.mode == 'immediate':
+            collection.insert_one(document)
+            return
+        # Copy: the driver adds _id to the document while the caller may still be serializing it
+        await self._submit(collection, InsertOne(dict(document)), writer)
+
+    async def insert_many(self, collection, documents: List[Dict], writer: Optional[str] = None):
+        if not documents:
+            return
+        if self.mode == 'immediate':
+            collection.insert_many(documents)
+            return
+        await asyncio.gather(*(self._submit(collection, InsertOne(dict(d)), writer) for d in documents))
+
+    async def update(self, collection, filter: Dict, update: Dict, upsert: bool = False,
+                     writer: Optional[str] = None):
+        if self.mode == 'immediate':
+            collection.update_one(filter, update, upsert=upsert)
+            return
+        await self._submit(collection, UpdateOne(filter, update, upsert=upsert), writer)
+
+    async def _submit(self, collection, operation, writer: Optional[str]):
+        self._bind_loop()
+        if isinstance(collection, LazyCollection):
+            # Pin the current tenant's collection: the flush runs outside this request
+            collection = collection.resolve()
+        future = self._loop.create_future() if self.mode == 'group' else None
+        self._pending.append(_PendingWrite(collection, operation, writer, future))
+        self.metrics["submitted"] += 1
+
+        if len(self._pending) >= self.max_batch:
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.max_delay, self._spawn_flush)
+
+        if future is not None:
+            await future
+
+    def _spawn_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = self._loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Write out everything pending, in submission order, one bulk_write per collection"""
+        if self._loop is None:
+            return
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            by_collection: Dict[str, List[_PendingWrite]] = {}
+            for write in batch:
+                by_collection.setdefault(write.collection.full_name, []).append(write)
+
+            start = time.perf_counter()
+            for writes in by_collection.values():
+                await self._write(writes)
+            self.metrics["batches"] += 1
+            self.metrics["operations"] += len(batch)
+            self.metrics["flush_seconds"] += time.perf_counter() - start
+            self.metrics["max_batch"] = max(self.metrics["max_batch"], len(batch))
+
+    async def _write(self, writes: List[_PendingWrite]):
+        collection = writes[0].collection
+        operations = [w.operation for w in writes]
+        failed: Dict[int, Exception] = {}
+        offset = 0
+        while offset < len(operations):
+            try:
+                await run_in_threadpool(collection.bulk_write, operations[offset:], ordered=True)
+                break
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors') or [{'index': 0, 'errmsg': str(e)}]
+                # Ordered: the first error stopped the batch, resume right after it
+                index = offset + errors[0]['index']
+                failed[index] = BulkWriteError({'writeErrors': [errors[0]]})
+                offset = index + 1
+            except Exception as e:
+                failed.update({n: e for n in range(offset, len(operations))})
+                break
+
+        for n, write in enumerate(writes):
+            error = failed.get(n)
+            if error is not None:
+                self.metrics["errors"] += 1
+                if write.future is None:
+                    self.metrics["lost"] += 1
+                    self.last_error = f"{collection.name}: {error}"
+                    logger.error(f"Scrittura differita fallita su {collection.name}: {error}")
+            if write.future is not None and not write.future.done():
+                if error is not None:
+                    write.future.set_exception(error)
+                else:
+                    write.future.set_result(None)
+
+    def has_pending(self, writer: Optional[str], collections: List[str]) -> bool:
+        database_name = tenancy.database_name()
+        targets = {f"{database_name}.{name}" for name in collections}
+        return any(w.writer == writer and w.collection.full_name in targets for w in self._pending)
+
+    async def sync_writer(self, writer: Optional[str], *collections: str):
+        """Flush before ``writer`` reads ``collections`` if it still has writes queued on them"""
+        if self.mode != 'buffered' or self._flush_lock is None:
+            return
+        # A flush in progress may still be carrying this writer's operations
+        if self._flush_lock.locked() or self.has_pending(writer, collections):
+            self.metrics["read_your_writes_flushes"] += 1
+            await self.flush()
+
+    async def close(self):
+        """Drain pending writes (called on shutdown)"""
+        if self._pending:
+            await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        batches = self.metrics["batches"]
+        return {
+            "mode": self.mode,
+            "max_batch": self.max_batch,
+            "max_delay_ms": self.max_delay * 1000,
+            "pending": len(self._pending),
+            "submitted": int(self.metrics["submitted"]),
+            "batches": int(batches),
+            "operations": int(self.metrics["operations"]),
+            "avg_batch_size": round(self.metrics["operations"] / batches, 2) if batches else 0,
+            "largest_batch": int(self.metrics["max_batch"]),
+            "avg_flush_ms": round(self.metrics["flush_seconds"] * 1000 / batches, 3) if batches else 0,
+            "errors": int(self.metrics["errors"]),
+            "lost": int(self.metrics["lost"]),
+            "last_error": self.last_error,
+            "read_your_writes_flushes": int(self.metrics["read_your_writes_flushes"]),
+        }
+
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+In-process API benchmark against the in-memory storage engine.
+
+Requests go through the full ASGI stack (middleware, routing, validation,
+serialization) via httpx's ASGI transport, with no network or database.
+
+    python benchmarks/api_inprocess.py --candidates 500 --requests 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+os.environ["STORAGE_BACKEND"] = "memory"
+# A single benchmark client would exhaust its per-client budget at once
+os.environ["RATE_LIMITS"] = ""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+from storage import MemoryStorage, set_storage  # noqa: E402
+
+
+async def seed(client, candidates):
+    ids = []
+    for n in range(candidates):
+        response = await client.post("/api/candidates", json={
+            "user_id": f"user-{n}", "name": f"Candidato {n}", "class_year": f"{n % 5 + 1}A",
+            "description": "Per una scuola più aperta, digitale e sostenibile. " * 5,
+        })
+        candidate_id = response.json()["candidate"]["id"]
+        ids.append(candidate_id)
+        await client.post("/api/campaigns", json={
+            "candidate_id": candidate_id, "title": f"Campagna {n}", "description": "Campagna",
+            "status": "active" if n % 2 else "draft",
+            "events": [{"name": "Assemblea", "date": "2030-03-15"}],
+        })
+        await client.post("/api/programs", json={
+            "candidate_id": candidate_id, "title": f"Programma {n}", "content": "Proposta\n" * 200,
+        })
+    return ids
+
+
+async def measure(client, name, method, path_for, requests, **kwargs):
+    samples = []
+    start = time.perf_counter()
+    for n in range(requests):
+        t = time.perf_counter()
+        response = await client.request(method, path_for(n), **kwargs)
+        samples.append(time.perf_counter() - t)
+        assert response.status_code == 200, response.text
+    elapsed = time.perf_counter() - start
+    samples.sort()
+    print(f"{name:<28} {requests / elapsed:9.0f} req/s   "
+          f"p50 {statistics.median(samples) * 1000:7.2f} ms   "
+          f"p95 {samples[int(len(samples) * 0.95) - 1] * 1000:7.2f} ms")
+
+
+async def main(args):
+    set_storage(MemoryStorage())
+    async with server.lifespan(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            t = time.perf_counter()
+            ids = await seed(client, args.candidates)
+            print(f"Seed di {args.candidates} candidati: {(time.perf_counter() - t) * 1000:.0f} ms")
+
+            await measure(client, "GET /api/candidates", "GET", lambda n: "/api/candidates", args.requests)
+            await measure(client, "GET /api/candidates/{id}", "GET",
+                          lambda n: f"/api/candidates/{ids[n % len(ids)]}", args.requests)
+            await measure(client, "GET /api/campaigns/{id}", "GET",
+                          lambda n: f"/api/campaigns/{ids[n % len(ids)]}", args.requests)
+            await measure(client, "GET /api/programs/{id}", "GET",
+                          lambda n: f"/api/programs/{ids[n % len(ids)]}", args.requests)
+            await measure(client, "GET /api/dashboard/stats", "GET", lambda n: "/api/dashboard/stats", args.requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
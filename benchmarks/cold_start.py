@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark for the backend.
+
+Measures, in fresh interpreters:
+- import time of ``server`` (no DB handshake, no LLM SDK)
+- time from process spawn to the first served request on
+  /api/health/live and /api/health/ready
+
+The backend needs the same environment as in production (MONGO_URL, ...).
+
+    python benchmarks/cold_start.py --runs 5
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import server; "
+    "print(time.perf_counter() - t); "
+    "import sys; print(int('emergentintegrations' in sys.modules))"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(output[0]), output[1] == "1"
+
+
+def wait_for(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.005)
+    return False
+
+
+def measure_first_request(timeout):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    try:
+        deadline = start + timeout
+        if not wait_for(f"{base}/api/health/live", deadline):
+            raise RuntimeError(process.stderr.read().decode()[-500:] if process.poll() is not None else "timeout")
+        live = time.perf_counter() - start
+        if not wait_for(f"{base}/api/health/ready", deadline):
+            raise RuntimeError("readiness timeout")
+        ready = time.perf_counter() - start
+        return live, ready
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def report(name, samples):
+    samples_ms = [s * 1000 for s in samples]
+    print(f"{name:<28} median {statistics.median(samples_ms):8.1f} ms   "
+          f"min {min(samples_ms):8.1f} ms   max {max(samples_ms):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    imports, lives, readies = [], [], []
+    llm_loaded = False
+    for _ in range(args.runs):
+        seconds, loaded = measure_import()
+        imports.append(seconds)
+        llm_loaded |= loaded
+        live, ready = measure_first_request(args.timeout)
+        lives.append(live)
+        readies.append(ready)
+
+    print(f"🚀 Cold start ({args.runs} run)")
+    report("import server", imports)
+    report("first request (live)", lives)
+    report("first request (ready)", readies)
+    print(f"LLM SDK importato all'avvio: {'sì' if llm_loaded else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Election day: a whole school votes within a few minutes.
+
+Students (already registered) vote through the full ASGI stack with a
+bounded number of concurrent requests; a share of them retries the vote
+(double click, flaky Wi-Fi) and some refresh the live results. At the end the
+election is closed and the recounted total is checked against the votes
+accepted.
+
+    python benchmarks/election_day.py --students 1500 --candidates 6 --concurrency 200
+
+Uses the in-memory engine unless STORAGE_BACKEND=mongo (the benchmark data is
+written to MONGO_URL/DB_NAME and left there, in a dedicated election).
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ["RATE_LIMITS"] = ""
+os.environ["MAX_IN_FLIGHT"] = "0"
+os.environ.setdefault("ELECTION_CACHE_S", "0.2")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+
+
+def seed(students: int, candidates: int):
+    admin_token = f"bench-admin-{uuid.uuid4()}"
+    server.users_collection.insert_one({
+        "id": str(uuid.uuid4()), "email": f"{admin_token}@bench", "name": "Admin", "role": "admin",
+        "password": "-", "token": admin_token,
+    })
+    tokens = [f"bench-{uuid.uuid4()}" for _ in range(students)]
+    server.users_collection.insert_many([
+        {"id": str(uuid.uuid4()), "email": f"{token}@bench", "name": "Studente", "role": "visitor",
+         "password": "-", "token": token}
+        for token in tokens
+    ])
+    candidate_ids = [f"bench-candidate-{uuid.uuid4()}" for _ in range(candidates)]
+    server.candidates_collection.insert_many([
+        {"id": c, "user_id": "benchmark", "name": f"Candidato {n}", "class_year": "5A", "description": "-"}
+        for n, c in enumerate(candidate_ids)
+    ])
+    return admin_token, tokens, candidate_ids
+
+
+async def main(args):
+    async with server.lifespan(server.app):
+        admin_token, tokens, candidate_ids = await asyncio.to_thread(seed, args.students, args.candidates)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            admin = {"Authorization": f"Bearer {admin_token}"}
+            election = (await client.post("/api/elections", json={
+                "title": "Benchmark", "candidate_ids": candidate_ids,
+            }, headers=admin)).json()["election"]
+            url = f"/api/elections/{election['id']}"
+
+            gate = asyncio.Semaphore(args.concurrency)
+            latencies = []
+            outcomes = {"accepted": 0, "duplicate": 0, "errors": 0}
+            # A few candidates get most of the votes, as on a real election day
+            weights = [1 / (n + 1) for n in range(len(candidate_ids))]
+
+            async def student(token):
+                headers = {"Authorization": f"Bearer {token}"}
+                choice = random.choices(candidate_ids, weights)[0]
+                attempts = 2 if random.random() < args.retry_share else 1
+                async with gate:
+                    for _ in range(attempts):
+                        start = time.perf_counter()
+                        response = await client.post(f"{url}/votes", json={"candidate_id": choice}, headers=headers)
+                        latencies.append(time.perf_counter() - start)
+                        if response.status_code == 200:
+                            outcomes["accepted"] += 1
+                        elif response.status_code == 409:
+                            outcomes["duplicate"] += 1
+                        else:
+                            outcomes["errors"] += 1
+                    if random.random() < args.results_share:
+                        await client.get(f"{url}/results")
+
+            start = time.perf_counter()
+            await asyncio.gather(*(student(token) for token in tokens))
+            elapsed = time.perf_counter() - start
+
+            live = (await client.get(f"{url}/results")).json()
+            final = (await client.post(f"{url}/close", headers=admin)).json()
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000  # noqa: E731
+    print(f"{args.students} studenti, {args.candidates} candidati, {args.concurrency} richieste concorrenti, "
+          f"{server.voting_service.shards} shard per contatore")
+    print(f"voti accettati {outcomes['accepted']}, doppi rifiutati {outcomes['duplicate']}, "
+          f"errori {outcomes['errors']}")
+    print(f"{outcomes['accepted'] / elapsed:.0f} voti/s in {elapsed:.1f} s   latenza p50 "
+          f"{statistics.median(latencies) * 1000:.1f} ms  p95 {pct(0.95):.1f} ms  p99 {pct(0.99):.1f} ms")
+    print(f"conteggio live {live['total_votes']}, riconteggio finale {final['total_votes']}"
+          f" -> {'OK' if final['total_votes'] == outcomes['accepted'] else 'DISALLINEATO'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=1500)
+    parser.add_argument("--candidates", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--retry-share", type=float, default=0.05)
+    parser.add_argument("--results-share", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
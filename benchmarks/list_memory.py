@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Peak memory of building the candidate list response: plain dicts vs records.
+
+Each mode runs in its own process: the collection is seeded, the RSS
+high-water mark is reset (Linux, /proc/self/clear_refs) and the list body is
+built once. Reported is the peak RSS growth while building it.
+
+- dicts: the previous path, list(find()) + jsonable_encoder + json.dumps
+- records: raw BSON + projection into slotted records (records.py)
+
+    python benchmarks/list_memory.py --candidates 50000
+
+Runs against the MongoDB at MONGO_URL/DB_NAME, where the benchmark
+candidates are inserted and then removed: the in-memory engine ignores codec
+options, so raw BSON would not be exercised there. Without a reachable
+mongod the benchmark is skipped.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+os.environ["STORAGE_BACKEND"] = "mongo"
+os.environ.setdefault("MONGO_SERVER_SELECTION_TIMEOUT_MS", "2000")
+os.environ["RATE_LIMITS"] = ""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+
+def _status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def _reset_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def build_dicts(server):
+    from fastapi.encoders import jsonable_encoder
+    candidates = list(server.candidates_read_collection.find({}))
+    for candidate in candidates:
+        candidate['_id'] = str(candidate['_id'])
+    payload = {"success": True, "candidates": candidates}
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def build_records(server):
+    return server._candidate_list()
+
+
+def run(mode: str, count: int):
+    import server
+    from storage import get_storage
+    from datetime import datetime
+
+    collection = server.candidates_collection
+    collection.delete_many({"user_id": "benchmark"})
+    now = datetime.utcnow()
+    batch = []
+    for n in range(count):
+        batch.append({
+            "id": f"bench-{n}", "user_id": "benchmark", "name": f"Candidato {n}", "class_year": "5A",
+            "description": "Rappresentante per una scuola più aperta, digitale e sostenibile",
+            "photo": None, "manifesto": None, "created_at": now, "updated_at": now,
+        })
+        if len(batch) == 1000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+    import gc
+    gc.collect()
+    exact = _reset_peak()
+    before = _status_kb("VmRSS")
+    start = time.perf_counter()
+    body = (build_dicts if mode == "dicts" else build_records)(server)
+    elapsed = time.perf_counter() - start
+    peak = _status_kb("VmHWM") if exact else _status_kb("VmRSS")
+    size = len(body)
+    del body
+    collection.delete_many({"user_id": "benchmark"})
+    get_storage().close()
+    print(json.dumps({"mode": mode, "peak_kb": peak - before, "body_kb": size // 1024,
+                      "ms": round(elapsed * 1000), "exact_peak": exact}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=50000)
+    parser.add_argument("--mode", choices=("dicts", "records"))
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.candidates)
+        return
+
+    from storage import get_storage
+    try:
+        get_storage().ping()
+    except RuntimeError as e:
+        print(f"Benchmark saltato: {e}")
+        return
+    finally:
+        get_storage().close()
+
+    print(f"Lista di {args.candidates} candidati")
+    for mode in ("dicts", "records"):
+        output = subprocess.run([sys.executable, __file__, "--mode", mode, "--candidates", str(args.candidates)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        note = "" if result["exact_peak"] else " (RSS finale, picco non misurabile)"
+        print(f"{mode:<8} picco RSS +{result['peak_kb'] / 1024:7.1f} MiB   risposta {result['body_kb'] / 1024:5.1f} MiB"
+              f"   {result['ms']:5d} ms{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Campaign write throughput: one write per request vs batched writes.
+
+Concurrent clients create campaigns and append events through the full ASGI
+stack for each WRITE_DURABILITY mode. By default the in-memory engine is
+used with a simulated database round trip (--rtt-ms) per write command, the
+cost that batching amortizes; set STORAGE_BACKEND=mongo to measure against
+a real server instead.
+
+    python benchmarks/write_batching.py --clients 50 --writes 20 --rtt-ms 1
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ["RATE_LIMITS"] = ""
+os.environ["MAX_IN_FLIGHT"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+from storage import MemoryStorage, set_storage  # noqa: E402
+
+WRITE_METHODS = ("insert_one", "insert_many", "update_one", "bulk_write")
+
+
+class RoundTripStorage(MemoryStorage):
+    """Memory engine charging one blocking round trip per write command, like a remote server"""
+
+    def __init__(self, rtt: float):
+        super().__init__()
+        self.rtt = rtt
+        self.commands = 0
+
+    def collection(self, name, read=False):
+        return _RoundTripCollection(super().collection(name, read), self)
+
+
+class _RoundTripCollection:
+    def __init__(self, collection, storage):
+        self._collection = collection
+        self._storage = storage
+
+    def __getattr__(self, attr):
+        value = getattr(self._collection, attr)
+        if attr not in WRITE_METHODS:
+            return value
+
+        def with_round_trip(*args, **kwargs):
+            self._storage.commands += 1
+            time.sleep(self._storage.rtt)
+            return value(*args, **kwargs)
+        return with_round_trip
+
+
+async def run_mode(mode, args):
+    storage = RoundTripStorage(args.rtt_ms / 1000) if os.environ["STORAGE_BACKEND"] == "memory" else None
+    if storage is not None:
+        set_storage(storage)
+    server.write_buffer.mode = mode
+
+    async with server.lifespan(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            candidate = (await client.post("/api/candidates", json={
+                "user_id": "bench", "name": "Candidato", "class_year": "5A", "description": "Benchmark",
+            })).json()["candidate"]
+
+            async def writer(n):
+                campaign = (await client.post("/api/campaigns", json={
+                    "candidate_id": candidate["id"], "title": f"Campagna {n}",
+                    "description": "Settimana di campagna", "status": "active",
+                }, headers={"Authorization": f"Bearer writer-{n}"})).json()["campaign"]
+                for e in range(args.writes - 1):
+                    response = await client.post(f"/api/campaigns/{campaign['id']}/events", json={
+                        "name": f"Evento {e}", "date": "2030-03-15",
+                    }, headers={"Authorization": f"Bearer writer-{n}"})
+                    assert response.status_code == 200, response.text
+
+            if storage is not None:
+                storage.commands = 0
+            start = time.perf_counter()
+            await asyncio.gather(*(writer(n) for n in range(args.clients)))
+            elapsed = time.perf_counter() - start
+        stats = server.write_buffer.stats()
+
+    requests = args.clients * args.writes
+    commands = f"{storage.commands:6d} comandi" if storage is not None else ""
+    print(f"{mode:<10} {requests / elapsed:9.0f} richieste/s   {elapsed * 1000:8.0f} ms   {commands}   "
+          f"batch medio {stats['avg_batch_size']}")
+
+
+async def main(args):
+    print(f"{args.clients} client x {args.writes} scritture, RTT simulato {args.rtt_ms} ms")
+    for mode in ("immediate", "group", "buffered"):
+        await run_mode(mode, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--writes", type=int, default=20)
+    parser.add_argument("--rtt-ms", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,6 +1,26 @@
-import React, { useState, useEffect, createContext, useContext } from 'react';
+import React, { useState, useEffect, useRef, createContext, useContext } from 'react';
 import './App.css';
 
+// Idempotency key for a submission: retrying the same payload after a failure
+// reuses the key, so the backend creates the record only once. A different
+// payload, or a new submission after success, gets a new key.
+const newIdempotencyKey = () =>
+  (window.crypto && window.crypto.randomUUID)
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const useIdempotencyKey = () => {
+  const pending = useRef(null);
+  const keyFor = (body) => {
+    if (!pending.current || pending.current.body !== body) {
+      pending.current = { body, key: newIdempotencyKey() };
+    }
+    return pending.current.key;
+  };
+  const reset = () => { pending.current = null; };
+  return [keyFor, reset];
+};
+
 // Auth Context
 const AuthContext = createContext();
 
@@ -889,6 +909,7 @@ const AIGeneratorTab = ({ user }) => {
 
 // Campaigns Tab Component
 const CampaignsTab = ({ user }) => {
+  const [idempotencyKey, resetIdempotencyKey] = useIdempotencyKey();
   const [campaigns, setCampaigns] = useState([]);
   const [loading, setLoading] = useState(true);
   const [showForm, setShowForm] = useState(false);
@@ -939,21 +960,23 @@ const CampaignsTab = ({ user }) => {
         }
       }
 
+      const body = JSON.stringify({
+        ...formData,
+        candidate_id: candidateId,
+        events: [],
+        materials: []
+      });
       const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/campaigns`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          ...formData,
-          candidate_id: candidateId,
-          events: [],
-          materials: []
-        })
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(body) },
+        body
       });
 
       const data = await response.json();
       if (data.success) {
         setShowForm(false);
         setFormData({ title: '', description: '', status: 'draft' });
+        resetIdempotencyKey();
         fetchCampaigns();
         alert('Campagna creata con successo!');
       }
@@ -1045,7 +1068,7 @@ const CampaignsTab = ({ user }) => {
                   
                   <div className="flex items-center text-sm text-gray-500">
                     <span className="mr-2">📊</span>
-                    Eventi: {campaign.events?.length || 0} | Materiali: {campaign.materials?.length || 0}
+                    Eventi: {campaign.events_count || 0} | Materiali: {campaign.materials_count || 0}
                   </div>
                 </div>
                 
@@ -1415,6 +1438,7 @@ const CampaignsTab = ({ user }) => {
 
 // Candidates Tab Component
 const CandidatesTab = ({ candidates, fetchCandidates, user }) => {
+  const [idempotencyKey, resetIdempotencyKey] = useIdempotencyKey();
   const [showForm, setShowForm] = useState(false);
   const [formData, setFormData] = useState({
     name: '',
@@ -1425,19 +1449,21 @@ const CandidatesTab = ({ candidates, fetchCandidates, user }) => {
   const handleSubmit = async (e) => {
     e.preventDefault();
     try {
+      const body = JSON.stringify({
+        ...formData,
+        user_id: user.id
+      });
       const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/candidates`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          ...formData,
-          user_id: user.id
-        })
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(body) },
+        body
       });
 
       const data = await response.json();
       if (data.success) {
         setShowForm(false);
         setFormData({ name: '', class_year: '', description: '' });
+        resetIdempotencyKey();
         fetchCandidates();
         alert('Candidato aggiunto con successo!');
       }
@@ -1541,6 +1567,7 @@ const CandidatesTab = ({ candidates, fetchCandidates, user }) => {
 
 // Programs Tab Component
 const ProgramsTab = ({ user }) => {
+  const [idempotencyKey, resetIdempotencyKey] = useIdempotencyKey();
   const [programs, setPrograms] = useState([]);
   const [loading, setLoading] = useState(true);
   const [selectedProgram, setSelectedProgram] = useState(null);
@@ -1584,19 +1611,21 @@ const ProgramsTab = ({ user }) => {
         }
       }
 
+      const body = JSON.stringify({
+        candidate_id: candidateId,
+        title: `Programma Elettorale ${new Date().toLocaleDateString('it-IT')}`,
+        content: programContent,
+        generated_by_ai: true
+      });
       const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/programs`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          candidate_id: candidateId,
-          title: `Programma Elettorale ${new Date().toLocaleDateString('it-IT')}`,
-          content: programContent,
-          generated_by_ai: true
-        })
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(body) },
+        body
       });
 
       const data = await response.json();
       if (data.success) {
+        resetIdempotencyKey();
         fetchPrograms();
         alert('Programma salvato con successo!');
       }
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+# Exercise the API in-process against the in-memory storage engine
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+from storage import MemoryStorage, set_storage  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    set_storage(MemoryStorage())
+    server.rate_limiter.reset()
+    server.response_cache.clear()
+    server.tenant_registry.reset()
+    with TestClient(server.app) as test_client:
+        yield test_client
+    set_storage(None)
+
+
+@pytest.fixture
+def admin_headers(client):
+    response = client.post("/api/auth/register", json={
+        "email": "preside@liceofermi.it",
+        "password": "Segreto2024!",
+        "name": "Dirigente Scolastico",
+        "role": "admin",
+    })
+    return {"Authorization": f"Bearer {response.json()['user']['token']}"}
+
+
+@pytest.fixture
+def candidate(client):
+    response = client.post("/api/candidates", json={
+        "user_id": "user-1",
+        "name": "Marco Rossi",
+        "class_year": "5A",
+        "description": "Rappresentante per una scuola più digitale",
+    })
+    return response.json()["candidate"]
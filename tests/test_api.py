@@ -0,0 +1,738 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import maintenance
+import server
+import sync
+import voting
+
+
+def test_health(client):
+    assert client.get("/api/health/live").json() == {"status": "alive"}
+    assert client.get("/api/health/ready").json() == {"status": "ready"}
+
+
+def test_startup_defers_llm_sdk_and_gates_readiness(client, monkeypatch):
+    import sys
+    # The LLM SDK is only imported by the first program generation
+    assert "emergentintegrations" not in sys.modules
+    assert server.load_llm_provider.cache_info().currsize == 0
+    # Until the lifespan has finished, the worker is alive but not ready
+    monkeypatch.setattr(server.app.state, "ready", False)
+    assert client.get("/api/health/live").status_code == 200
+    assert client.get("/api/health/ready").status_code == 503
+
+
+def test_register_and_login(client):
+    user = {"email": "giulia@liceofermi.it", "password": "pw", "name": "Giulia Bianchi", "role": "visitor"}
+    registered = client.post("/api/auth/register", json=user).json()["user"]
+
+    response = client.post("/api/auth/login", json={"email": user["email"], "password": "pw"})
+    assert response.status_code == 200
+    assert response.json()["user"]["token"] != registered["token"]
+
+    response = client.post("/api/auth/login", json={"email": user["email"], "password": "sbagliata"})
+    assert response.status_code == 401
+
+
+def test_candidates(client, candidate):
+    candidates = client.get("/api/candidates").json()["candidates"]
+    assert [c["id"] for c in candidates] == [candidate["id"]]
+
+    assert client.get(f"/api/candidates/{candidate['id']}").json()["candidate"]["name"] == "Marco Rossi"
+    assert client.get("/api/candidates/inesistente").status_code == 404
+
+
+def test_campaign_events_and_materials(client, candidate):
+    soon = datetime.utcnow() + timedelta(days=2)
+    later = datetime.utcnow() + timedelta(days=20)
+    campaign = client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"],
+        "title": "Campagna 2024",
+        "description": "Digitalizzazione e sostenibilità",
+        "status": "active",
+        "events": [{"name": "Assemblea", "date": later.isoformat(), "location": "Aula Magna"}],
+        "materials": [{"type": "volantino", "title": "Il programma"}],
+    }).json()["campaign"]
+    assert "events" not in campaign
+    assert campaign["events_count"] == 1
+
+    response = client.post(f"/api/campaigns/{campaign['id']}/events",
+                           json={"name": "Banchetto", "date": soon.isoformat()})
+    assert response.status_code == 200
+
+    listed = client.get(f"/api/campaigns/{candidate['id']}").json()["campaigns"][0]
+    assert listed["events_count"] == 2
+    assert listed["materials_count"] == 1
+    assert listed["next_event"]["name"] == "Banchetto"
+
+    week = client.get("/api/events", params={"days": 7}).json()
+    assert [e["name"] for e in week["events"]] == ["Banchetto"]
+
+    page = client.get(f"/api/campaigns/{campaign['id']}/events", params={"limit": 1}).json()
+    assert page["has_more"] is True
+    assert [e["name"] for e in page["events"]] == ["Banchetto"]
+
+    assert client.post("/api/campaigns/inesistente/events",
+                       json={"name": "X", "date": soon.isoformat()}).status_code == 404
+
+
+def test_program_versions(client, candidate):
+    base = "Titolo\n" + "".join(f"Proposta {i}\n" for i in range(20))
+    program = client.post("/api/programs", json={
+        "candidate_id": candidate["id"], "title": "Programma", "content": base,
+    }).json()["program"]
+    assert program["version"] == 1
+
+    contents = [base]
+    for version in range(2, 15):
+        content = contents[-1].replace(f"Proposta {version}\n", f"Proposta {version} rivista\n")
+        contents.append(content)
+        saved = client.post("/api/programs", json={
+            "id": program["id"], "candidate_id": candidate["id"],
+            "title": "Programma", "content": content, "version": version - 1,
+        }).json()["program"]
+        assert saved["version"] == version
+
+    programs = client.get(f"/api/programs/{candidate['id']}").json()["programs"]
+    assert len(programs) == 1
+    assert programs[0]["content"] == contents[-1]
+
+    versions = client.get(f"/api/programs/{program['id']}/versions").json()["versions"]
+    assert [v["kind"] for v in versions].count("snapshot") == 2
+    for version, content in enumerate(contents, start=1):
+        rebuilt = client.get(f"/api/programs/{program['id']}/versions/{version}").json()["program"]
+        assert rebuilt["content"] == content
+
+    stale = client.post("/api/programs", json={
+        "id": program["id"], "candidate_id": candidate["id"],
+        "title": "Programma", "content": "vecchio", "version": 3,
+    })
+    assert stale.status_code == 409
+
+
+def test_concurrent_first_revision_of_legacy_program(client, candidate):
+    program = client.post("/api/programs", json={
+        "candidate_id": candidate["id"], "title": "Programma", "content": "Mensa\n",
+    }).json()["program"]
+    # Saved before versioning: no version field, no version chain
+    server.programs_collection.update_one({"id": program["id"]}, {"$unset": {"version": ""}})
+    server.program_versions_collection.delete_many({"program_id": program["id"]})
+
+    # Both edits read the program before either one wrote
+    current = server.programs_collection.find_one({"id": program["id"]})
+    first = server.ElectoralProgram(id=program["id"], candidate_id=candidate["id"], title="Programma", content="Palestra\n")
+    second = server.ElectoralProgram(id=program["id"], candidate_id=candidate["id"], title="Programma", content="Piscina\n")
+    assert server._revise_program(dict(current), first)["version"] == 2
+    with pytest.raises(server.HTTPException) as lost:
+        server._revise_program(dict(current), second)
+    assert lost.value.status_code == 409
+
+    versions = client.get(f"/api/programs/{program['id']}/versions").json()["versions"]
+    assert [v["version"] for v in versions] == [1, 2]
+    original = client.get(f"/api/programs/{program['id']}/versions/1").json()["program"]
+    assert original["content"] == "Mensa\n"
+
+
+@pytest.mark.parametrize("old,new", [
+    ("", "Proposta 1"),
+    ("Mensa\nBiblioteca", "Mensa\nPalestra"),
+    ("Senza a capo finale", "Senza a capo finale\n"),
+    ("Più\r\nspazi\n", "Più\nspazi"),
+    ("Proposta\n" * 5, ""),
+])
+def test_program_diff_round_trip(old, new):
+    import program_versions
+    assert program_versions.apply_diff(old, program_versions.make_diff(old, new)) == new
+
+
+def test_dashboard_stats(client, candidate):
+    stats = client.get("/api/dashboard/stats").json()["stats"]
+    assert stats["total_candidates"] == 1
+    assert stats["total_campaigns"] == 0
+
+
+def test_admin_endpoints_require_admin(client, admin_headers):
+    assert client.get("/api/admin/db/pool").status_code == 401
+    response = client.get("/api/admin/db/pool", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["backend"] == "memory"
+
+
+def test_login_rate_limit(client):
+    for _ in range(10):
+        client.post("/api/auth/login", json={"email": "x@liceofermi.it", "password": "pw"})
+    response = client.post("/api/auth/login", json={"email": "x@liceofermi.it", "password": "pw"})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    # Other routes keep their own budget
+    assert client.get("/api/candidates").status_code == 200
+
+
+def test_rate_limit_keys_ignore_unverified_tokens(client, admin_headers, monkeypatch):
+    # A fresh made-up token per attempt does not reset the login budget
+    for i in range(10):
+        client.post("/api/auth/login", json={"email": "x@liceofermi.it", "password": "pw"},
+                    headers={"Authorization": f"Bearer inventato-{i}"})
+    response = client.post("/api/auth/login", json={"email": "x@liceofermi.it", "password": "pw"},
+                           headers={"Authorization": "Bearer inventato-10"})
+    assert response.status_code == 429
+
+    lookups = []
+    verify = server.rate_limiter.verify_token
+    monkeypatch.setattr(server.rate_limiter, "verify_token", lambda token: lookups.append(token) or verify(token))
+    monkeypatch.setitem(server.rate_limiter.budgets, "default", (3.0, 3 / 60))
+
+    def key(authorization):
+        return server.rate_limiter.client_key({
+            "type": "http", "method": "GET", "path": "/api/candidates", "client": ("testclient", 50000),
+            "headers": [(b"authorization", authorization.encode())],
+        })
+
+    # A rejected token is remembered: repeating it costs no lookup
+    for _ in range(2):
+        client.get("/api/candidates", headers={"Authorization": "Bearer inventato"})
+    assert lookups == ["inventato"] and key("Bearer inventato") == "ip:testclient"
+    # Unknown tokens are charged to the IP budget before any lookup
+    statuses = [client.get("/api/candidates", headers={"Authorization": f"Bearer ruotato-{i}"}).status_code
+                for i in range(3)]
+    assert statuses == [200, 429, 429] and len(lookups) == 2
+
+    # A verified token gets its own bucket from the next request on
+    server.rate_limiter.reset()
+    client.get("/api/candidates", headers=admin_headers)
+    assert key(admin_headers["Authorization"]) == "token:" + admin_headers["Authorization"][7:]
+
+
+@pytest.mark.parametrize("mode", ["group", "buffered"])
+def test_batched_campaign_writes_are_readable_by_writer(client, candidate, mode, monkeypatch):
+    monkeypatch.setattr(server.write_buffer, "mode", mode)
+    if mode == "buffered":
+        # Only a read by the writer can trigger the flush in time
+        monkeypatch.setattr(server.write_buffer, "max_delay", 60)
+    campaign = client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "draft",
+    }).json()["campaign"]
+    client.post(f"/api/campaigns/{campaign['id']}/events",
+                json={"name": "Assemblea", "date": (datetime.utcnow() + timedelta(days=1)).isoformat()})
+
+    listed = client.get(f"/api/campaigns/{candidate['id']}").json()["campaigns"]
+    assert [c["id"] for c in listed] == [campaign["id"]]
+    assert listed[0]["events_count"] == 1
+    assert listed[0]["next_event"]["name"] == "Assemblea"
+
+
+def test_buffered_write_failures_are_counted_and_do_not_drop_the_batch():
+    from storage import MemoryStorage
+    from write_buffer import WriteBuffer
+    events = MemoryStorage().collection("campaign_events")
+    events.create_index("id", unique=True)
+    events.insert_one({"id": "e1", "name": "Assemblea"})
+    buffer = WriteBuffer(mode="buffered", max_delay_ms=60000)
+
+    async def scenario():
+        await buffer.insert(events, {"id": "e1", "name": "Duplicato"})
+        await buffer.insert(events, {"id": "e2", "name": "Volantinaggio"})
+        await buffer.update(events, {"id": "e2"}, {"$set": {"location": "Aula magna"}})
+        await buffer.flush()
+
+    asyncio.run(scenario())
+    assert events.find_one({"id": "e2"}, {"_id": 0}) == {"id": "e2", "name": "Volantinaggio", "location": "Aula magna"}
+    stats = buffer.stats()
+    assert (stats["errors"], stats["lost"]) == (1, 1)
+    assert "E11000" in stats["last_error"]
+
+
+def test_idempotency_key_replays_create(client):
+    payload = {"user_id": "user-2", "name": "Giulia Bianchi", "class_year": "4B", "description": "Più sport"}
+    headers = {"Idempotency-Key": "modulo-candidato-1"}
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(lambda _: client.post("/api/candidates", json=payload, headers=headers), range(4)))
+    assert all(r.status_code == 200 for r in responses)
+    assert len({r.json()["candidate"]["id"] for r in responses}) == 1
+    assert sum(r.headers.get("idempotent-replayed") == "true" for r in responses) == 3
+
+    retry = client.post("/api/candidates", json=payload, headers=headers)
+    assert retry.json() == responses[0].json()
+    assert len(client.get("/api/candidates").json()["candidates"]) == 1
+
+    changed = client.post("/api/candidates", json=dict(payload, name="Altro"), headers=headers)
+    assert changed.status_code == 422
+
+
+def test_delta_sync(client, candidate):
+    full = client.get("/api/sync").json()
+    assert full["full"] is True
+    assert [c["id"] for c in full["candidates"]] == [candidate["id"]]
+
+    since = (datetime.fromisoformat(candidate["updated_at"]) + timedelta(milliseconds=1)).isoformat()
+    campaign = client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "draft",
+    }).json()["campaign"]
+    sync.record_deletions(server.tombstones_collection, "programs", ["programma-rimosso"])
+
+    delta = client.get("/api/sync", params={"since": since}).json()
+    assert delta["full"] is False
+    assert delta["candidates"] == []
+    assert [c["id"] for c in delta["campaigns"]] == [campaign["id"]]
+    assert delta["deleted"]["programs"] == ["programma-rimosso"]
+    assert datetime.fromisoformat(delta["next_since"]) < datetime.utcnow()
+
+
+def test_compressed_candidate_list_is_cached(client, candidate):
+    for n in range(20):
+        client.post("/api/candidates", json=dict(candidate, id=None, name=f"Candidato {n}"))
+
+    first = client.get("/api/candidates", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip"
+    assert len(first.json()["candidates"]) == 21
+    etag = first.headers["etag"]
+    assert client.get("/api/candidates", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/api/candidates", json=dict(candidate, id=None, name="Ultimo"))
+    refreshed = client.get("/api/candidates", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert len(refreshed.json()["candidates"]) == 22
+    assert server.response_cache.stats()["entries"] == 1
+
+
+def test_one_vote_per_user_and_tally(client, admin_headers, candidate, monkeypatch):
+    monkeypatch.setattr(voting, "ELECTION_CACHE_S", 0)
+    election = client.post("/api/elections", json={"title": "Rappresentanti 2025"},
+                           headers=admin_headers).json()["election"]
+    assert election["candidate_ids"] == [candidate["id"]]
+    token = client.post("/api/auth/register", json={
+        "email": "studente@liceofermi.it", "password": "pw", "name": "Studente", "role": "visitor",
+    }).json()["user"]["token"]
+    voter = {"Authorization": f"Bearer {token}"}
+    url = f"/api/elections/{election['id']}/votes"
+
+    assert client.post(url, json={"candidate_id": candidate["id"]}, headers=voter).status_code == 200
+    assert client.post(url, json={"candidate_id": candidate["id"]}, headers=voter).status_code == 409
+    assert client.post(url, json={"candidate_id": candidate["id"]}, headers=admin_headers).status_code == 403
+    assert client.post(url, json={"candidate_id": "sconosciuto"}, headers=voter).status_code == 400
+
+    live = client.get(f"/api/elections/{election['id']}/results").json()
+    assert live["final"] is False
+    assert live["tally"] == [{"candidate_id": candidate["id"], "votes": 1}]
+
+    closed = client.post(f"/api/elections/{election['id']}/close", headers=admin_headers).json()
+    assert closed["final"] is True and closed["total_votes"] == 1
+    assert client.post(url, json={"candidate_id": candidate["id"]}, headers=voter).status_code == 409
+
+    # Workers still holding the open election in their cache
+    with pytest.raises(voting.ElectionClosed):
+        server.voting_service.cast(election, "studente-in-ritardo", candidate["id"])
+    assert server.voting_service.votes.count_documents({"election_id": election["id"]}) == 1
+
+    closed_at = server.elections_collection.find_one({"id": election["id"]})["closed_at"]
+
+    class CastBeforeClose(datetime):
+        @classmethod
+        def utcnow(cls):
+            return closed_at - timedelta(seconds=1)
+
+    # Cast before the close but written after the final recount: counted by a new recount
+    monkeypatch.setattr(voting, "datetime", CastBeforeClose)
+    server.voting_service.cast(election, "studente-lento", candidate["id"])
+    final = client.get(f"/api/elections/{election['id']}/results").json()
+    assert final["final"] is True and final["total_votes"] == 2
+
+
+def test_admin_analytics(client, admin_headers, candidate):
+    client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "active",
+    })
+    client.post("/api/programs", json={"candidate_id": candidate["id"], "title": "Programma", "content": "x" * 120})
+
+    report = client.get("/api/admin/analytics", headers=admin_headers).json()
+    assert report["candidates_created"][0]["count"] == 1
+    assert report["campaigns_created"][0]["by"] == {"active": 1}
+    assert report["events_per_campaign"]["count"] == 1
+    assert report["program_length_by_class_year"] == [
+        {"class_year": "5A", "programs": 1, "mean_chars": 120.0, "median_chars": 120.0, "max_chars": 120}
+    ]
+    assert client.get("/api/admin/analytics", headers=admin_headers).json() == report
+
+
+def test_dashboard_activity_series(client, candidate):
+    for status in ("active", "active", "draft", "$set.x"):
+        client.post("/api/campaigns", json={
+            "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": status,
+        })
+
+    daily = client.get("/api/dashboard/activity").json()
+    assert len(daily["series"]) in (30, 31)
+    assert daily["totals"]["candidates"] == 1
+    today = daily["series"][-1]
+    assert today["campaigns"] == 4
+    # Unknown statuses never become field paths
+    assert today["campaigns_by_status"] == {"active": 2, "draft": 1, "other": 1}
+
+    hourly = client.get("/api/dashboard/activity", params={"granularity": "hour"}).json()
+    assert hourly["totals"]["campaigns"] == 4
+    too_wide = client.get("/api/dashboard/activity", params={"granularity": "hour", "start": "2020-01-01T00:00:00"})
+    assert too_wide.status_code == 400
+
+
+def test_batch_reads(client, candidate):
+    client.post("/api/programs", json={"candidate_id": candidate["id"], "title": "Programma", "content": "Testo"})
+    response = client.post("/api/batch", json={"operations": [
+        {"id": "stats", "op": "stats"},
+        {"id": "page", "op": "candidates", "limit": 10},
+        {"op": "programs", "candidate_id": candidate["id"]},
+        {"op": "campaigns"},
+    ]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results["stats"]["body"] == client.get("/api/dashboard/stats").json()
+    assert results["page"]["body"]["has_more"] is False
+    assert [c["id"] for c in results["page"]["body"]["candidates"]] == [candidate["id"]]
+    assert results["2"]["body"]["programs"][0]["title"] == "Programma"
+    assert results["3"]["status"] == 400
+
+
+def test_similar_programs(client, candidate, admin_headers):
+    text = " ".join(f"proposta {n} per la scuola e gli studenti" for n in range(40))
+    saved = [
+        client.post("/api/programs", json={"candidate_id": candidate["id"], "title": title, "content": content})
+        .json()["program"]
+        for title, content in [("Originale", text), ("Copia", text + " con una riga in più"),
+                               ("Diverso", "palestra nuova, biblioteca aperta il pomeriggio e più gite")]
+    ]
+
+    similar = client.get(f"/api/programs/{saved[0]['id']}/similar").json()["similar"]
+    assert [s["title"] for s in similar] == ["Copia"]
+    assert similar[0]["similarity"] > 0.8
+
+    report = client.get("/api/admin/programs/duplicates", headers=admin_headers).json()
+    assert report["programs"] == 3
+    assert [sorted(p["program_ids"]) for p in report["pairs"]] == [sorted([saved[0]["id"], saved[1]["id"]])]
+    assert report["pairs"][0]["same_candidate"] is True
+
+
+def test_tenants_are_isolated(client, candidate, admin_headers, monkeypatch):
+    import tenancy
+    monkeypatch.setattr(tenancy, "TENANTS", ("liceo-fermi",))
+    monkeypatch.setattr(server, "tenant_quotas", tenancy.Quotas("candidates=1"))
+    fermi = {"X-Tenant": "liceo-fermi"}
+
+    assert client.get("/api/candidates", headers=fermi).json()["candidates"] == []
+    created = client.post("/api/candidates", headers=fermi, json={
+        "user_id": "user-2", "name": "Giulia Bianchi", "class_year": "4B", "description": "Più sport",
+    })
+    assert created.status_code == 200
+    # Quota of the tenant reached; the default school already had a candidate too
+    assert client.post("/api/candidates", headers=fermi, json=created.json()["candidate"]).status_code == 403
+    assert [c["name"] for c in client.get("/api/candidates", headers=fermi).json()["candidates"]] == ["Giulia Bianchi"]
+    assert [c["id"] for c in client.get("/api/candidates").json()["candidates"]] == [candidate["id"]]
+    assert client.get("/api/candidates", headers={"X-Tenant": "sconosciuta"}).status_code == 404
+
+    # The default school's admin token means nothing in another school's database
+    assert client.get("/api/admin/tenant", headers={**admin_headers, **fermi}).status_code == 401
+    stats = client.get("/api/admin/tenant", headers=admin_headers).json()
+    assert stats["tenant"] == "default"
+    assert stats["collections"]["candidates"] == {"documents": 1, "limit": 1}
+    assert stats["metrics"]["requests"] >= 3
+
+
+def test_archive_closed_election(client, admin_headers, candidate, monkeypatch, tmp_path):
+    import archive
+    monkeypatch.setattr(voting, "ELECTION_CACHE_S", 0)
+    if archive.pa is not None:
+        # Never write Arrow files under the real ARCHIVE_DIR
+        monkeypatch.setattr(server, "archive_store", archive.ArrowArchive(str(tmp_path)))
+    client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "active",
+        "events": [{"name": "Assemblea", "date": "2025-03-01T10:00:00"}],
+    })
+    client.post("/api/programs", json={"candidate_id": candidate["id"], "title": "Programma", "content": "Testo"})
+    election = client.post("/api/elections", json={"title": "Rappresentanti 2025"},
+                           headers=admin_headers).json()["election"]
+    archive_url = f"/api/admin/elections/{election['id']}/archive"
+    assert client.post(archive_url, headers=admin_headers).status_code == 409
+    client.post(f"/api/elections/{election['id']}/close", headers=admin_headers)
+
+    archived = client.post(archive_url, headers=admin_headers).json()["archive"]
+    assert archived["counts"]["candidates"] == 1 and archived["counts"]["campaign_events"] == 1
+    assert client.get("/api/candidates").json()["candidates"] == []
+    assert client.get("/api/dashboard/stats").json()["stats"]["total_programs"] == 0
+    assert client.get(f"/api/elections/{election['id']}/results").json()["final"] is True
+
+    programs = client.get(f"/api/admin/archive/{election['id']}/programs",
+                          params={"candidate_id": candidate["id"]}, headers=admin_headers).json()["programs"]
+    assert [p["title"] for p in programs] == ["Programma"]
+    assert client.post(archive_url, headers=admin_headers).status_code == 409
+
+
+def test_records_from_raw_bson_match_plain_documents():
+    import bson
+    from bson.raw_bson import RawBSONDocument
+    import records
+    documents = [{
+        "_id": bson.ObjectId(), "id": "c1", "user_id": "u1", "name": "Marco Rossi", "class_year": "5A",
+        "description": "Più spazi per lo studio", "photo": None,
+        "manifesto": {"punti": [{"titolo": "Biblioteca aperta"}]}, "created_at": datetime(2025, 3, 1, 10, 30),
+    }]
+    raw = [RawBSONDocument(bson.encode(doc)) for doc in documents]
+    assert (records.list_body("candidates", records.records(raw, records.CandidateRecord))
+            == records.list_body("candidates", records.records(documents, records.CandidateRecord)))
+
+
+def test_arrow_archive_reads_filtered_pages(tmp_path):
+    pytest.importorskip("pyarrow")
+    import archive
+    store = archive.ArrowArchive(str(tmp_path), batch_rows=3)
+    documents = [
+        {"id": f"e{i}", "campaign_id": f"c{i % 2}", "tags": ["assemblea"] if i == 4 else None}
+        for i in range(10)
+    ]
+    assert store.write("elezioni", "el-1", "campaign_events", documents) == 10
+
+    page = store.read("elezioni", "el-1", "campaign_events", {"campaign_id": "c0"}, skip=1, limit=3)
+    assert [row["id"] for row in page] == ["e2", "e4", "e6"]
+    assert page[1]["tags"] == ["assemblea"]
+    assert store.read("elezioni", "el-1", "campaign_events", {"program_id": "p1"}) == []
+    assert store.read("elezioni", "el-2", "campaign_events", {}) is None
+
+
+def test_campaign_with_invalid_event_date_is_rejected(client, candidate):
+    response = client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "active",
+        "events": [{"name": "Assemblea", "date": 12345}],
+    })
+    assert response.status_code == 422
+    assert server.campaigns_collection.count_documents({}) == 0
+    assert server.events_collection.count_documents({}) == 0
+
+    response = client.post("/api/campaigns", json={
+        "candidate_id": candidate["id"], "title": "Campagna", "description": "Descrizione", "status": "active",
+        "events": [{"name": "Assemblea", "date": "2099-05-02T10:00:00+02:00"}],
+    })
+    assert response.status_code == 200
+    assert response.json()["campaign"]["next_event"]["date"] == "2099-05-02T08:00:00"
+
+
+def test_embedded_campaign_items_migration_is_idempotent(client, candidate):
+    server.campaigns_collection.insert_one({
+        "id": "campagna-legacy", "candidate_id": candidate["id"], "title": "Campagna", "status": "active",
+        "events": [{"title": "Assemblea", "date": "2030-05-02T10:00:00"}, {"title": "Volantinaggio"}],
+        "materials": [{"title": "Manifesto"}],
+    })
+    legacy = server.campaigns_collection.find_one({"id": "campagna-legacy"})
+    # A worker crashed after moving the events but before clearing the campaign
+    server.migrate_embedded_campaign_items()
+    server.campaigns_collection.update_one({"id": "campagna-legacy"}, {"$set": {
+        "events": legacy["events"], "materials": legacy["materials"], "events_count": 99,
+    }})
+    assert server.migrate_embedded_campaign_items() == 1
+    assert server.migrate_embedded_campaign_items() == 0
+
+    assert server.events_collection.count_documents({"campaign_id": "campagna-legacy"}) == 2
+    assert server.materials_collection.count_documents({"campaign_id": "campagna-legacy"}) == 1
+    campaign = server.campaigns_collection.find_one({"id": "campagna-legacy"})
+    assert "events" not in campaign
+    assert (campaign["events_count"], campaign["materials_count"]) == (2, 1)
+
+
+def test_tenant_admission_queues_then_sheds(monkeypatch):
+    import tenancy
+    monkeypatch.setattr(tenancy, "TENANTS", ("liceo-fermi",))
+    registry = tenancy.TenantRegistry(max_in_flight=1, admission_timeout_ms=50)
+
+    async def scenario():
+        assert await registry.admit("liceo-fermi")
+        waiting = asyncio.ensure_future(registry.admit("liceo-fermi"))
+        await asyncio.sleep(0.01)
+        registry.release("liceo-fermi")
+        assert await waiting  # queued until the slot was released
+        assert not await registry.admit("liceo-fermi")
+        assert await registry.admit("default")  # other schools keep their own slots
+
+    asyncio.run(scenario())
+    assert registry.metrics("liceo-fermi")["rejected"] == 1
+    with pytest.raises(RuntimeError):
+        tenancy.check_tenants(("liceo-fermi", "liceo_fermi"))
+
+
+def test_maintenance_jobs(client, admin_headers, candidate, monkeypatch):
+    old_admin = client.post("/api/auth/register", json={
+        "email": "vicepreside@liceofermi.it", "password": "pw", "name": "Vicepreside", "role": "admin",
+    }).json()["user"]
+    server.users_collection.update_one(
+        {"id": old_admin["id"]}, {"$set": {"token_issued_at": datetime.utcnow() - timedelta(days=30)}}
+    )
+    old_headers = {"Authorization": f"Bearer {old_admin['token']}"}
+    assert client.get("/api/admin/scheduler", headers=old_headers).status_code == 401
+
+    def run(job):
+        response = client.post(f"/api/admin/scheduler/{job}/run", headers=admin_headers)
+        assert response.status_code == 200
+        return response.json()["result"]["default"]
+
+    assert run("expire_tokens") == {"expired": 1}
+    assert server.users_collection.find_one({"id": old_admin["id"]}).get("token") is None
+
+    # Candidate-role users own their campaigns and programs by user id
+    for candidate_id in (candidate["id"], "candidato-rimosso", old_admin["id"]):
+        client.post("/api/campaigns", json={
+            "candidate_id": candidate_id, "title": "Campagna", "description": "Descrizione", "status": "active",
+        })
+    client.post("/api/programs", json={"candidate_id": old_admin["id"], "title": "Programma", "content": "Testo"})
+    server.campaigns_collection.update_many(
+        {}, {"$set": {"created_at": datetime.utcnow() - timedelta(days=1), "events_count": 3}}
+    )
+    server.programs_collection.update_many({}, {"$set": {"created_at": datetime.utcnow() - timedelta(days=1)}})
+    assert run("compact_orphans") == {"deleted": False, "campaigns": 1, "programs": 0}
+    assert server.campaigns_collection.count_documents({}) == 3
+
+    monkeypatch.setattr(maintenance, "ORPHAN_COMPACTION", "delete")
+    assert run("compact_orphans") == {"deleted": True, "campaigns": 1, "programs": 0}
+    assert len(client.get(f"/api/campaigns/{old_admin['id']}").json()["campaigns"]) == 1
+    assert len(client.get(f"/api/programs/{old_admin['id']}").json()["programs"]) == 1
+    assert run("refresh_aggregates") == {"fixed": 2}
+    assert server.tombstones_collection.count_documents({"collection": "campaigns"}) == 1
+
+    jobs = client.get("/api/admin/scheduler", headers=admin_headers).json()["jobs"]
+    assert jobs["compact_orphans"]["runs"] == 2 and jobs["compact_orphans"]["failures"] == 0
+    assert jobs["expire_tokens"]["last_ms"] is not None
+
+
+def test_frontend_build_is_served(client, tmp_path, monkeypatch):
+    import frontend
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_text('<html><script src="/static/js/main.1a2b3c4d.js"></script></html>')
+    (tmp_path / "static" / "js" / "main.1a2b3c4d.js").write_text("console.log('lista elettorale');\n" * 200)
+    files = frontend.StaticFrontend(str(tmp_path))
+
+    def read_only(root):
+        raise PermissionError(f"[Errno 30] Read-only file system: '{root}'")
+
+    with monkeypatch.context() as m:
+        m.setattr(frontend, "precompress_tree", read_only)
+        assert files.load(precompress_missing=True) == 2
+        assert files.stats()["precompressed"]["gzip"] == 0
+
+    # Build step (python cli.py precompress-frontend), then a worker starts
+    assert frontend.precompress_tree(str(tmp_path)) >= 1
+    assert files.load() == 2
+    monkeypatch.setattr(server, "frontend_files", files)
+
+    asset = client.get("/static/js/main.1a2b3c4d.js", headers={"Accept-Encoding": "gzip"})
+    assert asset.status_code == 200 and asset.text.startswith("console.log")
+    assert asset.headers["content-encoding"] == "gzip"
+    assert asset.headers["cache-control"] == frontend.IMMUTABLE
+    assert (tmp_path / "static" / "js" / "main.1a2b3c4d.js.gz").exists()
+
+    index = client.get("/")
+    assert index.headers["cache-control"] == "no-cache" and "main.1a2b3c4d.js" in index.text
+    assert client.get("/", headers={"If-None-Match": index.headers["etag"]}).status_code == 304
+    # Client-side routes fall back to index.html, missing files and API paths do not
+    assert client.get("/candidati/123").text == index.text
+    assert client.get("/static/js/missing.js").status_code == 404
+    assert client.get("/api/inesistente").status_code == 404
+    assert client.get("/api/health/live").status_code == 200
+
+
+def test_profiled_request_breaks_down_handler_and_mongo_time():
+    from types import SimpleNamespace
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    import profiling
+
+    listener = profiling.MongoTimingListener()
+    app = FastAPI()
+    app.router.route_class = profiling.ProfiledRoute
+
+    @app.get("/api/lenta")
+    def slow_endpoint():
+        # One database command of 5 ms, as reported by pymongo command monitoring
+        listener.started(SimpleNamespace(request_id=1))
+        listener.succeeded(SimpleNamespace(request_id=1, duration_micros=5000))
+        return {"ok": True}
+
+    app.add_middleware(profiling.ProfilingMiddleware, sample_rate=1.0, slow_ms=0)
+    profiling.store.clear()
+    try:
+        assert TestClient(app).get("/api/lenta").status_code == 200
+        [trace] = profiling.store.slowest()
+    finally:
+        profiling.store.clear()
+    assert (trace["path"], trace["status"], trace["sampled"]) == ("/api/lenta", 200, True)
+    assert (trace["mongo_ms"], trace["mongo_ops"]) == (5.0, 1)
+    assert trace["handler_ms"] >= 0 and trace["total_ms"] >= trace["handler_ms"]
+
+
+def test_query_stats_record_finds_and_slow_queries():
+    from types import SimpleNamespace
+    from query_stats import QueryStatsListener, summarize_explain
+
+    listener = QueryStatsListener(slow_ms=50, explain=False)
+    for request_id, duration_ms in ((1, 2), (2, 80)):
+        listener.started(SimpleNamespace(
+            request_id=request_id, command_name="find", database_name="lista_elettorale",
+            command={"find": "candidates", "filter": {"class_year": "5A"}, "lsid": {}},
+        ))
+        listener.succeeded(SimpleNamespace(
+            request_id=request_id, command_name="find", duration_micros=duration_ms * 1000,
+            reply={"cursor": {"firstBatch": [{"id": "c1"}, {"id": "c2"}]}},
+        ))
+
+    snapshot = listener.snapshot()
+    stats = snapshot["operations"]["candidates.find"]
+    assert (stats["count"], stats["slow"], stats["docs_returned"]) == (2, 1, 4)
+    assert stats["avg_ms"] == 41.0 and stats["max_ms"] == 80.0
+    assert "docs_examined" not in stats
+    [slow] = snapshot["slow_queries"]
+    assert (slow["collection"], slow["shape"], slow["duration_ms"]) == ("candidates", "class_year", 80.0)
+
+    # Examined and returned come from the same explain
+    plan = summarize_explain({
+        "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+        "executionStats": {"totalDocsExamined": 5000, "totalKeysExamined": 0, "nReturned": 2},
+    })
+    assert (plan["collection_scan"], plan["docs_examined"], plan["returned"]) == (True, 5000, 2)
+    assert plan["examined_per_returned"] == 2500.0
+
+
+def test_cli_serve_builds_uvicorn_config(monkeypatch):
+    import uvicorn
+    from typer.testing import CliRunner
+    import cli
+
+    calls = []
+    monkeypatch.setattr(uvicorn, "run", lambda app, **config: calls.append((app, config)))
+    monkeypatch.setenv("FORWARDED_ALLOW_IPS", "10.0.0.1,10.0.0.2")
+    result = CliRunner().invoke(cli.cli, ["serve", "--workers", "3", "--port", "9000", "--keep-alive", "120"])
+    assert result.exit_code == 0, result.output
+
+    [(app, config)] = calls
+    assert app == "server:app"
+    assert (config["workers"], config["port"], config["timeout_keep_alive"]) == (3, 9000, 120)
+    assert config["proxy_headers"] is True and config["forwarded_allow_ips"] == "10.0.0.1,10.0.0.2"
+    assert config["loop"] in ("uvloop", "asyncio") and config["http"] in ("httptools", "h11")
+    assert config["app_dir"] == os.path.dirname(cli.__file__)
+
+
+def test_mongo_client_options_come_from_settings(monkeypatch):
+    import database
+    from pymongo.read_preferences import SecondaryPreferred
+
+    monkeypatch.setattr(database, "MONGO_MAX_POOL_SIZE", 20)
+    monkeypatch.setattr(database, "MONGO_WAIT_QUEUE_TIMEOUT_MS", 750)
+    client = database.create_client("mongodb://localhost:27017")
+    try:
+        assert client.options.pool_options.max_pool_size == 20
+        assert client.options.pool_options.wait_queue_timeout == 0.75
+    finally:
+        client.close()
+
+    assert database.read_preference("secondary_preferred", 90) == SecondaryPreferred(max_staleness=90)
+    with pytest.raises(ValueError):
+        database.read_preference("ovunque")
+    assert database.available_compressors("zlib,lzma") == ("zlib",)
+